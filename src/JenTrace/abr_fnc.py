@@ -4,6 +4,22 @@ Created on Sat Apr 18 09:57:31 2020
 @author: David Vasquez
 Function:   -seidel_coef
             -plot_seidel
+            -paraxial_trace
+            -paraxial_focal_length
+            -system_arrays
+            -paraxial_trace_array
+            -paraxial_rays
+            -seidel_array
+            -paraxial_seidel
+            -chromatic_array
+            -paraxial_chromatic
+            -focal_shift
+            -plot_focal_shift
+            -series_tables
+            -series_mul
+            -series_power
+            -ray_series
+            -fifth_order
 """
 try: import JenTrace
 except ModuleNotFoundError: 
@@ -12,6 +28,28 @@ except ModuleNotFoundError:
 
 import numpy 
 import matplotlib.pyplot as plt
+from JenTrace.catalog import refraction_index, refraction_index_array
+from JenTrace.srf_tbl import SurfaceRow, surface_columns
+
+'''
+Fifth-order transverse ray aberration terms: name, image coordinate (0: x,
+1: y) and exponents of the normalized pupil (px,py) and field (H) coordinates
+'''
+FIFTH_ORDER_TERMS = [('Spherical'                    ,1,(0,5,0)),
+                     ('Tangential coma'              ,1,(0,4,1)),
+                     ('Sagittal coma'                ,1,(4,0,1)),
+                     ('Tangential oblique spherical' ,1,(0,3,2)),
+                     ('Sagittal oblique spherical'   ,0,(3,0,2)),
+                     ('Tangential elliptical coma'   ,1,(0,2,3)),
+                     ('Sagittal elliptical coma'     ,1,(2,0,3)),
+                     ('Tangential field curvature'   ,1,(0,1,4)),
+                     ('Sagittal field curvature'     ,0,(1,0,4)),
+                     ('Distortion'                   ,1,(0,0,5))]
+
+'''
+Truncated power series tables, key: order
+'''
+SERIES_CACHE = {}
 
 def seidel_coef(OptDsg):
 
@@ -93,6 +131,459 @@ def plot_seidel(SeidelCoef):
     plt.show()
         
     
+def paraxial_trace(SurfaceData,wvln,y0,u0):
+    '''
+    Paraxial (y-nu) ray trace through the optical system surfaces.
+    
+    SurfaceData: list of lists, (d,C,n,surfType)
+    wvln: wavelength in nm, used for the glass materials
+    y0:   ray height at the object surface (mm)
+    u0:   ray slope in the object space
+    
+    Returns three numpy arrays [k]: ray height (y) on each surface, ray slope (u)
+    after each surface and refraction index (n) after each surface.
+    '''
+    d,C,n = system_arrays(SurfaceData,wvln)
+    y,u   = paraxial_trace_array(d,C,n,y0,u0)
+    return y,u,n
+
+def paraxial_focal_length(SurfaceData,wvln):
+    '''
+    Effective focal length (efl) and back focal length (bfl) of the surfaces 
+    between the object and the image. The bfl is measured from the last surface 
+    before the image. An afocal system returns numpy.inf for both values.
+    '''
+    y,u,n = paraxial_trace(SurfaceData,wvln,1.0,0.0)
+    
+    if u[-2] == 0:
+        return numpy.inf, numpy.inf
+    
+    efl = -y[1]/u[-2]
+    bfl = -y[-2]/u[-2]
+    
+    return efl,bfl
+
+def system_arrays(systems,wavelengths):
+    '''
+    Surface arrays of one or several optical systems.
+    
+    systems:     SurfaceData (list of lists, (d,C,n,surfType)) or list of S
+                 SurfaceData with the same number of surfaces k
+    wavelengths: wavelength or list of W wavelengths in nm
+    
+    Returns the numpy arrays d,C and n. One system and one wavelength: [k]. 
+    Otherwise d,C [S,1,1,k] and n [S,W,1,k], ready to broadcast over the 
+    [system, wavelength, field] axes. The indices of all the materials and 
+    wavelengths are computed as one array (refraction_index_array).
+    '''
+    single  = not isinstance(systems[0][0],(list,tuple,SurfaceRow))
+    scalar  = numpy.ndim(wavelengths) == 0
+    if single:
+        systems = [systems]
+    wavelengths = numpy.atleast_1d(wavelengths)
+    columns = [surface_columns(SurfaceData) for SurfaceData in systems]
+    d = numpy.array([column[0] for column in columns])
+    C = numpy.array([column[1] for column in columns])
+    
+    # Materials -> rows of the index table [materials,W]
+    rows  = {}
+    order = [[rows.setdefault(material,len(rows)) for material in column[2]] 
+             for column in columns]
+    table = refraction_index_array(list(rows),wavelengths)
+    n = numpy.moveaxis(table[numpy.array(order)],-1,1)
+    
+    if single and scalar:
+        return d[0],C[0],n[0,0]
+    return d[:,None,None,:],C[:,None,None,:],n[:,:,None,:]
+
+def paraxial_trace_array(d,C,n,y0,u0):
+    '''
+    Paraxial (y-nu) ray trace of stacks of rays and systems. The surfaces are 
+    the last axis, all the other axes are broadcast together.
+    
+    d,C,n: numpy arrays [...,k], thickness, curvature and refraction index
+    y0,u0: numpy arrays [...], ray height and slope at the object surface
+    
+    Returns two numpy arrays [...,k]: ray height (y) on each surface and ray 
+    slope (u) after each surface.
+    '''
+    shape = numpy.broadcast_shapes(numpy.shape(d),numpy.shape(C),numpy.shape(n),
+                                   numpy.shape(y0)+(1,),numpy.shape(u0)+(1,))
+    # Surfaces first, every surface is a contiguous block of rays
+    d,C,n = [numpy.moveaxis(numpy.asarray(x,dtype=float),-1,0) for x in (d,C,n)]
+    y = numpy.empty((shape[-1],)+shape[:-1])
+    u = numpy.empty((shape[-1],)+shape[:-1])
+    y[0] = y0
+    u[0] = u0
+    for w in range (1,shape[-1]):       # k -> surface indice (start in 1)
+        #Transfer
+        y[w] = y[w-1] + d[w-1]*u[w-1]
+        #Refraction n'u' = nu - yC(n'-n)
+        u[w] = (n[w-1]*u[w-1] - y[w]*C[w]*(n[w]-n[w-1]))/n[w]
+    return numpy.moveaxis(y,0,-1),numpy.moveaxis(u,0,-1)
+
+def paraxial_rays(d,C,n,aprRad,aprInd,fields,fieldType='height'):
+    '''
+    Paraxial marginal and chief rays of stacks of systems and fields. The 
+    trace is linear, so two unit rays traced once per system and wavelength 
+    give the rays of all the fields.
+    
+    d,C,n:     numpy arrays [...,k] (see system_arrays)
+    aprRad:    aperture stop radius, the marginal ray height on the stop
+    aprInd:    aperture stop index
+    fields:    numpy array [F], object height in mm (fieldType='height') or 
+               field angle in degrees (fieldType='angle', object at infinity)
+    
+    Returns the marginal ray y,u and the chief ray yb,ub, numpy arrays [...,F,k]
+    '''
+    assert fieldType in ('height','angle'), 'fieldType must be "height" or "angle"'
+    fields = numpy.atleast_1d(numpy.asarray(fields,dtype=float))
+    # Unit rays: index 0 -> (y0=1,u0=0), index 1 -> (y0=0,u0=1)
+    yUnit,uUnit = paraxial_trace_array(d[...,None,:],C[...,None,:],n[...,None,:],
+                                       numpy.array([1.0,0.0]),numpy.array([0.0,1.0]))
+    Y1,Y2 = yUnit[...,0,:],yUnit[...,1,:]
+    U1,U2 = uUnit[...,0,:],uUnit[...,1,:]
+    a = Y1[...,aprInd,None]           # stop height per unit y0
+    b = Y2[...,aprInd,None]           # stop height per unit u0
+    
+    if fieldType == 'height':
+        y0,u0   = 0.0*a,aprRad/b
+        yb0     = fields + 0.0*a
+        ub0     = -fields*a/b
+    else:
+        y0,u0   = aprRad/a,0.0*a
+        ub0     = numpy.tan(numpy.radians(fields)) + 0.0*a
+        yb0     = -ub0*b/a
+    
+    # Marginal ray does not depend on the field
+    y  = y0[...,None]*Y1[...,None,:]  + u0[...,None]*Y2[...,None,:]  + 0.0*fields[:,None]
+    u  = y0[...,None]*U1[...,None,:]  + u0[...,None]*U2[...,None,:]  + 0.0*fields[:,None]
+    yb = yb0[...,None]*Y1[...,None,:] + ub0[...,None]*Y2[...,None,:]
+    ub = yb0[...,None]*U1[...,None,:] + ub0[...,None]*U2[...,None,:]
+    return y,u,yb,ub
+
+def seidel_array(C,n,y,u,yb,ub):
+    '''
+    Seidel coefficients of stacks of paraxial marginal (y,u) and chief (yb,ub) 
+    rays, the same sums as seidel_coef evaluated over all the surfaces with 
+    array operations.
+    
+    C,n:        numpy arrays [...,k], curvature and refraction index
+    y,u,yb,ub:  numpy arrays [...,k], from paraxial_rays
+    
+    Returns numpy array [...,5,k]: spherical, coma, astigmatism, Petzval 
+    curvature and distortion per surface (surface 0 is zero).
+    '''
+    shape = numpy.broadcast_shapes(numpy.shape(C),numpy.shape(n),numpy.shape(y))
+    # Dense arrays, surfaces first: every surface is a contiguous block of rays
+    SeidelCoef = numpy.zeros((5,shape[-1])+shape[:-1])
+    C,n,y,u,yb,ub = [numpy.ascontiguousarray(numpy.moveaxis(numpy.broadcast_to(x,shape),-1,0))
+                     for x in (C,n,y,u,yb,ub)]
+    
+    # Medium before (n,U) and after (n_p,U_p) the surfaces 1..k-1
+    n_  ,n_p  = n[:-1],n[1:]
+    U   ,U_p  = u[:-1],u[1:]
+    U_b       = ub[:-1]
+    h   ,h_b  = y[1:],yb[1:]
+    c         = C[1:]
+    
+    # Abreviations
+    A     =  n_*(h  *c+U  )
+    A_b   =  n_*(h_b*c+U_b)
+    H     =  n_*(U*h_b-U_b*h) #Lagrange invariant
+    dUn   =  (U_p/n_p) - (U/n_)
+    dn    =  (1/n_p) - (1/n_)
+    
+    SeidelCoef[0,1:] = -( (A**2)  * h * dUn )
+    SeidelCoef[1,1:] = -( (A*A_b) * h * dUn )
+    SeidelCoef[2,1:] = -( (A_b**2)* h * dUn )
+    SeidelCoef[3,1:] = -( (H**2)  * c * dn  )
+    # Distortion: -(A_b**3/A*h*dUn + A_b/A*H**2*c*dn) = A_b/A*(astigmatism+Petzval)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        SeidelCoef[4,1:] = (A_b/A) * (SeidelCoef[2,1:] + SeidelCoef[3,1:])
+    return numpy.moveaxis(SeidelCoef,(0,1),(-2,-1))
+
+def paraxial_seidel(systems,wavelengths,fields,aprRad=1.0,aprInd=1,fieldType='height'):
+    '''
+    Seidel coefficients from the paraxial marginal and chief rays, no real 
+    ray aiming (OpDesign) is needed.
+    
+    systems:     SurfaceData or list of S SurfaceData with the same number of 
+                 surfaces
+    wavelengths: wavelength or list of W wavelengths in nm
+    fields:      object height (mm) or field angle (degrees, fieldType='angle'),
+                 scalar or list of F fields
+    aprRad:      aperture stop radius
+    aprInd:      aperture stop index
+    
+    Returns numpy array [S,W,F,5,k], or [5,k] for one system, one wavelength 
+    and one field (the same layout as seidel_coef and plot_seidel).
+    '''
+    single = not isinstance(systems[0][0],(list,tuple,SurfaceRow))
+    scalar = numpy.ndim(wavelengths) == 0 and numpy.ndim(fields) == 0
+    d,C,n  = system_arrays(systems if not single else [systems],
+                           numpy.atleast_1d(wavelengths))
+    # d,C,n [S,W,1,k] -> rays [S,W,F,k]
+    y,u,yb,ub  = paraxial_rays(d[...,0,:],C[...,0,:],n[...,0,:],aprRad,aprInd,
+                               fields,fieldType)
+    SeidelCoef = seidel_array(C,n,y,u,yb,ub)
+    if single and scalar:
+        return SeidelCoef[0,0,0]
+    return SeidelCoef
+
+def chromatic_array(C,n,dn,y,u,yb,ub):
+    '''
+    Primary chromatic coefficients of stacks of paraxial marginal (y,u) and 
+    chief (yb,ub) rays at the reference wavelength.
+    
+    C,n:        numpy arrays [...,k], curvature and refraction index
+    dn:         numpy array [...,k], index difference between the short and 
+                the long wavelength (e.g. nF - nC)
+    y,u,yb,ub:  numpy arrays [...,k], from paraxial_rays
+    
+    Returns numpy array [...,2,k]: axial colour A*h*d(dn/n) and lateral colour 
+    A_b*h*d(dn/n) per surface (surface 0 is zero).
+    '''
+    shape = numpy.broadcast_shapes(numpy.shape(C),numpy.shape(n),numpy.shape(dn),
+                                   numpy.shape(y))
+    # Dense arrays, surfaces first: every surface is a contiguous block of rays
+    ChromCoef = numpy.zeros((2,shape[-1])+shape[:-1])
+    C,n,dn,y,u,yb,ub = [numpy.ascontiguousarray(numpy.moveaxis(numpy.broadcast_to(x,shape),-1,0))
+                        for x in (C,n,dn,y,u,yb,ub)]
+    
+    n_        = n[:-1]
+    U   ,U_b  = u[:-1],ub[:-1]
+    h   ,h_b  = y[1:],yb[1:]
+    c         = C[1:]
+    A     =  n_*(h  *c+U  )
+    A_b   =  n_*(h_b*c+U_b)
+    dDn   =  (dn[1:]/n[1:]) - (dn[:-1]/n_)
+    
+    ChromCoef[0,1:] = A   * h * dDn
+    ChromCoef[1,1:] = A_b * h * dDn
+    return numpy.moveaxis(ChromCoef,(0,1),(-2,-1))
+
+def paraxial_chromatic(systems,fields,wvlnShort=486.1,wvlnRef=587.6,wvlnLong=656.3,
+                       aprRad=1.0,aprInd=1,fieldType='height'):
+    '''
+    Axial and lateral colour coefficients per surface from the paraxial rays 
+    at the reference wavelength and the index difference between the short 
+    and long wavelengths (F, d and C lines by default).
+    
+    systems: SurfaceData or list of S SurfaceData with the same number of 
+             surfaces
+    fields:  object height (mm) or field angle (degrees, fieldType='angle'),
+             scalar or list of F fields
+    
+    Returns numpy array [S,F,2,k], or [2,k] for one system and one field.
+    '''
+    single = not isinstance(systems[0][0],(list,tuple,SurfaceRow))
+    scalar = numpy.ndim(fields) == 0
+    d,C,n  = system_arrays(systems if not single else [systems],
+                           [wvlnShort,wvlnRef,wvlnLong])
+    # n [S,3,1,k] -> reference index and dispersion [S,k], rays [S,F,k]
+    nRef = n[:,1,0]
+    dn   = n[:,0,0] - n[:,2,0]
+    y,u,yb,ub = paraxial_rays(d[:,0,0],C[:,0,0],nRef,aprRad,aprInd,fields,fieldType)
+    ChromCoef = chromatic_array(C[:,0],nRef[:,None],dn[:,None],y,u,yb,ub)
+    if single and scalar:
+        return ChromCoef[0,0]
+    return ChromCoef
+
+def focal_shift(systems,wavelengths,wvlnRef=587.6,fieldType='height'):
+    '''
+    Chromatic focal shift: paraxial back focal distance (from the last surface
+    before the image) of every wavelength minus the one of wvlnRef. All the 
+    wavelengths and systems are traced in one array operation.
+    
+    systems:     SurfaceData or list of S SurfaceData with the same number of 
+                 surfaces
+    wavelengths: list of W wavelengths in nm (e.g. a dense sweep)
+    fieldType:   'height', object at the object surface distance; 'angle', 
+                 object at infinity
+    
+    Returns numpy array [W], or [S,W] for a list of systems
+    '''
+    single = not isinstance(systems[0][0],(list,tuple,SurfaceRow))
+    wavelengths = numpy.atleast_1d(numpy.asarray(wavelengths,dtype=float))
+    d,C,n  = system_arrays(systems if not single else [systems],
+                           numpy.append(wavelengths,wvlnRef))
+    # Paraxial marginal ray from the axial object point, n [S,W+1,1,k]
+    if fieldType == 'height':
+        y,u = paraxial_trace_array(d,C,n,0.0,1e-3)
+    else:
+        y,u = paraxial_trace_array(d,C,n,1.0,0.0)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        bfl = -y[...,0,-2]/u[...,0,-2]
+    shift = bfl[:,:-1] - bfl[:,-1:]
+    return shift[0] if single else shift
+
+def plot_focal_shift(wavelengths,shift,labels=None):
+    '''
+    Plots focal shift curves, shift numpy array [W] or [S,W]
+    '''
+    shift = numpy.atleast_2d(shift)
+    fig, ax = plt.subplots()
+    for q in range(shift.shape[0]):
+        label = labels[q] if labels is not None else None
+        ax.plot(wavelengths,1000*shift[q],label=label)
+    ax.axhline(0,color='black',lw=0.8)
+    ax.grid('on')
+    if labels is not None:
+        ax.legend()
+    ax.set_xlabel('wavelength[nm]')
+    ax.set_ylabel('focal shift[um]')
+    return fig, ax
+
+def series_tables(order=5):
+    '''
+    Monomials px^a py^b H^c of total degree <= order (index 0 is the constant 
+    term) and the product table: pairs (I,J) sorted by the product monomial, 
+    Starts are the first pair of every product monomial. Cached per order.
+    '''
+    if order not in SERIES_CACHE:
+        monomials = [(a,b,deg-a-b) for deg in range(order+1) 
+                     for a in range(deg,-1,-1) for b in range(deg-a,-1,-1)]
+        index = {mono:q for q,mono in enumerate(monomials)}
+        pairs = [(index[tuple(numpy.add(m1,m2))],q1,q2) 
+                 for q1,m1 in enumerate(monomials) for q2,m2 in enumerate(monomials)
+                 if sum(m1)+sum(m2) <= order]
+        pairs.sort()
+        K,I,J  = numpy.array(pairs).T
+        Starts = numpy.searchsorted(K,numpy.arange(len(monomials)))
+        SERIES_CACHE[order] = (monomials,index,I,J,Starts)
+    return SERIES_CACHE[order]
+
+def series_mul(a,b,order=5):
+    '''
+    Product of truncated power series a,b: numpy arrays [...,m]
+    '''
+    monomials,index,I,J,Starts = series_tables(order)
+    return numpy.add.reduceat(a[...,I]*b[...,J],Starts,axis=-1)
+
+def series_power(a,alpha,order=5):
+    '''
+    a**alpha of a truncated power series with a non zero constant term, 
+    binomial expansion around the constant term
+    '''
+    a0  = a[...,:1]
+    x   = a/a0
+    x[...,0] = 0.0
+    term   = numpy.zeros(a.shape)
+    term[...,0] = 1.0
+    result = term.copy()
+    coef   = 1.0
+    for q in range(1,order+1):
+        coef   = coef*(alpha-q+1)/q
+        term   = series_mul(term,x,order)
+        result = result + coef*term
+    return result*a0**alpha
+
+def ray_series(systems,wvln,field,aprRad=1.0,aprInd=1,fieldType='height',order=5):
+    '''
+    Real ray trace with truncated power series: the ray coordinates are 
+    polynomials of the normalized paraxial pupil (px,py) and field (H) 
+    coordinates, every operation of the exact trace (transfer to a sphere, 
+    refraction) is applied to the series and truncated at the given order.
+    
+    After every surface w the ray is carried paraxially to the image, so the 
+    image intercept w includes the exact trace of the surfaces 1..w.
+    
+    systems: SurfaceData or list of S SurfaceData with the same number of 
+             surfaces
+    field:   full field, object height (mm) or field angle (degrees, 
+             fieldType='angle'); H=1 is the full field along y
+    
+    Returns numpy arrays X,Y [S,m,k], image intercept series for every 
+    surface (see series_tables for the monomials)
+    '''
+    single = not isinstance(systems[0][0],(list,tuple,SurfaceRow))
+    d,C,n  = system_arrays(systems if not single else [systems],[wvln])
+    d,C,n  = d[:,0,0],C[:,0,0],n[:,0,0]
+    S,k    = d.shape
+    y,u,yb,ub = paraxial_rays(d,C,n,aprRad,aprInd,field,fieldType)
+    monomials,index,I,J,Starts = series_tables(order)
+    m      = len(monomials)
+    mul    = lambda a,b: series_mul(a,b,order)
+    
+    def plus(a,const):
+        # Adds a constant (per system) to the constant term of the series
+        a = a.copy()
+        a[:,0] += numpy.ravel(const)
+        return a
+    
+    def linear(px=0.0,py=0.0,H=0.0,const=0.0):
+        a = numpy.zeros([S,m])
+        a[:,0] = const
+        a[:,index[(1,0,0)]] = px
+        a[:,index[(0,1,0)]] = py
+        a[:,index[(0,0,1)]] = H
+        return a
+    
+    # Object space ray, linear in the paraxial pupil and field coordinates
+    X  = linear(px=y[:,0,0])
+    Y  = linear(py=y[:,0,0],H=yb[:,0,0])
+    sx = linear(px=u[:,0,0])
+    sy = linear(py=u[:,0,0],H=ub[:,0,0])
+    Z  = numpy.zeros([S,m])
+    N  = series_power(plus(mul(sx,sx) + mul(sy,sy),1.0),-0.5,order)
+    L  = mul(sx,N)
+    M  = mul(sy,N)
+    
+    Ximg = numpy.zeros([S,m,k])
+    Yimg = numpy.zeros([S,m,k])
+    for w in range(0,k-1):
+        if w > 0:
+            c = C[:,w,None]
+            #Transfer to the sphere c(X^2+Y^2+Z^2) - 2Z = 0
+            Zr = plus(Z,-d[:,w-1])
+            F  = c*(mul(X,X)+mul(Y,Y)+mul(Zr,Zr)) - 2*Zr
+            G  = N - c*(mul(X,L)+mul(Y,M)+mul(Zr,N))
+            t  = mul(F,series_power(G + series_power(mul(G,G)-c*F,0.5,order),-1,order))
+            X,Y,Z = X + mul(t,L),Y + mul(t,M),Zr + mul(t,N)
+            #Refraction n'D' = nD + (n'cosI' - n cosI)*normal
+            n0,n1 = n[:,w-1,None],n[:,w,None]
+            cosI  = -c*(mul(X,L)+mul(Y,M)) + N - c*mul(Z,N)
+            g     = series_power(plus(n0**2*mul(cosI,cosI),n1**2-n0**2),0.5,order) - n0*cosI
+            L,M,N = (n0*L - c*mul(g,X))/n1,(n0*M - c*mul(g,Y))/n1,(n0*N + mul(g,plus(-c*Z,1.0)))/n1
+        
+        # Vertex plane position and slopes, paraxial transfer to the image
+        invN  = series_power(N,-1,order)
+        sx,sy = mul(L,invN),mul(M,invN)
+        X0,Y0 = X - mul(Z,sx),Y - mul(Z,sy)
+        yUnit,uUnit = paraxial_trace_array(d[:,None,w:],C[:,None,w:],n[:,None,w:],
+                                           numpy.array([1.0,0.0]),numpy.array([0.0,1.0]))
+        A,B = yUnit[:,0,-1,None],yUnit[:,1,-1,None]
+        Ximg[:,:,w] = A*X0 + B*sx
+        Yimg[:,:,w] = A*Y0 + B*sy
+    Ximg[:,:,-1] = Ximg[:,:,-2]
+    Yimg[:,:,-1] = Yimg[:,:,-2]
+    return Ximg,Yimg
+
+def fifth_order(systems,wvln,field,aprRad=1.0,aprInd=1,fieldType='height'):
+    '''
+    Fifth-order transverse ray aberration coefficients per surface (mm on the 
+    image surface, full aperture and full field), the terms of 
+    FIFTH_ORDER_TERMS.
+    
+    The coefficients come from ray_series: the contribution of the surface w
+    is the change of the fifth-order image terms when the surface is traced 
+    exactly instead of paraxially. It includes the intrinsic part and the 
+    part induced by the aberrations of the previous surfaces, and the sum over
+    the surfaces is the fifth-order aberration of the system.
+    
+    Returns numpy array [S,10,k], or [10,k] for one system (surface 0 and the 
+    image surface are zero).
+    '''
+    single = not isinstance(systems[0][0],(list,tuple,SurfaceRow))
+    Ximg,Yimg  = ray_series(systems,wvln,field,aprRad,aprInd,fieldType)
+    monomials,index,I,J,Starts = series_tables()
+    FifthCoef  = numpy.zeros(Ximg.shape[:1]+(len(FIFTH_ORDER_TERMS),Ximg.shape[2]))
+    for q,(name,coord,mono) in enumerate(FIFTH_ORDER_TERMS):
+        series = Yimg if coord == 1 else Ximg
+        FifthCoef[:,q,1:] = numpy.diff(series[:,index[mono],:],axis=-1)
+    return FifthCoef[0] if single else FifthCoef
+
 
 if __name__=='__main__':
     from opt_sys import OpSysData
@@ -119,6 +610,18 @@ if __name__=='__main__':
     
     SCoef =  seidel_coef(design1)
     print(SCoef)
+    # Paraxial Seidel coefficients, no ray aiming
+    print(paraxial_seidel(syst1.SurfaceData,635,1.0,aprInd=3))
+    print(paraxial_seidel(syst1.SurfaceData,[486.1,587.6,656.3],[0,0.5,1.0],aprInd=3).shape)
+    # Axial and lateral colour, focal shift curve
+    print(paraxial_chromatic(syst1.SurfaceData,1.0,aprInd=3))
+    wvlnSweep = numpy.linspace(450,750,151)
+    plot_focal_shift(wvlnSweep,focal_shift(syst1.SurfaceData,wvlnSweep))
+    # Fifth-order coefficients, sum over the surfaces
+    FifthCoef = fifth_order(syst1.SurfaceData,635,1.0,aprInd=3)
+    for (name,coord,mono),coef in zip(FIFTH_ORDER_TERMS,FifthCoef.sum(axis=1)):
+        print("{: >30} {: 12e}".format(name,coef))
+    print(paraxial_focal_length(syst1.SurfaceData,635))
     
     # plot design
     design1.plot_design(clearSemDia)
@@ -2,7 +2,16 @@
 """
 Created on Wed Apr  1 21:45:28 2020
 @author: David Vasquez
-Function: sellmeierDispForm
+Function: -sellmeierDispForm
+          -refraction_index
+          -glass_index
+          -compile_glass_table
+          -glass_rows
+          -sellmeier_array
+          -dispersion
+          -refraction_index_array
+          -load_catalog
+          -catalog_glass
 Optical Glass information took from:
     SCHOTT: Optical Glass - Datasheets - May 2019
     OHARA:  Glaskatalog_komplett - Version_19_Okt_2018
@@ -13,6 +22,9 @@ except ModuleNotFoundError:
     sys.path.insert(0,os.path.dirname(os.getcwd()))
 
 import math
+import numpy as np
+from functools import lru_cache
+from JenTrace.gls_cat import GlassCatalog
 #Dictionary with Sellmeier Constants for Dispersion Formula
 #/////////////NAME///////B1//////////B2//////////B3/////////C1////////////C2///////////C3///////////       
 OPT_GLASS = { 
@@ -345,6 +357,11 @@ OPT_GLASS = {
 
 }
 
+'''
+Vendor sections of OPT_GLASS: vendor name and first glass of the section
+'''
+OPT_GLASS_VENDORS = [('SCHOTT','F2'),('OHARA','S-FPM5')]
+
 def sellmeierDispForm (glass,wvln):
     '''
     glass:(list) List of the Sellmeier dispersion constants [B1.B2,B3,C1,C2,C3]
@@ -360,5 +377,143 @@ def sellmeierDispForm (glass,wvln):
     
     return refIndex
 
+def refraction_index (material,wvln):
+    '''
+    material:(float or str) Refraction index or glass name in OPT_GLASS or
+             in a loaded catalog (load_catalog)
+    wvln    :(float)Wavelength in nm
+    '''
+    if isinstance(material,str):
+        return glass_index(material,float(wvln))
+    return float(material)
+
+@lru_cache(maxsize=4096)
+def glass_index (name,wvln):
+    '''
+    Memoized refraction index of the glass name (row of GLASS_TABLE, else
+    the first loaded catalog with the name) at the wavelength wvln in nm. 
+    The memo is cleared by compile_glass_table and load_catalog
+    '''
+    row = GLASS_INDEX.get(name)
+    if row is None:
+        return float(catalog_glass(name).index(name,wvln))
+    return sellmeierDispForm(GLASS_ROWS[row],wvln)
+
+'''
+Compiled glass table:
+    GLASS_NAMES: list of the glass names, row order
+    GLASS_INDEX: dictionary glass name -> row
+    GLASS_TABLE: numpy array [G,6] (contiguous), Sellmeier constants per row
+    GLASS_ROWS : list of the rows as Python floats (scalar evaluation)
+'''
+GLASS_NAMES = []
+GLASS_INDEX = {}
+GLASS_TABLE = np.empty([0,6])
+GLASS_ROWS  = []
+
+def compile_glass_table ():
+    '''
+    Compiles OPT_GLASS into GLASS_TABLE and GLASS_INDEX. Call it after adding
+    glasses to OPT_GLASS, the memo of glass_index is cleared.
+    '''
+    global GLASS_TABLE
+    GLASS_NAMES[:] = list(OPT_GLASS)
+    GLASS_INDEX.clear()
+    GLASS_INDEX.update({name:row for row,name in enumerate(GLASS_NAMES)})
+    GLASS_TABLE = np.ascontiguousarray([OPT_GLASS[name] for name in GLASS_NAMES],dtype=float)
+    GLASS_ROWS[:] = GLASS_TABLE.tolist()
+    glass_index.cache_clear()
+
+def glass_rows (glasses):
+    '''
+    glasses:(list) Glass names or rows of GLASS_TABLE
+    Returns the rows, numpy array of int
+    '''
+    try:
+        return np.array([GLASS_INDEX[glass] if isinstance(glass,str) else glass 
+                         for glass in glasses],dtype=int)
+    except KeyError as error:
+        raise ValueError('%s, non existent glass material' % error.args[0])
+
+def sellmeier_array (glasses,wvln):
+    '''
+    glasses:(numpy array [M,6]) Sellmeier dispersion constants, one glass per row
+    wvln   :(numpy array, any shape) Wavelengths in nm
+    Returns the refraction indices, numpy array [M,*wvln.shape]
+    '''
+    glasses = np.asarray(glasses,dtype=float)
+    # Convert from nm to µm, axes [glass,*wavelength,term]
+    wvln2 = ((np.asarray(wvln,dtype=float)/1000.0)**2)[None,...,None]
+    shape = (len(glasses),)+(1,)*(wvln2.ndim-2)+(3,)
+    B = glasses[:,0:3].reshape(shape)
+    C = glasses[:,3:6].reshape(shape)
+    return np.sqrt(1 + np.sum(B*wvln2/(wvln2-C),axis=-1))
+
+def dispersion (glasses,wvln):
+    '''
+    glasses:(list) Glass names or rows of GLASS_TABLE, all the glasses by 
+            default (None)
+    wvln   :(numpy array, any shape) Wavelengths in nm
+    Returns the refraction indices of every glass at every wavelength in one
+    broadcast, numpy array [len(glasses),*wvln.shape]
+    '''
+    if glasses is None:
+        return sellmeier_array(GLASS_TABLE,wvln)
+    return sellmeier_array(GLASS_TABLE[glass_rows(glasses)],wvln)
+
+def refraction_index_array (materials,wvln):
+    '''
+    materials:(list) Refraction indices (float) or glass names in OPT_GLASS
+              or in a loaded catalog
+    wvln     :(numpy array [W]) Wavelengths in nm
+    Returns the refraction indices, numpy array [len(materials),W]. All the 
+    OPT_GLASS glasses are evaluated in one Sellmeier array operation.
+    '''
+    wvln  = np.atleast_1d(np.asarray(wvln,dtype=float))
+    index = np.empty([len(materials),len(wvln)])
+    glass = []
+    for q,material in enumerate(materials):
+        if not isinstance(material,str):
+            index[q] = float(material)
+        elif material in GLASS_INDEX:
+            glass.append(q)
+        else:
+            index[q] = catalog_glass(material).index(material,wvln)
+    if glass:
+        index[glass] = dispersion([materials[q] for q in glass],wvln)
+    return index
+
+'''
+Loaded external glass catalogs (GlassCatalog), searched in order after 
+OPT_GLASS. The glasses are resolved lazily by name from the memory-mapped 
+cache of every catalog.
+'''
+GLASS_CATALOGS = []
+
+def load_catalog (path,cachePath=None):
+    '''
+    path     :(str) AGF glass catalog, compiled into its binary cache 
+              (cachePath, by default path + '.npy') on the first use
+    Returns the GlassCatalog
+    '''
+    catalog = GlassCatalog(path,cachePath)
+    GLASS_CATALOGS.append(catalog)
+    glass_index.cache_clear()
+    return catalog
+
+def catalog_glass (name):
+    '''
+    Returns the first loaded GlassCatalog with the glass name
+    '''
+    for catalog in GLASS_CATALOGS:
+        if name in catalog:
+            return catalog
+    raise ValueError('%s, non existent glass material' % name)
+
+compile_glass_table()
+
 if __name__ == '__main__':
-    coef= sellmeierDispForm (OPT_GLASS['N-SF5'],1060.0)
\ No newline at end of file
+    coef= sellmeierDispForm (OPT_GLASS['N-SF5'],1060.0)
+    print(refraction_index('N-SF5',1060.0), refraction_index(1.5,1060.0))
+    print(refraction_index_array(['N-SF5',1.5,'N-BK7'],[486.1,587.6,656.3]))
+    print(dispersion(None,np.linspace(400,800,401)).shape, glass_index.cache_info())
\ No newline at end of file
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+FFT diffraction PSF and MTF
+Class:      -DiffractionGrid
+            -DiffractionPSF
+functions:  -diffraction_grid
+            -image_aperture
+            -pupil_opd
+            -fft_psf
+            -diffraction_psf
+
+The pupil is sampled on a regular square grid (OpDesign.pupil_source), the
+complex pupil function exp(2*pi*i*OPD) is zero padded and the PSF is
+|FFT|^2. The MTF is the modulus of the real FFT of the PSF. The pupil grid
+is cached per (gridSize, padding) and shared (read-only) across fields,
+optimizer iterations and threads. The padded FFT buffer is reused per thread,
+the OPD map is allocated per call; scipy.fft keeps its own plan (twiddle
+factor) cache for repeated transform sizes.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import threading
+import numpy as np
+import scipy.fft
+import matplotlib.pyplot as plt
+from JenTrace.catalog import refraction_index
+from JenTrace.ray_trc import trace_surfaces
+from JenTrace.wvf_fnc import exit_pupil, reference_opd
+
+'''
+Cached diffraction grids, key: (gridSize, padding)
+'''
+GRID_CACHE = {}
+
+class DiffractionGrid:
+    '''
+    Regular pupil grid. The grid data is read-only, a cached grid is shared
+    by all the threads.
+
+    Attributes:
+        GridSize: pupil samples per side (N)
+        Padding : padding factor, the FFT size is M = N*Padding
+        Px,Py   : numpy arrays [N,N], normalized pupil coordinates
+        Inside  : numpy array [N,N] bool, points inside the unit circle
+        Peak    : PSF peak of the aberration-free pupil (Strehl normalization)
+        Local   : threading.local, padded FFT buffer of every thread
+    '''
+    def __init__(self,gridSize=64,padding=4):
+        self.GridSize = gridSize
+        self.Padding  = padding
+        g = (np.arange(gridSize) - gridSize//2)/(gridSize/2)
+        self.Px,self.Py = np.meshgrid(g,g)
+        self.Inside = self.Px**2 + self.Py**2 <= 1
+        self.Peak   = float(self.Inside.sum())**2
+        for array in (self.Px,self.Py,self.Inside):
+            array.flags.writeable = False
+        self.Local  = threading.local()
+
+    def buffer(self):
+        '''
+        Padded pupil function buffer, numpy array [M,M] complex, owned by the
+        calling thread
+        '''
+        if not hasattr(self.Local,'Buffer'):
+            M = self.GridSize*self.Padding
+            self.Local.Buffer = np.zeros([M,M],dtype=complex)
+        return self.Local.Buffer
+
+    def opd_map(self,opdInside):
+        '''
+        OPD map [N,N] (new array) from the OPD of the points inside the pupil,
+        numpy.nan outside
+        '''
+        opd = np.full([self.GridSize,self.GridSize],np.nan)
+        opd[self.Inside] = opdInside
+        return opd
+
+def diffraction_grid(gridSize=64,padding=4):
+    '''
+    Cached DiffractionGrid, the same object is returned for the same sizes
+    '''
+    key = (gridSize,padding)
+    if key not in GRID_CACHE:
+        GRID_CACHE.setdefault(key,DiffractionGrid(gridSize,padding))
+    return GRID_CACHE[key]
+
+class DiffractionPSF:
+    '''
+    Diffraction PSF of an optical design.
+
+    Attributes:
+        PSF       : numpy array [M,M], PSF [y,x] normalized to the peak of the
+                    aberration-free pupil (the maximum is the Strehl ratio)
+        Pitch     : [dx,dy] pixel pitch in mm
+        Strehl    : Strehl ratio
+        Wavelength: wavelength in nm
+        NA        : [NAx,NAy] image space numerical aperture
+    '''
+    def __init__(self,psf,pitch,wvln,NA):
+        self.PSF        = psf
+        self.Pitch      = np.asarray(pitch)
+        self.Strehl     = psf.max()
+        self.Wavelength = wvln
+        self.NA         = np.asarray(NA)
+
+    def extent(self):
+        M = self.PSF.shape[0]
+        return [-M/2*self.Pitch[0],(M/2-1)*self.Pitch[0],
+                -M/2*self.Pitch[1],(M/2-1)*self.Pitch[1]]
+
+    def mtf(self):
+        '''
+        Diffraction MTF from the real FFT of the PSF.
+        Returns the frequencies [cycles/mm] and MTF of the sagittal (x) and
+        tangential (y) directions, up to the cutoff 2*NA/wavelength
+        '''
+        M   = self.PSF.shape[0]
+        otf = np.abs(scipy.fft.rfft2(self.PSF))
+        otf = otf/otf[0,0]
+        fx  = np.arange(M//2+1)/(M*self.Pitch[0])
+        fy  = np.arange(M//2+1)/(M*self.Pitch[1])
+        cutoff = 2*self.NA/(self.Wavelength*1e-6)
+        sx = fx <= cutoff[0]
+        sy = fy <= cutoff[1]
+        return (fx[sx],otf[0,:M//2+1][sx]),(fy[sy],otf[:M//2+1,0][sy])
+
+    def print_report(self):
+        (fx,mtfS),(fy,mtfT) = self.mtf()
+        print("\nDIFFRACTION PSF")
+        print("Wavelength: {:f} nm, Strehl: {:f}".format(self.Wavelength,self.Strehl))
+        print("NA: [{:f} {:f}], pixel pitch: [{:f} {:f}] um".format(*self.NA,*1000*self.Pitch))
+        headers = ['Frequency','MTF T','MTF S']
+        print("{: >12} {: >12} {: >12} ".format(*headers))
+        for fraction in (0.1,0.25,0.5,0.75):
+            freq = fraction*min(fx[-1],fy[-1])
+            print("{:12f} {:12f} {:12f} ".format(freq,np.interp(freq,fy,mtfT),
+                                                 np.interp(freq,fx,mtfS)))
+
+    def plot(self):
+        fig, (ax1,ax2) = plt.subplots(1,2,figsize=(10,4))
+        ax1.imshow(self.PSF,extent=[1000*q for q in self.extent()],origin='lower',cmap='gray')
+        ax1.set_xlabel('x[um]')
+        ax1.set_ylabel('y[um]')
+        (fx,mtfS),(fy,mtfT) = self.mtf()
+        ax2.plot(fy,mtfT,'-',label='T')
+        ax2.plot(fx,mtfS,'--',label='S')
+        ax2.set_ylim(0,1.05)
+        ax2.grid('on')
+        ax2.legend()
+        ax2.set_xlabel('frequency[cycles/mm]')
+        ax2.set_ylabel('MTF')
+        return fig, (ax1,ax2)
+
+def image_aperture(optDsg,surfIndex=-1):
+    '''
+    Image space numerical aperture [NAx,NAy] from the aimed essential rays
+    (half the direction cosine difference of the marginal rays)
+    '''
+    RayTrace = optDsg.raySrcTrace
+    NAy = abs(RayTrace[1,20,surfIndex] - RayTrace[2,20,surfIndex])/2
+    NAx = abs(RayTrace[3,19,surfIndex] - RayTrace[4,19,surfIndex])/2
+    return np.array([NAx,NAy])
+
+def pupil_opd(optDsg,grid,surfIndex=-1):
+    '''
+    OPD (waves) of the design on the points of the grid inside the pupil, on
+    the reference sphere of the surface surfIndex (by default the image
+    plane). The exit pupil is the paraxial exit pupil of the system up to
+    surfIndex. Lost (vignetted) rays and points outside the pupil are 
+    numpy.nan.
+    Returns the OPD map, numpy array [N,N]
+    '''
+    SurfaceData = optDsg.optSys.SurfaceData
+    wvln        = optDsg.usrSrc.Wavelength
+    surfIndex   = surfIndex % len(SurfaceData)
+    assert surfIndex > optDsg.aprInd, 'The OPD surface (surfIndex) must be after the aperture stop'
+    XYZ,LMN = optDsg.pupil_source(grid.Px[grid.Inside],grid.Py[grid.Inside])
+    chief   = optDsg.usrSrc.RayList[0]
+    XYZ     = np.vstack([chief[0],XYZ])
+    LMN     = np.vstack([chief[1],LMN])
+    image   = trace_surfaces(XYZ,LMN,wvln,SurfaceData,[surfIndex])[:,:,0]
+    if surfIndex < len(SurfaceData)-1:
+        SurfaceData = SurfaceData[:surfIndex+1]
+    zXP     = exit_pupil(SurfaceData,wvln,optDsg.aprInd)
+    nImage  = refraction_index(SurfaceData[-2][2],wvln)
+    return grid.opd_map(reference_opd(image[:,2:5],image[:,5:8],image[:,8],
+                                      zXP,wvln,nImage)[1:])
+
+def fft_psf(grid,opd):
+    '''
+    PSF [M,M] of the pupil function exp(2*pi*i*opd) sampled on grid,
+    normalized to the aberration-free peak. The padded buffer of the calling
+    thread is reused, no array of size M x M is allocated for the pupil
+    function.
+    '''
+    N = grid.GridSize
+    buffer = grid.buffer()
+    buffer.fill(0)
+    amplitude = grid.Inside & np.isfinite(opd)
+    buffer[:N,:N][amplitude] = np.exp(2j*np.pi*opd[amplitude])
+    field = scipy.fft.fft2(buffer,overwrite_x=True)
+    psf   = scipy.fft.fftshift(field.real**2 + field.imag**2)
+    return psf/grid.Peak
+
+def diffraction_psf(optDsg,gridSize=64,padding=4,surfIndex=-1):
+    '''
+    Diffraction PSF of a solved optical design on the surface surfIndex (by
+    default the image plane). The pixel pitch is wavelength/(2*NA*padding).
+    Returns a DiffractionPSF
+    '''
+    assert optDsg.dsgSolved, 'The optical design is not solved'
+    grid  = diffraction_grid(gridSize,padding)
+    opd   = pupil_opd(optDsg,grid,surfIndex)
+    wvln  = optDsg.usrSrc.Wavelength
+    NA    = image_aperture(optDsg,surfIndex)
+    pitch = (wvln*1e-6)/(2*NA*padding)
+    return DiffractionPSF(fft_psf(grid,opd),pitch,wvln,NA)
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import PointSource
+    from JenTrace.opt_dsg import OpDesign
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (39.68  ,1/-31.47  ,1      )
+
+    designs = [OpDesign(PointSource([0,Y,0],635),syst1,aprRad=1) for Y in (0.0,2.5)]
+    for optDsg in designs:
+        optDsg.autofocus()
+
+    for optDsg in designs:
+        start = time.time()
+        psf1  = diffraction_psf(optDsg)
+        print('Elapsed time: {:f} s, Strehl: {:f}'.format(time.time()-start,psf1.Strehl))
+    psf1.print_report()
+    psf1.plot()
+    plt.show()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization of optical systems and designs
+functions:  -system_dict
+            -system_from_dict
+            -source_dict
+            -source_from_dict
+            -design_dict
+            -design_from_dict
+            -save_design
+            -load_design
+            -load_designs
+            -group_systems
+
+An OpSysData or an OpDesign is saved as a compact JSON file (.json) or as a
+binary numpy archive (.npz). The surfaces are stored as the columns of the
+SurfaceTable, the design keeps the aperture, the user source and the cached
+aiming solution (aimed essential rays), so a loaded design is traced but not
+solved again. load_designs reads a whole directory of designs, optionally
+with several threads, and group_systems groups them by number of surfaces
+for the batched functions (stack_systems, paraxial_seidel, ...).
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from JenTrace.opt_sys import OpSysData
+from JenTrace.opt_dsg import OpDesign
+from JenTrace.ray_src import RaySource, PointSource, InfinitySource
+from JenTrace.srf_tbl import SurfaceTable
+
+'''
+File format identifier and version
+'''
+FILE_FORMAT  = 'JenTrace'
+FILE_VERSION = 1
+
+def system_dict(optSys):
+    '''
+    OpSysData as a dictionary of the surface columns (d, C, interned
+    materials, material index and surface type code)
+    '''
+    SurfaceData = optSys.SurfaceData
+    if not isinstance(SurfaceData,SurfaceTable):
+        SurfaceData = SurfaceTable(SurfaceData)
+    return {'d':SurfaceData.d.tolist(),'C':SurfaceData.C.tolist(),
+            'materials':list(SurfaceData.Materials),
+            'material':SurfaceData.material.tolist(),
+            'surfType':SurfaceData.surfType.tolist()}
+
+def system_from_dict(data):
+    optSys = OpSysData()
+    optSys.SurfaceData = SurfaceTable.from_columns(data['d'],data['C'],data['materials'],
+                                                   data['material'],data['surfType'])
+    return optSys
+
+def rays_list(RayList):
+    '''
+    RayList as rows [X,Y,Z,L,M,N,wvln] of Python floats
+    '''
+    return [[*map(float,ray[0]),*map(float,ray[1]),float(ray[2])] for ray in RayList]
+
+def rays_from_list(rows):
+    return [[list(row[0:3]),list(row[3:6]),row[6]] for row in np.asarray(rows,dtype=float).tolist()]
+
+def source_dict(source):
+    '''
+    Ray source as a dictionary: class, position (PointSource) or direction
+    cosines (InfinitySource), wavelength and rays
+    '''
+    if isinstance(source,PointSource):
+        vector = source.Position
+    elif isinstance(source,InfinitySource):
+        vector = source.DirecCos
+    else:
+        vector = None
+    return {'class':source.__class__.__name__,
+            'vector':None if vector is None else [float(q) for q in vector],
+            'wavelength':float(source.RayList[0][2]) if vector is None else float(source.Wavelength),
+            'rays':rays_list(source.RayList)}
+
+def source_from_dict(data):
+    if data['class'] == 'PointSource':
+        source = PointSource(data['vector'],data['wavelength'])
+    elif data['class'] == 'InfinitySource':
+        source = InfinitySource(data['vector'],data['wavelength'])
+    else:
+        source = RaySource()
+    source.RayList = rays_from_list(data['rays'])
+    return source
+
+def design_dict(optDsg):
+    '''
+    OpDesign as a dictionary: system, user source, aperture and the aiming
+    solution (aimed rays of the user and design sources)
+    '''
+    infRays = None
+    if isinstance(optDsg.dsgInfSrc,InfinitySource):
+        infRays = rays_list(optDsg.dsgInfSrc.RayList)
+    return {'system'    :system_dict(optDsg.optSys),
+            'source'    :source_dict(optDsg.usrSrc),
+            'aprRad'    :optDsg.aprRad,
+            'aprInd'    :optDsg.aprInd,
+            'systemType':optDsg.designType,
+            'tolError'  :optDsg.tolError,
+            'solution'  :{'solved':bool(optDsg.dsgSolved),
+                          'error':[float(q) for q in optDsg.dsgError],
+                          'usrRays':rays_list(optDsg.usrSrc.RayList),
+                          'ptoRays':rays_list(optDsg.dsgPtoSrc.RayList),
+                          'infRays':infRays}}
+
+def design_from_dict(data,solve=False):
+    '''
+    OpDesign from design_dict. The cached aiming solution is restored,
+    unless solve (the ray aiming is solved again)
+    '''
+    optSys   = system_from_dict(data['system'])
+    usrSrc   = source_from_dict(data['source'])
+    solution = data['solution']
+    cached   = None
+    if not solve:
+        infRays = solution['infRays']
+        cached  = (rays_from_list(solution['usrRays']),rays_from_list(solution['ptoRays']),
+                   None if infRays is None else rays_from_list(infRays),
+                   solution['error'],solution['solved'])
+    optDsg = OpDesign(usrSrc,optSys,aprRad=data['aprRad'],aprInd=data['aprInd'],
+                      systemType=data['systemType'],solution=cached)
+    optDsg.tolError = data['tolError']
+    return optDsg
+
+def save_design(item,path):
+    '''
+    Saves an OpSysData or an OpDesign. The format is given by the extension
+    of path: '.json' (compact JSON) or '.npz' (binary, the surface columns
+    and the rays are numpy arrays)
+    '''
+    if isinstance(item,OpDesign):
+        data = {'type':'OpDesign',**design_dict(item)}
+    else:
+        data = {'type':'OpSysData','system':system_dict(item)}
+    data = {'format':FILE_FORMAT,'version':FILE_VERSION,**data}
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path,'w') as file:
+            json.dump(data,file,separators=(',',':'))
+    elif extension == '.npz':
+        # Numeric columns as arrays, the rest as a JSON header
+        arrays = {key:np.asarray(data['system'].pop(key)) for key in ('d','C','material','surfType')}
+        if data['type'] == 'OpDesign':
+            arrays['sourceRays'] = np.asarray(data['source'].pop('rays'),dtype=float).reshape(-1,7)
+            for key in ('usrRays','ptoRays','infRays'):
+                rays = data['solution'].pop(key)
+                if rays is not None:
+                    arrays[key] = np.asarray(rays,dtype=float).reshape(-1,7)
+        header = np.frombuffer(json.dumps(data,separators=(',',':')).encode(),dtype=np.uint8)
+        np.savez(path,header=header,**arrays)
+    else:
+        raise ValueError('%s, unsupported design file extension (.json, .npz)' % path)
+
+def load_design(path,solve=False):
+    '''
+    Loads an OpSysData or an OpDesign saved by save_design. The aiming
+    solution of a design is restored unless solve.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path) as file:
+            data = json.load(file)
+    elif extension == '.npz':
+        with np.load(path) as archive:
+            data = json.loads(archive['header'].tobytes().decode())
+            for key in ('d','C','material','surfType'):
+                data['system'][key] = archive[key]
+            if data['type'] == 'OpDesign':
+                data['source']['rays'] = archive['sourceRays']
+                for key in ('usrRays','ptoRays','infRays'):
+                    data['solution'][key] = archive[key] if key in archive.files else None
+    else:
+        raise ValueError('%s, unsupported design file extension (.json, .npz)' % path)
+
+    if data.get('format') != FILE_FORMAT:
+        raise ValueError('%s, not a %s design file' % (path,FILE_FORMAT))
+    if data['type'] == 'OpDesign':
+        return design_from_dict(data,solve)
+    return system_from_dict(data['system'])
+
+def load_designs(directory,solve=False,workers=1):
+    '''
+    Loads all the design files (.json, .npz) of directory.
+    workers: number of threads reading the files, useful for slow (network)
+             file systems; the parsing itself is bound to one core
+    Returns a dictionary file name -> OpSysData or OpDesign, sorted by name
+    '''
+    names = sorted(name for name in os.listdir(directory)
+                   if os.path.splitext(name)[1].lower() in ('.json','.npz'))
+    paths = [os.path.join(directory,name) for name in names]
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            items = list(executor.map(lambda path: load_design(path,solve),paths))
+    else:
+        items = [load_design(path,solve) for path in paths]
+    return dict(zip(names,items))
+
+def group_systems(items):
+    '''
+    Groups the loaded systems and designs (dictionary name -> item) by
+    number of surfaces, e.g. for stack_systems or paraxial_seidel.
+    Returns a dictionary k -> (names, list of SurfaceData)
+    '''
+    groups = {}
+    for name,item in items.items():
+        SurfaceData = item.optSys.SurfaceData if isinstance(item,OpDesign) else item.SurfaceData
+        names,systems = groups.setdefault(len(SurfaceData),([],[]))
+        names.append(name)
+        systems.append(SurfaceData)
+    return groups
+
+
+if __name__ == '__main__':
+    import time, tempfile
+    from JenTrace.abr_fnc import paraxial_seidel
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (39.68  ,1/-31.47  ,1      )
+    design1 = OpDesign(PointSource([0,2.5,0],587.6),syst1,aprRad=1)
+
+    directory = tempfile.mkdtemp()
+    save_design(design1,os.path.join(directory,'design.json'))
+    save_design(design1,os.path.join(directory,'design.npz'))
+    for q,distance in enumerate(np.linspace(38.0,41.0,20)):
+        syst2 = OpSysData()
+        syst2.SurfaceData[:] = syst1.SurfaceData[:]
+        syst2.change_surface(distance,1/-31.47,1,surfIndex=3)
+        save_design(syst2,os.path.join(directory,'system{:02d}.json'.format(q)))
+
+    start = time.time()
+    items = load_designs(directory,workers=4)
+    print('Elapsed time: {:f} s, {:d} files'.format(time.time()-start,len(items)))
+    print('Max ray difference: {:e}'.format(
+          np.abs(items['design.npz'].raySrcTrace-design1.raySrcTrace).max()))
+    items['design.json'].optSys.print_report()
+    for k,(names,systems) in group_systems(items).items():
+        print(k,len(names),paraxial_seidel(systems,587.6,[2.5]).shape)
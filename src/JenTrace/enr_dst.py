@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming energy distribution: encircled energy, ensquared energy and
+geometric PSF
+Class:      -EnergyHistogram
+functions:  -energy_distribution
+
+The ray intercepts are reduced chunk by chunk into fixed histograms, so the
+memory does not depend on the number of rays and no intercept is sorted.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+import matplotlib.pyplot as plt
+from JenTrace.ray_trc import trace_surfaces
+from JenTrace.spt_dgm import random_pupil
+
+class EnergyHistogram:
+    '''
+    Streaming reducer of ray intercepts around a fixed center.
+
+    Arguments passed by the user:
+        center   : [x,y] reference point, e.g. the chief ray
+        maxRadius: histogram half width (mm). Rays farther away are counted
+                   in Overflow
+        noBins   : bins of the radial and square (half width) histograms
+        psfBins  : bins per side of the 2-D geometric PSF
+
+    Attributes:
+        Radial  : numpy array [noBins], energy per radius bin
+        Square  : numpy array [noBins], energy per half width bin, max(|dx|,|dy|)
+        PSF     : numpy array [psfBins,psfBins], energy per pixel [y,x]
+        Total   : total energy (including Overflow and lost rays)
+        Overflow: energy outside maxRadius (radial histogram)
+        Lost    : energy of the rays lost in the system
+        NoRays  : number of accumulated rays
+    '''
+    def __init__(self,center,maxRadius,noBins=200,psfBins=128):
+        self.Center    = np.asarray(center,dtype=float)
+        self.MaxRadius = float(maxRadius)
+        self.noBins    = noBins
+        self.psfBins   = psfBins
+        self.Radial    = np.zeros(noBins)
+        self.Square    = np.zeros(noBins)
+        self.PSF       = np.zeros([psfBins,psfBins])
+        self.Total     = 0.0
+        self.Overflow  = 0.0
+        self.Lost      = 0.0
+        self.NoRays    = 0
+
+    def accumulate(self,x,y,weight=None):
+        '''
+        Adds one chunk of ray intercepts x,y [i] (numpy.nan: lost ray)
+        '''
+        if weight is None:
+            weight = np.ones(len(x))
+        self.NoRays += len(x)
+        self.Total  += weight.sum()
+        valid  = np.isfinite(x) & np.isfinite(y)
+        self.Lost += weight[~valid].sum()
+        dx     = x[valid] - self.Center[0]
+        dy     = y[valid] - self.Center[1]
+        weight = weight[valid]
+
+        # Radial and square histograms, the bin index is computed directly
+        scale  = self.noBins/self.MaxRadius
+        radial = (np.hypot(dx,dy)*scale).astype(int)
+        square = (np.maximum(np.abs(dx),np.abs(dy))*scale).astype(int)
+        inside = radial < self.noBins
+        self.Overflow += weight[~inside].sum()
+        self.Radial   += np.bincount(radial[inside],weight[inside],self.noBins)
+        inside = square < self.noBins
+        self.Square   += np.bincount(square[inside],weight[inside],self.noBins)
+
+        # 2-D histogram on [-maxRadius, maxRadius]^2
+        scale  = self.psfBins/(2*self.MaxRadius)
+        col    = np.floor((dx+self.MaxRadius)*scale).astype(int)
+        row    = np.floor((dy+self.MaxRadius)*scale).astype(int)
+        inside = (col >= 0) & (col < self.psfBins) & (row >= 0) & (row < self.psfBins)
+        self.PSF += np.bincount(row[inside]*self.psfBins+col[inside],weight[inside],
+                                self.psfBins**2).reshape(self.psfBins,self.psfBins)
+
+    def encircled_energy(self):
+        '''
+        Returns the radius [noBins] and the encircled energy fraction [noBins]
+        '''
+        radius = self.MaxRadius*np.arange(1,self.noBins+1)/self.noBins
+        return radius,np.cumsum(self.Radial)/self.Total
+
+    def ensquared_energy(self):
+        '''
+        Returns the square half width [noBins] and the ensquared energy fraction [noBins]
+        '''
+        halfWidth = self.MaxRadius*np.arange(1,self.noBins+1)/self.noBins
+        return halfWidth,np.cumsum(self.Square)/self.Total
+
+    def radius_for(self,fraction,square=False):
+        '''
+        Radius (or square half width) that contains the energy fraction, linear
+        interpolation of the histogram. numpy.nan if it is beyond MaxRadius.
+        '''
+        radius,energy = self.ensquared_energy() if square else self.encircled_energy()
+        radius = np.concatenate([[0.0],radius])
+        energy = np.concatenate([[0.0],energy])
+        if fraction > energy[-1]:
+            return np.nan
+        return float(np.interp(fraction,energy,radius))
+
+    def psf(self):
+        '''
+        Normalized geometric PSF (sum over all the energy equal to 1) and its
+        extent [xmin,xmax,ymin,ymax] in mm
+        '''
+        extent = [self.Center[0]-self.MaxRadius,self.Center[0]+self.MaxRadius,
+                  self.Center[1]-self.MaxRadius,self.Center[1]+self.MaxRadius]
+        return self.PSF/self.Total,extent
+
+    def plot(self):
+        fig, (ax1,ax2) = plt.subplots(1,2,figsize=(10,4))
+        for (radius,energy),label in ((self.encircled_energy(),'encircled'),
+                                      (self.ensquared_energy(),'ensquared')):
+            ax1.plot(1000*radius,energy,label=label)
+        ax1.grid('on')
+        ax1.legend()
+        ax1.set_xlabel('radius/half width[um]')
+        ax1.set_ylabel('energy fraction')
+        psf,extent = self.psf()
+        ax2.imshow(psf,extent=extent,origin='lower',cmap='gray')
+        ax2.set_xlabel('x[mm]')
+        ax2.set_ylabel('y[mm]')
+        return fig, (ax1,ax2)
+
+    def print_report(self):
+        print("\nENERGY DISTRIBUTION")
+        print("Rays: {:d}, overflow: {:f}, lost: {:f}".format(
+              self.NoRays,self.Overflow/self.Total,self.Lost/self.Total))
+        headers = ['Fraction','Radius','HalfWidth']
+        print("{: >12} {: >12} {: >12} ".format(*headers))
+        for fraction in (0.5,0.8,0.9,0.95):
+            print("{:12f} {:12f} {:12f} ".format(fraction,self.radius_for(fraction),
+                                                 self.radius_for(fraction,square=True)))
+
+def energy_distribution(optDsg,noRays=10**6,chunkSize=10**5,noBins=200,psfBins=128,
+                        maxRadius=None,center=None,surfIndex=-1,seed=102629122021):
+    '''
+    Encircled/ensquared energy and geometric PSF of an optical design in one
+    streaming pass: every chunk of rays is sampled in the aperture stop
+    (OpDesign.pupil_source), traced and reduced into an EnergyHistogram.
+
+    optDsg:    solved optical design
+    noRays:    total number of rays (10^7 rays are possible, the memory only
+               depends on chunkSize)
+    maxRadius: histogram half width, by default 1.25 times the largest radius
+               of the first chunk
+    center:    reference point, by default the chief ray on the surface
+    Returns an EnergyHistogram
+    '''
+    assert optDsg.dsgSolved, 'The optical design is not solved'
+    SurfaceData = optDsg.optSys.SurfaceData
+    wvln        = optDsg.usrSrc.Wavelength
+    rng         = np.random.default_rng(seed)
+    if center is None:
+        center  = optDsg.raySrcTrace[0,8:10,surfIndex]
+
+    energy = None
+    for start in range(0,noRays,chunkSize):
+        px,py   = random_pupil(min(chunkSize,noRays-start),rng)
+        XYZ,LMN = optDsg.pupil_source(px,py)
+        surfTrace = trace_surfaces(XYZ,LMN,wvln,SurfaceData,[surfIndex],chunkSize)
+        x,y     = surfTrace[:,2,0],surfTrace[:,3,0]
+        if energy is None:
+            if maxRadius is None:
+                maxRadius = 1.25*np.nanmax(np.hypot(x-center[0],y-center[1]))
+            energy = EnergyHistogram(center,maxRadius,noBins,psfBins)
+        energy.accumulate(x,y)
+
+    return energy
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import PointSource
+    from JenTrace.opt_dsg import OpDesign
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (39.68  ,1/-31.47  ,1      )
+
+    design1 = OpDesign(PointSource([0,2.5,0],635),syst1,aprRad=2)
+
+    start   = time.time()
+    energy1 = energy_distribution(design1,noRays=10**7)
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    energy1.print_report()
+    energy1.plot()
+    plt.show()
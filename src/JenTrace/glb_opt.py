@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-start global search for optical designs
+functions:  -latin_hypercube
+            -apply_variables
+            -first_order_check
+            -spot_rms_merit
+            -local_search
+            -multi_start_search
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import copy
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import minimize
+from JenTrace.opt_dsg import OpDesign
+from JenTrace.ray_src import PointSource
+from JenTrace.spt_dgm import spot_diagram
+from JenTrace.abr_fnc import paraxial_trace, paraxial_focal_length
+
+def latin_hypercube(noSamples,bounds,seed=None):
+    '''
+    Latin hypercube sampling: every variable range is divided in noSamples
+    strata and each stratum is sampled exactly once.
+
+    noSamples: int, number of samples
+    bounds:    list of tuples, (lower, upper) per variable
+    seed:      int, seed of the random generator
+
+    Returns a numpy array [noSamples, len(bounds)]
+    '''
+    rng    = np.random.default_rng(seed)
+    bounds = np.asarray(bounds,dtype=float)
+    noVar  = len(bounds)
+    # One random point per stratum, strata shuffled independently per variable
+    unit   = (np.arange(noSamples)[:,None] + rng.random((noSamples,noVar)))/noSamples
+    for q in range(noVar):
+        unit[:,q] = rng.permutation(unit[:,q])
+
+    return bounds[:,0] + unit*(bounds[:,1]-bounds[:,0])
+
+def apply_variables(optSys,variables,x):
+    '''
+    Returns a copy of optSys with the variables replaced by the values in x.
+
+    optSys:    OpSysData template
+    variables: list of tuples, (param, surfIndex, lower, upper), param is 'd' or 'C'
+    x:         list of values, one per variable
+    '''
+    newSys = copy.deepcopy(optSys)
+    for (param,surfIndex,lower,upper),value in zip(variables,x):
+        d,C,n,surfType = newSys.SurfaceData[surfIndex]
+        if param == 'd':
+            d = float(value)
+        elif param == 'C':
+            C = float(value)
+        else:
+            raise ValueError('%s, variable parameter must be either "d" or "C"' % param)
+        newSys.change_surface(d,C,n,surfType,surfIndex=surfIndex)
+
+    return newSys
+
+def first_order_check(optSys,usrSrc,aprRad,minThick=0.0,eflRange=None):
+    '''
+    Cheap paraxial screening of a starting system. Returns False when:
+        -a distance between lens surfaces is smaller than minThick
+        -the paraxial marginal ray misses a spherical surface (|y*C| >= 1)
+        -the effective focal length is outside eflRange (lower, upper)
+
+    optSys: OpSysData
+    usrSrc: PointSource or InfinitySource, defines the wavelength and the
+            paraxial marginal ray (object space slope or height aprRad)
+    aprRad: paraxial marginal ray height at the first surface (mm)
+    '''
+    SurfaceData = optSys.SurfaceData
+    wvln        = usrSrc.Wavelength
+    if any(surf[0] < minThick for surf in SurfaceData[1:-2]):
+        return False
+
+    if isinstance(usrSrc,PointSource):
+        y,u,n = paraxial_trace(SurfaceData,wvln,0.0,aprRad/SurfaceData[0][0])
+    else:
+        y,u,n = paraxial_trace(SurfaceData,wvln,aprRad,0.0)
+    C     = np.array([surf[1] for surf in SurfaceData])
+    if not np.all(np.isfinite(y)) or np.any(np.abs(y*C) >= 1):
+        return False
+
+    if eflRange is not None:
+        efl,bfl = paraxial_focal_length(SurfaceData,wvln)
+        if not (eflRange[0] <= efl <= eflRange[1]):
+            return False
+
+    return True
+
+def spot_rms_merit(optSys,usrSrc,aprRad=1.0,aprInd=1,noRays=200):
+    '''
+    Merit function: RMS spot radius in the image plane of an optical design
+    built with optSys and a copy of usrSrc. Designs that cannot be solved
+    return numpy.inf.
+    '''
+    try:
+        optDsg  = OpDesign(copy.deepcopy(usrSrc),optSys,aprRad=aprRad,aprInd=aprInd)
+        spot    = spot_diagram(optDsg,noRays=noRays)
+    except (Warning,ValueError,AssertionError,ZeroDivisionError):
+        return np.inf
+
+    xCoor = spot.Position[:,0]
+    yCoor = spot.Position[:,1]
+    if len(xCoor) == 0 or not np.all(np.isfinite(xCoor+yCoor)):
+        return np.inf
+
+    return np.sqrt(np.mean((xCoor-xCoor.mean())**2 + (yCoor-yCoor.mean())**2))
+
+def local_search(task):
+    '''
+    Local Nelder-Mead optimization of one starting point. The argument is a
+    tuple so the function can be mapped over a process pool:
+
+    task: (optSys, variables, x0, meritFnc, meritArgs, maxIter)
+
+    Returns a dictionary with the keys 'merit', 'x', 'x0', 'optSys', 'nfev'.
+    '''
+    optSys,variables,x0,meritFnc,meritArgs,maxIter = task
+    bounds = np.array([[var[2],var[3]] for var in variables],dtype=float)
+
+    def evaluate(x):
+        # Out of bounds values are penalized
+        if np.any(x < bounds[:,0]) or np.any(x > bounds[:,1]):
+            return np.inf
+        return meritFnc(apply_variables(optSys,variables,x),*meritArgs)
+
+    res = minimize(evaluate, x0, method='Nelder-Mead', options={'maxiter':maxIter})
+
+    return {'merit' : float(res.fun),
+            'x'     : res.x,
+            'x0'    : np.asarray(x0),
+            'optSys': apply_variables(optSys,variables,res.x),
+            'nfev'  : res.nfev}
+
+def multi_start_search(optSys,variables,meritFnc=spot_rms_merit,meritArgs=(),
+                       noStarts=32,noWorkers=None,maxIter=200,
+                       checkFnc=first_order_check,checkArgs=None,seed=None):
+    '''
+    Global design search: Latin hypercube starting points of the variables are
+    screened with checkFnc and the surviving starts are optimized locally in a
+    process pool.
+
+    optSys:    OpSysData template
+    variables: list of tuples, (param, surfIndex, lower, upper), param is 'd' or 'C'
+    meritFnc:  merit function, meritFnc(optSys,*meritArgs) -> float. It must be
+               defined at module level to be sent to the worker processes
+    meritArgs: arguments of meritFnc, e.g. (usrSrc, aprRad, aprInd, noRays) for
+               spot_rms_merit. The source usrSrc (meritArgs[0]) is required
+               by the default checkArgs
+    noStarts:  number of starting points
+    noWorkers: number of worker processes, 1 runs in the current process
+    maxIter:   maximum number of Nelder-Mead iterations per start
+    checkFnc:  first order check, checkFnc(optSys,*checkArgs) -> bool. None
+               disables the screening
+    checkArgs: arguments of checkFnc. By default, the source and aperture
+               radius of spot_rms_merit arguments are used
+    seed:      seed of the Latin hypercube sampling
+
+    Returns the list of local solutions ranked by merit (best first).
+    '''
+    assert len(variables) > 0, 'At least one variable is required'
+    bounds = [(var[2],var[3]) for var in variables]
+    starts = latin_hypercube(noStarts,bounds,seed=seed)
+
+    # Prune bad starts before any real ray is traced
+    if checkFnc is not None:
+        if checkArgs is None:
+            assert len(meritArgs) > 0, 'The source (meritArgs[0]) is required to screen the starts, pass meritArgs or checkArgs'
+            aprRad    = meritArgs[1] if len(meritArgs) > 1 else 1.0
+            checkArgs = (meritArgs[0],aprRad)
+        starts = [x0 for x0 in starts
+                  if checkFnc(apply_variables(optSys,variables,x0),*checkArgs)]
+
+    tasks = [(optSys,variables,x0,meritFnc,meritArgs,maxIter) for x0 in starts]
+    if len(tasks) == 0:
+        return []
+
+    if noWorkers == 1:
+        solutions = [local_search(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=noWorkers) as executor:
+            solutions = list(executor.map(local_search,tasks))
+
+    return sorted(solutions,key=lambda sol: sol['merit'])
+
+
+if __name__=='__main__':
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import InfinitySource
+
+    # Template: singlet focusing a collimated beam
+    syst1 = OpSysData()
+    syst1.change_surface(10  ,0       ,1      ,surfIndex=0)
+    syst1.add_surface   (4   ,1/50.0  ,'N-BK7')
+    syst1.add_surface   (95  ,-1/50.0 ,1      )
+
+    pto1  = InfinitySource([0,0,1],635)
+
+    variables = [('C',1, 0.0 ,0.05),
+                 ('C',2,-0.05,0.01),
+                 ('d',2, 80.0,110.0)]
+
+    solutions = multi_start_search(syst1,variables,meritArgs=(pto1,2.0,1,100),
+                                   noStarts=4,maxIter=10,seed=1)
+    for sol in solutions:
+        print(sol['merit'],sol['x'])
+    solutions[0]['optSys'].print_report()
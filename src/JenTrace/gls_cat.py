@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+External glass catalogs (AGF format) with a memory-mapped binary cache
+Class:      -GlassCatalog
+functions:  -formula_index
+            -read_agf
+            -compile_catalog
+
+An AGF text catalog is parsed once into a binary cache file: a numpy
+structured array sorted by glass name (numpy .npy format). The cache is
+memory-mapped on the next use and the glasses are resolved lazily by binary
+search over the names, so opening a catalog does not depend on its size.
+The cache is rebuilt when the AGF file is newer than the cache.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import os
+import numpy as np
+
+'''
+Record of the binary cache, one row per glass (sorted by name)
+    name   : glass name
+    formula: AGF dispersion formula code
+    coef   : dispersion coefficients (CD record)
+    ld     : valid wavelength range in µm (LD record)
+    nd,vd  : catalog nd and Abbe number (NM record)
+    status : availability (NM record): 0 standard, 1 preferred, 2 obsolete,
+             3 special, 4 melt, -1 unknown
+'''
+GLASS_RECORD = np.dtype([('name','S40'),('formula','i4'),('coef','f8',(10,)),
+                         ('ld','f8',(2,)),('nd','f8'),('vd','f8'),('status','i4')])
+
+'''
+AGF dispersion formulas, wavelength in µm
+'''
+FORMULA_NAMES = {1:'Schott',2:'Sellmeier 1',3:'Herzberger',4:'Sellmeier 2',
+                 5:'Conrady',6:'Sellmeier 3',7:'Handbook of Optics 1',
+                 8:'Handbook of Optics 2',9:'Sellmeier 4',10:'Extended',
+                 11:'Sellmeier 5',12:'Extended 2',13:'Extended 3'}
+
+def formula_index(formula,coef,wvln):
+    '''
+    Refraction index of an AGF dispersion formula.
+
+    formula: AGF formula code (FORMULA_NAMES)
+    coef   : dispersion coefficients [10]
+    wvln   : wavelengths in nm, scalar or numpy array
+    Returns numpy array with the shape of wvln
+    '''
+    c  = coef
+    w  = np.asarray(wvln,dtype=float)/1000.0
+    w2 = w**2
+    if formula == 1:
+        n2 = c[0] + c[1]*w2 + c[2]/w2 + c[3]/w2**2 + c[4]/w2**3 + c[5]/w2**4
+    elif formula == 2:
+        n2 = 1 + sum(c[2*q]*w2/(w2-c[2*q+1]) for q in range(3))
+    elif formula == 3:
+        L  = 1/(w2-0.028)
+        return c[0] + c[1]*L + c[2]*L**2 + c[3]*w2 + c[4]*w2**2 + c[5]*w2**3
+    elif formula == 4:
+        n2 = 1 + c[0] + c[1]*w2/(w2-c[2]**2) + c[3]*w2/(w2-c[4]**2)
+    elif formula == 5:
+        return c[0] + c[1]/w + c[2]/w**3.5
+    elif formula == 6:
+        n2 = 1 + sum(c[2*q]*w2/(w2-c[2*q+1]) for q in range(4))
+    elif formula == 7:
+        n2 = c[0] + c[1]/(w2-c[2]) - c[3]*w2
+    elif formula == 8:
+        n2 = c[0] + c[1]*w2/(w2-c[2]) - c[3]*w2
+    elif formula == 9:
+        n2 = c[0] + c[1]*w2/(w2-c[2]) + c[3]*w2/(w2-c[4])
+    elif formula == 10:
+        n2 = c[0] + c[1]*w2 + sum(c[q+1]/w2**q for q in range(1,7))
+    elif formula == 11:
+        n2 = 1 + sum(c[2*q]*w2/(w2-c[2*q+1]) for q in range(5))
+    elif formula == 12:
+        n2 = (c[0] + c[1]*w2 + c[2]/w2 + c[3]/w2**2 + c[4]/w2**3 + c[5]/w2**4
+              + c[6]*w2**2 + c[7]*w2**3)
+    elif formula == 13:
+        n2 = c[0] + c[1]*w2 + c[2]*w2**2 + sum(c[q+2]/w2**q for q in range(1,7))
+    else:
+        raise ValueError('%s, unsupported dispersion formula' % formula)
+    return np.sqrt(n2)
+
+def read_agf(path):
+    '''
+    Parses an AGF glass catalog (UTF-16 or 8-bit text). Only the NM
+    (name, formula, nd, vd, status), CD (coefficients) and LD (wavelength range)
+    records are read.
+    Returns a numpy structured array GLASS_RECORD sorted by name
+    '''
+    with open(path,'rb') as file:
+        raw = file.read()
+    if raw[:2] in (b'\xff\xfe',b'\xfe\xff'):
+        text = raw.decode('utf-16')
+    else:
+        text = raw.decode('latin-1')
+
+    glasses = []
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'NM' and len(fields) >= 3:
+            glass = {'name':fields[1],'formula':int(float(fields[2])),'coef':[],
+                     'ld':(np.nan,np.nan),
+                     'nd':float(fields[4]) if len(fields) > 4 else np.nan,
+                     'vd':float(fields[5]) if len(fields) > 5 else np.nan,
+                     'status':int(float(fields[7])) if len(fields) > 7 else -1}
+            glasses.append(glass)
+        elif fields[0] == 'CD' and glasses:
+            glasses[-1]['coef'] = [float(value) for value in fields[1:11]]
+        elif fields[0] == 'LD' and glasses and len(fields) >= 3:
+            glasses[-1]['ld'] = (float(fields[1]),float(fields[2]))
+
+    records = np.zeros(len(glasses),dtype=GLASS_RECORD)
+    for q,glass in enumerate(glasses):
+        coef = glass['coef'] + [0.0]*(10-len(glass['coef']))
+        records[q] = (glass['name'].encode(),glass['formula'],coef,glass['ld'],
+                      glass['nd'],glass['vd'],glass['status'])
+    return np.sort(records,order='name')
+
+def compile_catalog(path,cachePath=None):
+    '''
+    Compiles the AGF catalog path into its binary cache file (by default
+    path + '.npy'). Returns the cache path
+    '''
+    if cachePath is None:
+        cachePath = path + '.npy'
+    np.save(cachePath,read_agf(path))
+    return cachePath
+
+class GlassCatalog:
+    '''
+    External glass catalog resolved lazily from a memory-mapped cache.
+
+    Arguments passed by the user:
+        path     : AGF file
+        cachePath: binary cache file, by default path + '.npy'. It is
+                   compiled if it does not exist or the AGF file is newer
+
+    Attributes:
+        Path     : AGF file
+        CachePath: binary cache file
+        Vendor   : catalog name, the AGF file name without extension
+        Records  : numpy memmap GLASS_RECORD [G], sorted by name
+    '''
+    def __init__(self,path,cachePath=None):
+        self.Path      = path
+        self.CachePath = path + '.npy' if cachePath is None else cachePath
+        self.Vendor    = os.path.splitext(os.path.basename(path))[0].upper()
+        if (not os.path.exists(self.CachePath)
+            or os.path.getmtime(self.CachePath) < os.path.getmtime(path)):
+            compile_catalog(path,self.CachePath)
+        self.Records = np.load(self.CachePath,mmap_mode='r')
+        if self.Records.dtype != GLASS_RECORD:
+            # Cache written with another record layout
+            compile_catalog(path,self.CachePath)
+            self.Records = np.load(self.CachePath,mmap_mode='r')
+
+    def __len__(self):
+        return len(self.Records)
+
+    def __contains__(self,name):
+        return self.row(name) is not None
+
+    def row(self,name):
+        '''
+        Row of the glass name (binary search), None if it is not in the catalog
+        '''
+        key  = name.encode()
+        names = self.Records['name']
+        row  = int(np.searchsorted(names,key))
+        if row < len(names) and names[row] == key:
+            return row
+        return None
+
+    def names(self):
+        return [name.decode() for name in self.Records['name']]
+
+    def glass(self,name):
+        '''
+        Record of the glass name: formula, coefficients [10], ld, nd and vd
+        '''
+        row = self.row(name)
+        if row is None:
+            raise ValueError('%s, non existent glass material' % name)
+        return self.Records[row]
+
+    def index(self,name,wvln):
+        '''
+        Refraction index of the glass name at the wavelengths wvln (nm)
+        '''
+        record = self.glass(name)
+        return formula_index(int(record['formula']),np.array(record['coef']),wvln)
+
+
+if __name__ == '__main__':
+    import sys, time, tempfile
+    from JenTrace.catalog import load_catalog, refraction_index
+    
+    # Sample AGF catalog (Schott, Sellmeier 1 and Conrady formulas), or the 
+    # AGF catalog passed as argument
+    SAMPLE_AGF = """CC Sample catalog
+NM SMP-BK7 2 517642 1.5168 64.17 0 1
+CD 1.03961212 0.00600069867 0.231792344 0.0200179144 1.01046945 103.560653 0 0 0 0
+LD 0.3 2.5
+NM SMP-SF5 2 673323 1.67271 32.25 0 0
+CD 1.52481889 0.011254756 0.187085527 0.0588995392 1.42729015 129.141675 0 0 0 0
+LD 0.37 2.5
+NM SMP-BK7S 1 517642 1.5168 64.17 0 2
+CD 2.2718929 -0.010108077 0.010592509 0.00020816965 -7.6472538e-06 4.9240991e-07 0 0 0 0
+LD 0.365 1.014
+NM SMP-BK7C 5 517642 1.5168 64.17 0 3
+CD 1.49654247 0.0108266241 0.000289435897 0 0 0 0 0 0 0
+LD 0.4 1.0
+"""
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(tempfile.mkdtemp(),'sample.agf')
+        with open(path,'w') as file:
+            file.write(SAMPLE_AGF)
+    
+    start = time.time()
+    catalog1 = load_catalog(path)
+    print('Elapsed time: {:f} s, {:d} glasses'.format(time.time()-start,len(catalog1)))
+    for name in catalog1.names()[:10]:
+        print(name,catalog1.index(name,[486.1,587.6,656.3]))
+    
+    # Cached catalog (memory-mapped) and glass names resolved by refraction_index
+    catalog2 = GlassCatalog(path)
+    print(catalog2.CachePath,catalog2.Vendor,len(catalog2))
+    if len(sys.argv) == 1:
+        reference = {'SMP-BK7':'N-BK7','SMP-BK7C':'N-BK7','SMP-BK7S':'N-BK7','SMP-SF5':'N-SF5'}
+        for name in catalog2.names():
+            record = catalog2.glass(name)
+            nd     = refraction_index(name,587.5618)
+            print(name,FORMULA_NAMES[int(record['formula'])],record['ld'],record['status'],nd)
+            assert abs(nd - refraction_index(reference[name],587.5618)) < 1e-3, 'Sample glass index'
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial index of the glass map (nd, Vd, PgF)
+Class:      -GlassMap
+functions:  -glass_properties
+            -catalog_points
+            -glass_map
+            -nearest_glass
+
+The refractive index nd, the Abbe number Vd and the partial dispersion PgF
+of every glass (OPT_GLASS and the loaded catalogs) are computed from the
+dispersion formulas in one array evaluation and indexed with a KD-tree
+(scipy.spatial.cKDTree). k-nearest and radius queries accept batches of
+points; the trees of every filter (vendor, status) are built once and cached.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+from scipy.spatial import cKDTree
+from JenTrace.catalog import OPT_GLASS_VENDORS, GLASS_NAMES, GLASS_INDEX, GLASS_CATALOGS, dispersion
+from JenTrace.gls_cat import formula_index
+
+'''
+Fraunhofer lines of the glass map in nm: g, F, d, C
+'''
+MAP_WAVELENGTHS = np.array([435.8343,486.1327,587.5618,656.2725])
+
+'''
+Cached glass maps, key: (glass names of OPT_GLASS, cache files of the catalogs)
+'''
+MAP_CACHE = {}
+
+def glass_properties(index):
+    '''
+    index: numpy array [...,4], refraction indices at MAP_WAVELENGTHS
+    Returns nd, Vd and PgF, numpy array [...,3]
+    '''
+    ng,nF,nd,nC = np.moveaxis(np.asarray(index),-1,0)
+    return np.stack([nd,(nd-1)/(nF-nC),(ng-nF)/(nF-nC)],axis=-1)
+
+def catalog_points(glassCatalog):
+    '''
+    nd, Vd and PgF of all the glasses of a GlassCatalog, numpy array [G,3].
+    The glasses are evaluated in one array operation per dispersion formula
+    '''
+    records = glassCatalog.Records
+    index   = np.empty([len(records),4])
+    formula = np.asarray(records['formula'])
+    coef    = np.asarray(records['coef'])
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for code in np.unique(formula):
+            rows = formula == code
+            index[rows] = formula_index(int(code),coef[rows].T,MAP_WAVELENGTHS[:,None]).T
+    return glass_properties(index)
+
+class GlassMap:
+    '''
+    KD-tree index of the glass map.
+
+    Arguments passed by the user:
+        names : list of the glass names [G]
+        vendor: list of the vendors [G]
+        status: list of the availability codes [G] (AGF: 0 standard,
+                1 preferred, 2 obsolete, 3 special, 4 melt, -1 unknown). The
+                built-in OPT_GLASS glasses are standard (0)
+        points: numpy array [G,3], nd, Vd and PgF
+        scale : weights of nd, Vd and PgF in the distance
+
+    Attributes:
+        Names,Vendor,Status,Points,Scale
+        Trees : cached trees, key: (vendors, status, dimensions)
+    '''
+    def __init__(self,names,vendor,status,points,scale=(1.0,0.01,1.0)):
+        self.Names  = np.array(names,dtype=object)
+        self.Vendor = np.array(vendor,dtype=object)
+        self.Status = np.array(status,dtype=int)
+        self.Points = np.asarray(points,dtype=float)
+        self.Scale  = np.asarray(scale,dtype=float)
+        self.Trees  = {}
+
+    def __len__(self):
+        return len(self.Names)
+
+    def tree(self,vendor=None,status=None,dims=2):
+        '''
+        Rows and KD-tree of the glasses of the vendors and status (None: all)
+        over the first dims coordinates (2: nd,Vd; 3: nd,Vd,PgF)
+        '''
+        vendor = None if vendor is None else tuple(str(v) for v in np.atleast_1d(vendor))
+        status = None if status is None else tuple(int(s) for s in np.atleast_1d(status))
+        key    = (vendor,status,dims)
+        if key not in self.Trees:
+            valid = np.all(np.isfinite(self.Points[:,:dims]),axis=1)
+            if vendor is not None:
+                valid &= np.isin(self.Vendor,vendor)
+            if status is not None:
+                valid &= np.isin(self.Status,status)
+            rows = np.flatnonzero(valid)
+            assert len(rows) > 0, 'No glass with the vendor and status filters'
+            self.Trees[key] = (rows,cKDTree(self.Points[rows,:dims]*self.Scale[:dims]))
+        return self.Trees[key]
+
+    def nearest(self,points,k=1,vendor=None,status=None):
+        '''
+        k nearest glasses of the points.
+        points: numpy array [...,2] (nd,Vd) or [...,3] (nd,Vd,PgF)
+        Returns the glass names and the scaled distances, numpy arrays [...]
+        (k=1) or [...,k]
+        '''
+        points = np.asarray(points,dtype=float)
+        dims   = points.shape[-1]
+        rows,tree = self.tree(vendor,status,dims)
+        distance,near = tree.query(points*self.Scale[:dims],k=min(k,len(rows)))
+        return self.Names[rows[near]],distance
+
+    def within(self,points,radius,vendor=None,status=None):
+        '''
+        Glasses within the scaled distance radius of the points.
+        points: numpy array [2]/[3] or [P,2]/[P,3]
+        Returns a list of glass names, or a list of lists for [P,...] points
+        '''
+        points = np.asarray(points,dtype=float)
+        dims   = points.shape[-1]
+        rows,tree = self.tree(vendor,status,dims)
+        near = tree.query_ball_point(points*self.Scale[:dims],radius)
+        if points.ndim == 1:
+            return list(self.Names[rows[near]])
+        return [list(self.Names[rows[q]]) for q in near]
+
+    def properties(self,name):
+        '''
+        nd, Vd and PgF of the glass name (first match)
+        '''
+        return self.Points[list(self.Names).index(name)]
+
+    def print_report(self):
+        headers = ['Vendor','Glasses','nd min','nd max','Vd min','Vd max']
+        print("\nGLASS MAP")
+        print("{: >12} {: >8} {: >10} {: >10} {: >10} {: >10} ".format(*headers))
+        for vendor in dict.fromkeys(self.Vendor):
+            points = self.Points[self.Vendor == vendor]
+            print("{: >12} {: >8d} {:10f} {:10f} {:10f} {:10f} ".format(
+                  vendor,len(points),np.nanmin(points[:,0]),np.nanmax(points[:,0]),
+                  np.nanmin(points[:,1]),np.nanmax(points[:,1])))
+
+def glass_map(catalogs=True,scale=(1.0,0.01,1.0)):
+    '''
+    Cached GlassMap of OPT_GLASS and, if catalogs, of the loaded catalogs
+    (catalog.load_catalog). A new map is built when glasses or catalogs
+    are added.
+    '''
+    cachePaths = tuple(c.CachePath for c in GLASS_CATALOGS) if catalogs else ()
+    key = (tuple(GLASS_NAMES),cachePaths,tuple(scale))
+    if key in MAP_CACHE:
+        return MAP_CACHE[key]
+
+    # OPT_GLASS, vendor by section
+    starts = [GLASS_INDEX[first] for _,first in OPT_GLASS_VENDORS]
+    vendor = [OPT_GLASS_VENDORS[np.searchsorted(starts,row,side='right')-1][0]
+              for row in range(len(GLASS_NAMES))]
+    names  = list(GLASS_NAMES)
+    # OPT_GLASS has no availability code, its glasses are taken as standard
+    status = [0]*len(names)
+    points = [glass_properties(dispersion(None,MAP_WAVELENGTHS))]
+    if catalogs:
+        for glassCatalog in GLASS_CATALOGS:
+            names  += glassCatalog.names()
+            vendor += [glassCatalog.Vendor]*len(glassCatalog)
+            status += list(glassCatalog.Records['status'])
+            points.append(catalog_points(glassCatalog))
+
+    MAP_CACHE[key] = GlassMap(names,vendor,status,np.vstack(points),scale)
+    return MAP_CACHE[key]
+
+def nearest_glass(nd,vd,pgf=None,k=1,vendor=None,status=None):
+    '''
+    Names of the k nearest real glasses of the (nd, Vd[, PgF]) points, e.g.
+    to replace a continuous glass variable after an optimization.
+    nd,vd,pgf: floats or numpy arrays (batch of points)
+    vendor   : vendor names, None: all the vendors
+    status   : availability codes (0 standard, 1 preferred, 2 obsolete, 
+               3 special, 4 melt, -1 unknown), None: all the glasses. The 
+               built-in OPT_GLASS glasses are standard (0) and are kept by 
+               e.g. status=[0,1]; catalog glasses without a status code (-1) 
+               are only kept when -1 is in status
+    '''
+    points = np.stack(np.broadcast_arrays(nd,vd) if pgf is None
+                      else np.broadcast_arrays(nd,vd,pgf),axis=-1)
+    return glass_map().nearest(points,k,vendor,status)[0]
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.catalog import refraction_index
+
+    start = time.time()
+    map1  = glass_map()
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    map1.print_report()
+    print('N-BK7 nd, Vd, PgF:',map1.properties('N-BK7'))
+
+    # Snap continuous glass variables to the catalog
+    print(nearest_glass(1.62,36.0),nearest_glass(1.62,36.0,k=3,vendor='OHARA'))
+    print(nearest_glass(1.62,36.0,status=[0,1]))
+    names,distance = map1.nearest([[1.5168,64.17],[1.7,30.0],[1.8,45.0]],k=2)
+    print(names,distance)
+    print(map1.within([1.5168,64.17],0.01))
+
+    candidates = np.column_stack([np.random.uniform(1.45,1.9,100000),
+                                  np.random.uniform(20,80,100000)])
+    start = time.time()
+    names,distance = map1.nearest(candidates)
+    print('Elapsed time: {:f} s, {:d} points'.format(time.time()-start,len(candidates)))
+    print(names[0],refraction_index(names[0],587.5618),candidates[0])
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-configuration (zoom) designs
+Class MultiConfig
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import copy
+from JenTrace.opt_dsg import OpDesign
+from JenTrace.ray_src import InfinitySource
+from JenTrace.ray_trc import trace_systems, stack_systems
+
+class MultiConfig:
+    '''
+    A multi-configuration design is a base optical system with a list of
+    configurations. Every configuration overrides a few surface values of the
+    base system, e.g. the spacings of a zoom or focus-adjust lens.
+
+    Arguments passed by the user:
+        usrSrc: point/infinity source, shared by all the configurations
+        optSys: base optical system (OpSysData)
+        aprRad: aperture stop radius
+        aprInd: aperture stop index
+
+    Attributes:
+        Overrides: list (configurations) of lists of tuples (param,surfIndex,value)
+                   param: 'd' distance, 'C' curvature or 'n' refraction index/material
+        Designs  : list of OpDesign, one per configuration, created by solve
+    '''
+    cfgParams = {'d':0, 'C':1, 'n':2}
+
+    def __init__(self,usrSrc,optSys,aprRad=1.0,aprInd=1,systemType='default'):
+        self.usrSrc     = usrSrc
+        self.optSys     = optSys
+        self.aprRad     = aprRad
+        self.aprInd     = aprInd
+        self.designType = systemType
+        self.Overrides  = []
+        self.Designs    = []
+
+    def add_configuration(self,overrides=[]):
+        self.check_overrides(overrides)
+        self.Overrides.append(list(overrides))
+        self.Designs = []
+
+    def change_configuration(self,overrides,cfgIndex):
+        self.check_overrides(overrides)
+        self.Overrides[cfgIndex] = list(overrides)
+        self.Designs = []
+
+    def delete_configuration(self,cfgIndex):
+        del self.Overrides[cfgIndex]
+        self.Designs = []
+
+    def check_overrides(self,overrides):
+        surf_len = len(self.optSys.SurfaceData)
+        for (param,surfIndex,value) in overrides:
+            assert param in self.cfgParams, 'Configuration parameter must be "d", "C" or "n"'
+            assert surfIndex >= 0 and surfIndex < surf_len, 'Invalid surface index in configuration'
+
+    def configuration_system(self,cfgIndex):
+        '''
+        Returns a copy of the base system with the configuration overrides
+        '''
+        cfgSys = copy.deepcopy(self.optSys)
+        for (param,surfIndex,value) in self.Overrides[cfgIndex]:
+            surface = list(cfgSys.SurfaceData[surfIndex])
+            surface[self.cfgParams[param]] = value
+            cfgSys.change_surface(*surface,surfIndex=surfIndex)
+        return cfgSys
+
+    def shared_surfaces(self):
+        '''
+        Surface indices which are not overridden by any configuration
+        '''
+        changed = set(surfIndex for overrides in self.Overrides
+                                for (param,surfIndex,value) in overrides)
+        return [q for q in range(len(self.optSys.SurfaceData)) if q not in changed]
+
+    def first_override(self):
+        '''
+        Index of the first surface overridden by a configuration (number of
+        surfaces if there is none)
+        '''
+        return min([surfIndex for overrides in self.Overrides
+                              for (param,surfIndex,value) in overrides],
+                   default=len(self.optSys.SurfaceData))
+
+    def shared_aiming(self):
+        '''
+        True if the ray aiming is the same in all the configurations: the
+        aimed rays only depend on the surfaces up to the aperture stop
+        '''
+        return self.first_override() > self.aprInd
+
+    def solve(self):
+        '''
+        Solves one OpDesign per configuration. The ray aiming of every
+        configuration starts from the solution of the previous one. If the
+        aiming is shared (shared_aiming), it is solved once and the solution
+        of the first configuration is restored in the others.
+        '''
+        assert len(self.Overrides) > 0, 'No configuration defined'
+        self.Designs = []
+        warmDsg  = None
+        solution = None
+        for cfgIndex in range(len(self.Overrides)):
+            optDsg = OpDesign(copy.deepcopy(self.usrSrc),
+                              self.configuration_system(cfgIndex),
+                              aprRad=self.aprRad,aprInd=self.aprInd,
+                              systemType=self.designType,warmDsg=warmDsg,
+                              solution=solution)
+            self.Designs.append(optDsg)
+            warmDsg = optDsg
+            if self.shared_aiming():
+                infRays  = None
+                if isinstance(optDsg.dsgInfSrc,InfinitySource):
+                    infRays = optDsg.dsgInfSrc.RayList
+                solution = (optDsg.usrSrc.RayList,optDsg.dsgPtoSrc.RayList,infRays,
+                            optDsg.dsgError,optDsg.dsgSolved)
+
+    def stack(self,RayList):
+        SurfaceDataList = [self.configuration_system(cfgIndex).SurfaceData
+                           for cfgIndex in range(len(self.Overrides))]
+        return stack_systems(SurfaceDataList,RayList)
+
+    def trace(self,RayList=None):
+        '''
+        Traces all the configurations in one batched trace. By default, the
+        aimed user source rays of every configuration are traced (solve is
+        called if needed), otherwise RayList is traced in every configuration.
+        The surfaces before the first overridden surface are traced once when
+        the traced rays are the same in every configuration: RayList, or the
+        aimed rays if the aiming is shared (shared_aiming).
+
+        Returns a RayTrace [S,i,25,k], S: configuration
+        '''
+        if RayList is None:
+            if len(self.Designs) != len(self.Overrides):
+                self.solve()
+            if self.shared_aiming():
+                RayList = self.Designs[0].usrSrc.RayList
+            else:
+                RayList = [optDsg.usrSrc.RayList for optDsg in self.Designs]
+        d,C,n,surfType = self.stack(RayList)
+        return trace_systems(RayList,d,C,n,surfType)
+
+    def print_report(self):
+        headers = ['Cfg','Param','Surface','Value']
+        print("\nCONFIGURATION LIST")
+        print("Class:" + self.__class__.__name__)
+        print("Shared surfaces: " + str(self.shared_surfaces()))
+        print("Shared aiming: " + str(self.shared_aiming()))
+        print("{: >5} {: >12} {: >12} {: >12} ".format(*headers))
+        for cfgIndex,overrides in enumerate(self.Overrides):
+            for (param,surfIndex,value) in overrides:
+                print("{: 5d} {:>12} {: 12d} {:>12} ".format(cfgIndex,param,surfIndex,value))
+
+
+if __name__=='__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import PointSource
+
+    # Base system, the image distance is the focus adjustment
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (25     ,1/-31.47  ,1      )
+
+    pto1 = PointSource([0,2.5,0],635)
+    zoom = MultiConfig(pto1,syst1,aprRad=2)
+    for dist in (24.0,24.5,25.0,25.5,26.0):
+        zoom.add_configuration([('d',3,dist)])
+    zoom.print_report()
+
+    start = time.time()
+    zoom.solve()
+    print('Solve: {:f} s'.format(time.time()-start))
+
+    RayTrace = zoom.trace()
+    print(RayTrace[:,:,9,-1])
@@ -6,13 +6,28 @@ functions:  -LMN_apertureStop
             -XYZ_apertureStop
             -ap_error_calc
             -XYZ_image
+            -LMN_aperture_error
+            -XYZ_aperture_error
+            -aperture_error
+            -image_error
+            -trace_indices
+            -aim_rays
+            -aim_fields
+            -field_label
+            
+The merit functions do not modify the optical design, the ray source nor the
+optical system, so they can be evaluated concurrently (threads or processes).
+The *_error functions only receive plain data (lists and numbers).
 """
 try: import JenTrace
 except ModuleNotFoundError: 
     import os, sys
     sys.path.insert(0,os.path.dirname(os.getcwd()))
     
-from JenTrace.ray_trc import trace
+from JenTrace.ray_trc import trace, trace_ray, transfer_refract
+from JenTrace.ray_src import RaySource, PointSource, InfinitySource
+from JenTrace.catalog import refraction_index
+from JenTrace.srf_tbl import surface_columns
 import numpy as np
 
 def LMN_apertureStop (x0,*arg):
@@ -31,23 +46,13 @@ def LMN_apertureStop (x0,*arg):
     assert arg[1].__class__.__name__=='PointSource' ,'arg[1] must be a PointSource object' 
     assert arg[2] >=0 and arg[2] <=4, 'Invalid ray index (indexRay)'
     #reference the values
-    vector        = x0 
     SurfaceData   = arg[0].optSys.SurfaceData
     ApertureRadio = arg[0].aprRad
     ApertureIndex = arg[0].aprInd
-    RayList       = arg[1].RayList
+    ray           = arg[1].RayList[arg[2]]
     indexRay      = arg[2]
     
-    #Calculate direction cosines
-    LMN = arg[1].calc_direcCos([vector[0],vector[1],1])  
-    #replace cosine director    
-    arg[1].change_LMN(LMN,indexRay)
-    #Make Raytrace
-    RayTrace  = trace(RayList,SurfaceData)
-    #Calculate error
-    error = ap_error_calc(RayTrace,ApertureRadio,indexRay,ApertureIndex)
-    
-    return error
+    return LMN_aperture_error(x0,SurfaceData,ray[0],ray[2],ApertureRadio,ApertureIndex,indexRay)
 
 def XYZ_apertureStop (x0,*arg):
     '''
@@ -66,65 +71,71 @@ def XYZ_apertureStop (x0,*arg):
     assert arg[2] >=0 and arg[2] <=4, 'Invalid ray index (indexRay)'
     
     #reference the values
-    vector        = x0 
     SurfaceData   = arg[0].optSys.SurfaceData
     ApertureRadio = arg[0].aprRad
     ApertureIndex = arg[0].aprInd
-    RayList       = arg[1].RayList
+    ray           = arg[1].RayList[arg[2]]
     indexRay      = arg[2]    
     
-    #Rewrite position vector
-    XYZ = [vector[0],vector[1],0]   
-    #replace cosine director    
-    arg[1].change_XYZ(XYZ,indexRay)
-    #Make Raytrace
-    RayTrace  = trace(RayList,SurfaceData)
-    #Calculate error
-    error = ap_error_calc(RayTrace,ApertureRadio,indexRay,ApertureIndex)
+    return XYZ_aperture_error(x0,SurfaceData,ray[1],ray[2],ApertureRadio,ApertureIndex,indexRay)
+
+def LMN_aperture_error (x0,*arg):
+    '''
+    Side-effect-free merit function of a ray propagated from XYZ in the 
+    direction [x0[0],x0[1],1] to the aperture stop.
     
-    return error
+    x0:  (list) [vector_compX, vector_comp_y]
+    arg: (list) [SurfaceData, XYZ, wvln, ApertureRadio, ApertureIndex, indexRay]
+    '''
+    SurfaceData,XYZ,wvln,ApertureRadio,ApertureIndex,indexRay = arg
+    assert indexRay >=0 and indexRay <=4, 'Invalid ray index (indexRay)'
+    #Calculate direction cosines
+    LMN = RaySource.calc_direcCos([x0[0],x0[1],1])
+    #Trace the single ray up to the aperture stop
+    X0,Y0 = trace_ray(XYZ,LMN,wvln,SurfaceData,ApertureIndex)[0:2]
+    
+    return aperture_error(X0,Y0,ApertureRadio,indexRay)
+
+def XYZ_aperture_error (x0,*arg):
+    '''
+    Side-effect-free merit function of a ray propagated from the position
+    [x0[0],x0[1],0] in the direction LMN to the aperture stop.
+    
+    x0:  (list) [position X, position y]
+    arg: (list) [SurfaceData, LMN, wvln, ApertureRadio, ApertureIndex, indexRay]
+    '''
+    SurfaceData,LMN,wvln,ApertureRadio,ApertureIndex,indexRay = arg
+    assert indexRay >=0 and indexRay <=4, 'Invalid ray index (indexRay)'
+    #Position vector
+    XYZ = [x0[0],x0[1],0]
+    #Trace the single ray up to the aperture stop
+    X0,Y0 = trace_ray(XYZ,LMN,wvln,SurfaceData,ApertureIndex)[0:2]
+    
+    return aperture_error(X0,Y0,ApertureRadio,indexRay)
 
 def ap_error_calc(RayTrace,ApertureRadio,indexRay,ApertureIndex):
-    """
-    if indexRay == 0:
-        error    = (abs(RayTrace[indexRay, 9 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 8 ,ApertureIndex]))
-        
-    if indexRay == 1:
-        error    = (abs(+ApertureRadio - RayTrace[indexRay, 9 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 8 ,ApertureIndex]))
-                    
-    if indexRay == 2:
-        error    = (abs(-ApertureRadio - RayTrace[indexRay, 9 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 8 ,ApertureIndex]))
-                   
-    if indexRay == 3:
-        error    = (abs(+ApertureRadio - RayTrace[indexRay, 8 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 9 ,ApertureIndex]))
-        
-    if indexRay == 4:
-        error    = (abs(-ApertureRadio - RayTrace[indexRay, 8 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 9 ,ApertureIndex]))
-    """
-    if indexRay == 0:
-        error    = (abs(RayTrace[indexRay, 4 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 3 ,ApertureIndex]))
-        
-    if indexRay == 1:
-        error    = (abs(+ApertureRadio - RayTrace[indexRay, 4 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 3 ,ApertureIndex]))
-                    
-    if indexRay == 2:
-        error    = (abs(-ApertureRadio - RayTrace[indexRay, 4 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 3 ,ApertureIndex]))
-                   
-    if indexRay == 3:
-        error    = (abs(+ApertureRadio - RayTrace[indexRay, 3 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 4 ,ApertureIndex]))
-        
-    if indexRay == 4:
-        error    = (abs(-ApertureRadio - RayTrace[indexRay, 3 ,ApertureIndex])
-                   +abs(RayTrace[indexRay, 4 ,ApertureIndex]))
+    '''
+    Error between the ray indexRay of RayTrace and its aperture stop target
+    '''
+    return aperture_error(RayTrace[indexRay, 3 ,ApertureIndex],
+                          RayTrace[indexRay, 4 ,ApertureIndex],
+                          ApertureRadio,indexRay)
+
+#Normalized aperture stop target [X,Y] of the essential rays
+APERTURE_TARGET = [[ 0, 0],         # 0: chief ray
+                   [ 0,+1],         # 1: y upper marginal/coma ray
+                   [ 0,-1],         # 2: y lower marginal/coma ray
+                   [+1, 0],         # 3: x positive marginal/coma ray
+                   [-1, 0]]         # 4: x negative marginal/coma ray
+
+def aperture_error(X0,Y0,ApertureRadio,indexRay):
+    '''
+    Error between the ray position [X0,Y0] on the aperture plane and the 
+    target of the essential ray indexRay.
+    '''
+    targetX,targetY = APERTURE_TARGET[indexRay]
+    error    = (abs(targetX*ApertureRadio - X0)
+               +abs(targetY*ApertureRadio - Y0))
     
     return error
     
@@ -136,29 +147,37 @@ def XYZ_image (x0,*arg):
     the rays with index from 1 to 4 describe the focus error distance.
     
     x0:   (list[float]) distance
-    *arg: (list) [object optical design, int indexRay]
+    *arg: (list) [object optical design, object spot data]
     
     # x0 must be float
     # arg[0] must be Optical design
-    # arg[1] must be int [0,1,2,3,4]
+    # arg[1] must be the spot data of the spot diagram
     
     '''
     #rename values
-    dist        = x0[0] 
-    #RayList     = arg[0].dsgPtoSrc.RayList
-    #RayList     = arg[0].usrSrc.RayList
     SurfaceData = arg[0].optSys.SurfaceData
-    #indexRay    = arg[1]
     sptSrc      = arg[1]
     
-    #replace surface distance
-    surf_len = len(SurfaceData)
-    surf_idx = (surf_len-2) 
-    arg[0].optSys.change_surface(dist,SurfaceData[surf_idx][1],SurfaceData[surf_idx][2],surfIndex=surf_idx)
+    return image_error(x0,SurfaceData,sptSrc.RayList)
+
+def image_error (x0,*arg):
+    '''
+    Side-effect-free version of XYZ_image. The distance of the surface before 
+    the image is replaced in a copy of SurfaceData.
+    
+    x0:   (list[float]) distance
+    *arg: (list) [SurfaceData, RayList]
+    '''
+    dist        = x0[0] 
+    SurfaceData,RayList = arg
+    
+    #replace surface distance in a copy
+    surf_idx    = len(SurfaceData)-2
+    SurfaceData = list(SurfaceData)
+    SurfaceData[surf_idx] = [dist,*SurfaceData[surf_idx][1:]]
     
     #Make Raytrace
-    #RayTrace  = trace(RayList,SurfaceData)
-    RayTrace  = trace(sptSrc.RayList,SurfaceData)
+    RayTrace  = trace(RayList,SurfaceData)
     
     #Fist moment of inertia
     xCoor     = RayTrace[:,8,-1]
@@ -186,11 +205,144 @@ def XYZ_image (x0,*arg):
     return error
 
 
+def trace_indices(XYZ,LMN,n,SurfaceData,surfIndex=-1):
+    '''
+    Batched trace of rays with their own refraction indices (e.g. different
+    wavelengths) up to the surface surfIndex.
+    
+    XYZ,LMN: numpy.ndarray [R,3], n: numpy.ndarray [R,k]
+    Returns X0,Y0,X,Y,Z,L,M,N,OPL numpy.ndarray [R] on the surface surfIndex
+    '''
+    surfIndex = surfIndex % len(SurfaceData)
+    d,C   = surface_columns(SurfaceData)[0:2]
+    X,Y,Z = XYZ.T
+    L,M,N = LMN.T
+    X0,Y0 = X,Y
+    OPL   = np.zeros(len(X))
+    for w in range(1,surfIndex+1):
+        step  = transfer_refract(X,Y,Z,L,M,N,d[w-1],C[w],n[:,w-1],n[:,w])
+        OPL   = OPL + n[:,w-1]*((d[w-1]-Z)/N + step[4])
+        X0,Y0 = step[0:2]
+        X,Y,Z = step[5:8]
+        L,M,N = step[14:17]
+    return X0,Y0,X,Y,Z,L,M,N,OPL
+
+def aim_rays(XYZ,LMN,n,SurfaceData,ApertureRadio,ApertureIndex,target,
+             variable='LMN',tolError=1e-9,maxIter=30):
+    '''
+    Batched ray aiming: every ray is aimed to its normalized aperture stop 
+    target [px,py] with a damped Newton method (finite difference Jacobian), 
+    all the rays are solved at the same time.
+    
+    XYZ,LMN : numpy.ndarray [R,3], source position and direction cosines
+    n       : numpy.ndarray [R,k], refraction indices of every ray
+    target  : numpy.ndarray [R,2], normalized aperture stop coordinates
+    variable: 'LMN' direction tangents (point source) or 'XYZ' position in 
+              the plane z=0 (infinity source)
+    
+    Returns the aimed XYZ,LMN and the aperture error [R] (mm)
+    '''
+    XYZ    = np.array(XYZ,dtype=float)
+    LMN    = np.array(LMN,dtype=float)
+    goal   = np.asarray(target,dtype=float)*ApertureRadio
+    zStop  = sum(surf[0] for surf in SurfaceData[:ApertureIndex]) - XYZ[:,2]
+    
+    def rays(v):
+        if variable == 'LMN':
+            tan = np.column_stack([v,np.ones(len(v))])
+            return XYZ,tan/np.linalg.norm(tan,axis=1,keepdims=True)
+        return np.column_stack([v,np.zeros(len(v))]),LMN
+    
+    def residual(v):
+        X0,Y0 = trace_indices(*rays(v),n,SurfaceData,ApertureIndex)[0:2]
+        return np.column_stack([X0,Y0]) - goal
+    
+    # Initial point: straight line from the source to the stop target
+    if variable == 'LMN':
+        v = (goal - XYZ[:,0:2])/zStop[:,None]
+    else:
+        v = goal - LMN[:,0:2]/LMN[:,2,None]*zStop[:,None]
+    err = residual(v)
+    for iteration in range(maxIter):
+        norm = np.hypot(err[:,0],err[:,1])
+        if np.all(norm[np.isfinite(norm)] < tolError):
+            break
+        # Jacobian [R,2,2] by forward differences
+        h   = 1e-7*np.maximum(np.abs(v).max(axis=1),1e-3)[:,None]
+        jac = np.stack([(residual(v + h*e) - err)/h for e in np.eye(2)],axis=2)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            det  = jac[:,0,0]*jac[:,1,1] - jac[:,0,1]*jac[:,1,0]
+            step = np.column_stack([-( jac[:,1,1]*err[:,0] - jac[:,0,1]*err[:,1])/det,
+                                    -(-jac[:,1,0]*err[:,0] + jac[:,0,0]*err[:,1])/det])
+        step = np.nan_to_num(step,posinf=0.0,neginf=0.0)
+        # Damping: the step is halved while the error grows (or the ray is lost)
+        scale = np.ones(len(v))
+        for halving in range(10):
+            new    = v + scale[:,None]*step
+            newErr = residual(new)
+            newNorm= np.hypot(newErr[:,0],newErr[:,1])
+            worse  = ~(newNorm <= norm) & np.isfinite(norm)
+            if not np.any(worse):
+                break
+            scale[worse] /= 2
+        better = ~worse | ~np.isfinite(norm)
+        v[better]   = new[better]
+        err[better] = newErr[better]
+    
+    XYZ,LMN = rays(v)
+    return XYZ,LMN,np.abs(err).sum(axis=1)
+
+def aim_fields(fields,wavelengths,SurfaceData,ApertureRadio,ApertureIndex,target):
+    '''
+    Batched ray aiming of all the field/wavelength combinations, every
+    combination is aimed to the same aperture stop targets.
+    
+    fields     : list of PointSource (field position) or InfinitySource (field
+                 direction), all of the same type. The wavelength of the 
+                 sources is not used
+    wavelengths: list of wavelengths in nm
+    target     : numpy.ndarray [R,2], normalized aperture stop coordinates
+    
+    Returns the aimed XYZ,LMN [F*W*R,3], the refraction indices n [F*W*R,k] 
+    and the aperture error [F*W*R] (mm), rays ordered as [field, wavelength,
+    target]
+    '''
+    assert all(isinstance(source,(PointSource,InfinitySource)) for source in fields), \
+        'fields must be PointSource or InfinitySource objects'
+    assert all(isinstance(source,type(fields[0])) for source in fields), \
+        'All the fields must be the same source type'
+    F,W,R  = len(fields),len(wavelengths),len(target)
+    nWvln  = np.array([[refraction_index(surf[2],wvln) for surf in SurfaceData]
+                       for wvln in wavelengths])
+    n      = np.repeat(np.tile(nWvln,(F,1)),R,axis=0)
+    if isinstance(fields[0],PointSource):
+        variable = 'LMN'
+        XYZ = np.repeat([source.Position for source in fields],W*R,axis=0)
+        LMN = np.tile([0.0,0.0,1.0],(F*W*R,1))
+    else:
+        variable = 'XYZ'
+        XYZ = np.zeros((F*W*R,3))
+        LMN = np.repeat([source.DirecCos for source in fields],W*R,axis=0)
+    
+    XYZ,LMN,aimError = aim_rays(XYZ,LMN,n,SurfaceData,ApertureRadio,ApertureIndex,
+                                np.tile(target,(F*W,1)),variable)
+    return XYZ,LMN,n,aimError
+
+def field_label(source):
+    '''
+    Short label of a field: y position (PointSource) or y angle (InfinitySource)
+    '''
+    if isinstance(source,PointSource):
+        return 'y={:.3g}mm'.format(source.Position[1])
+    L,M,N = source.DirecCos
+    return 'θy={:.3g}°'.format(np.degrees(np.arctan2(M,N)))
+
+
 
 if __name__=='__main__':
-    from ray_src import PointSource
-    from opt_sys import OpSysData
-    from opt_dsg import OpDesign
+    from JenTrace.ray_src import PointSource
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.opt_dsg import OpDesign
     from plt_fnc import plot_system,plot_rayTrace 
 
     import matplotlib.pyplot as plt
@@ -211,4 +363,13 @@ if __name__=='__main__':
     fig, ax = plot_rayTrace(design1.dsgInfTrace,fig=fig,ax=ax)
     
     
-    
\ No newline at end of file
+    
+    
+    #Concurrent evaluation of the side-effect-free merit functions
+    from concurrent.futures import ThreadPoolExecutor
+    ray  = design1.dsgPtoSrc.RayList[1]
+    args = (syst1.SurfaceData,ray[0],ray[2],design1.aprRad,design1.aprInd,1)
+    grid = [[x,y] for x in np.linspace(-0.1,0.1,5) for y in np.linspace(-0.1,0.1,5)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        errors = list(executor.map(lambda x0: LMN_aperture_error(x0,*args),grid))
+    print(errors)
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Composable merit function built from operands
+Classes:    -Operand
+            -RMSSpot
+            -EffectiveFocalLength
+            -Distortion
+            -ChiefRayAngle
+            -EdgeThickness
+            -GeometricMTF
+            -WavefrontRMS
+            -StrehlRatio
+            -MeritFunction
+functions:  -hexapolar_pupil
+            -surface_sag
+
+The operands declare the rays they need. MeritFunction collects the rays of
+all the operands, removes the duplicated ones and traces the union once.
+Every operand is then evaluated from its rows of the shared RayTrace.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+from abc import ABC, abstractmethod
+from JenTrace.ray_trc import trace
+from JenTrace.ray_src import PointSource
+from JenTrace.abr_fnc import paraxial_trace, paraxial_focal_length
+from JenTrace.mtf_fnc import mtf_sum
+from JenTrace.catalog import refraction_index
+from JenTrace.wvf_fnc import exit_pupil, reference_opd, zernike_fit
+from JenTrace.dif_fnc import diffraction_grid, fft_psf
+
+def hexapolar_pupil(noRings):
+    '''
+    Hexapolar pupil sampling: center plus noRings rings with 6*ring points.
+    Returns px,py numpy arrays in the unit circle.
+    '''
+    px = [0.0]
+    py = [0.0]
+    for ring in range(1,noRings+1):
+        theta = np.linspace(0,2*np.pi,6*ring,endpoint=False)
+        px.extend(ring/noRings*np.cos(theta))
+        py.extend(ring/noRings*np.sin(theta))
+    return np.array(px),np.array(py)
+
+def surface_sag(C,h):
+    '''
+    Sag of a spherical surface with curvature C at the height h
+    '''
+    return C*h**2/(1+np.sqrt(1-(C*h)**2))
+
+class Operand(ABC):
+    '''
+    Abstract base operand. The residual is weight*(value-target) for mode
+    'eq'. The modes 'min' and 'max' are boundaries: the residual is zero when
+    the value is above (min) or below (max) the target.
+
+    Subclasses implement value(designs,RayTrace), the operand value from the
+    rows of its rays, override rays(designs), the RayList needed by the
+    operand (default: no ray), and set surfIndex, the last surface needed in
+    the trace (-1: image).
+    '''
+    modes = {'eq','min','max'}
+
+    def __init__(self,target=0.0,weight=1.0,mode='eq'):
+        assert mode in self.modes, 'Operand mode must be "eq", "min" or "max"'
+        self.target    = target
+        self.weight    = weight
+        self.mode      = mode
+        self.surfIndex = -1
+
+    def rays(self,designs):
+        return []
+
+    @abstractmethod
+    def value(self,designs,RayTrace):
+        pass
+
+    def residual(self,value):
+        error = value - self.target
+        if self.mode == 'min':
+            error = min(error,0.0)
+        if self.mode == 'max':
+            error = max(error,0.0)
+        return self.weight*error
+
+class RMSSpot(Operand):
+    '''
+    RMS spot radius (mm) of the field fieldIndex on the surface surfIndex,
+    sampled with a hexapolar pupil grid of noRings rings.
+    '''
+    def __init__(self,fieldIndex=0,noRings=3,surfIndex=-1,target=0.0,weight=1.0,mode='eq'):
+        Operand.__init__(self,target,weight,mode)
+        self.fieldIndex = fieldIndex
+        self.noRings    = noRings
+        self.surfIndex  = surfIndex
+
+    def rays(self,designs):
+        px,py = hexapolar_pupil(self.noRings)
+        return designs[self.fieldIndex].pupil_rays(px,py)
+
+    def value(self,designs,RayTrace):
+        x = RayTrace[:,8,self.surfIndex]
+        y = RayTrace[:,9,self.surfIndex]
+        return np.sqrt(np.nanmean((x-np.nanmean(x))**2+(y-np.nanmean(y))**2))
+
+class EffectiveFocalLength(Operand):
+    '''
+    Paraxial effective focal length (mm) at the wavelength of the design
+    fieldIndex. No real ray is traced.
+    '''
+    def __init__(self,fieldIndex=0,target=0.0,weight=1.0,mode='eq'):
+        Operand.__init__(self,target,weight,mode)
+        self.fieldIndex = fieldIndex
+        self.surfIndex  = 0
+
+    def value(self,designs,RayTrace):
+        optDsg  = designs[self.fieldIndex]
+        efl,bfl = paraxial_focal_length(optDsg.optSys.SurfaceData,optDsg.usrSrc.Wavelength)
+        return efl
+
+class Distortion(Operand):
+    '''
+    Distortion (%) of the field fieldIndex: real chief ray height against the
+    paraxial chief ray height on the image surface (meridional plane). The
+    distortion is 0 on axis (paraxial image height below tolHeight in mm).
+    '''
+    tolHeight = 1e-9
+
+    def __init__(self,fieldIndex=0,target=0.0,weight=1.0,mode='eq'):
+        Operand.__init__(self,target,weight,mode)
+        self.fieldIndex = fieldIndex
+        self.surfIndex  = -1
+
+    def rays(self,designs):
+        return [designs[self.fieldIndex].usrSrc.RayList[0]]
+
+    def value(self,designs,RayTrace):
+        optDsg      = designs[self.fieldIndex]
+        SurfaceData = optDsg.optSys.SurfaceData
+        wvln        = optDsg.usrSrc.Wavelength
+        aprInd      = optDsg.aprInd
+        # The paraxial trace is linear, two rays give the chief ray through the stop center
+        if isinstance(optDsg.usrSrc,PointSource):
+            y0 = optDsg.usrSrc.Position[1]
+            ya,ua,na = paraxial_trace(SurfaceData,wvln,y0,0.0)
+            yb,ub,nb = paraxial_trace(SurfaceData,wvln,y0,1.0)
+            t  = -ya[aprInd]/(yb[aprInd]-ya[aprInd])
+            yImg = ya[-1] + t*(yb[-1]-ya[-1])
+        else:
+            LMN = optDsg.usrSrc.DirecCos
+            u0  = LMN[1]/LMN[2]
+            ya,ua,na = paraxial_trace(SurfaceData,wvln,0.0,u0)
+            yb,ub,nb = paraxial_trace(SurfaceData,wvln,1.0,u0)
+            t  = -ya[aprInd]/(yb[aprInd]-ya[aprInd])
+            yImg = ya[-1] + t*(yb[-1]-ya[-1])
+        if abs(yImg) < self.tolHeight:
+            return 0.0
+        return 100*(RayTrace[0,9,self.surfIndex]-yImg)/yImg
+
+class ChiefRayAngle(Operand):
+    '''
+    Angle (degrees) between the chief ray of the field fieldIndex and the
+    optical axis after the surface surfIndex.
+    '''
+    def __init__(self,fieldIndex=0,surfIndex=-1,target=0.0,weight=1.0,mode='eq'):
+        Operand.__init__(self,target,weight,mode)
+        self.fieldIndex = fieldIndex
+        self.surfIndex  = surfIndex
+
+    def rays(self,designs):
+        return [designs[self.fieldIndex].usrSrc.RayList[0]]
+
+    def value(self,designs,RayTrace):
+        L,M,N = RayTrace[0,19:22,self.surfIndex]
+        return np.degrees(np.arctan2(np.sqrt(L**2+M**2),N))
+
+class EdgeThickness(Operand):
+    '''
+    Edge thickness (mm) between the surfaces surfIndex and surfIndex+1 at
+    the semi-diameter semDia. No ray is traced.
+    '''
+    def __init__(self,surfIndex,semDia,target=0.0,weight=1.0,mode='min'):
+        Operand.__init__(self,target,weight,mode)
+        self.surfIndex = surfIndex
+        self.semDia    = semDia
+
+    def value(self,designs,RayTrace):
+        SurfaceData = designs[0].optSys.SurfaceData
+        d,C1 = SurfaceData[self.surfIndex][0:2]
+        C2   = SurfaceData[self.surfIndex+1][1]
+        return d + surface_sag(C2,self.semDia) - surface_sag(C1,self.semDia)
+
+class GeometricMTF(Operand):
+    '''
+    Geometric MTF of the field fieldIndex at the frequency (cycles/mm), 
+    direction 't' (tangential, y) or 's' (sagittal, x), sampled with a 
+    hexapolar pupil grid of noRings rings. Usually a 'min' boundary.
+    '''
+    def __init__(self,fieldIndex=0,frequency=10.0,direction='t',noRings=6,
+                 surfIndex=-1,target=0.0,weight=1.0,mode='min'):
+        Operand.__init__(self,target,weight,mode)
+        assert direction in ('t','s'), 'MTF direction must be "t" or "s"'
+        self.fieldIndex = fieldIndex
+        self.frequency  = frequency
+        self.direction  = direction
+        self.noRings    = noRings
+        self.surfIndex  = surfIndex
+
+    def rays(self,designs):
+        px,py = hexapolar_pupil(self.noRings)
+        return designs[self.fieldIndex].pupil_rays(px,py)
+
+    def value(self,designs,RayTrace):
+        column = 9 if self.direction == 't' else 8
+        return mtf_sum(RayTrace[:,column,self.surfIndex],self.frequency)[0]
+
+class WavefrontRMS(Operand):
+    '''
+    RMS wavefront error (waves, piston removed) of the field fieldIndex on 
+    the exit pupil reference sphere, from a Zernike fit of noTerms terms on a 
+    hexapolar pupil grid of noRings rings. The Zernike basis of the grid is 
+    cached, so repeated evaluations only cost the trace.
+    '''
+    def __init__(self,fieldIndex=0,noRings=6,noTerms=15,target=0.0,weight=1.0,mode='eq'):
+        Operand.__init__(self,target,weight,mode)
+        self.fieldIndex = fieldIndex
+        self.noRings    = noRings
+        self.noTerms    = noTerms
+        self.surfIndex  = -1
+
+    def rays(self,designs):
+        # The pupil center (index 0) is the aimed chief ray
+        px,py = hexapolar_pupil(self.noRings)
+        return designs[self.fieldIndex].pupil_rays(px,py)
+
+    def value(self,designs,RayTrace):
+        optDsg      = designs[self.fieldIndex]
+        SurfaceData = optDsg.optSys.SurfaceData
+        wvln        = optDsg.usrSrc.Wavelength
+        zXP    = exit_pupil(SurfaceData,wvln,optDsg.aprInd)
+        nImage = refraction_index(SurfaceData[-2][2],wvln)
+        image  = RayTrace[:,:,self.surfIndex]
+        opd    = reference_opd(image[:,8:11],image[:,19:22],image[:,24],zXP,wvln,nImage)
+        px,py  = hexapolar_pupil(self.noRings)
+        coef   = zernike_fit(px,py,opd,self.noTerms)
+        return np.sqrt(np.sum(coef[1:]**2))
+
+class StrehlRatio(Operand):
+    '''
+    Diffraction Strehl ratio of the field fieldIndex from the FFT PSF of a
+    regular pupil grid (gridSize x gridSize, FFT size gridSize*padding). The
+    grid is cached and shared by all the evaluations, the FFT buffer is
+    reused per thread.
+    Usually a 'min' boundary.
+    '''
+    def __init__(self,fieldIndex=0,gridSize=32,padding=4,target=0.0,weight=1.0,mode='min'):
+        Operand.__init__(self,target,weight,mode)
+        self.fieldIndex = fieldIndex
+        self.gridSize   = gridSize
+        self.padding    = padding
+        self.surfIndex  = -1
+
+    def rays(self,designs):
+        # The pupil center (index 0) is the aimed chief ray
+        grid = diffraction_grid(self.gridSize,self.padding)
+        px   = np.concatenate([[0.0],grid.Px[grid.Inside]])
+        py   = np.concatenate([[0.0],grid.Py[grid.Inside]])
+        return designs[self.fieldIndex].pupil_rays(px,py)
+
+    def value(self,designs,RayTrace):
+        optDsg      = designs[self.fieldIndex]
+        SurfaceData = optDsg.optSys.SurfaceData
+        wvln        = optDsg.usrSrc.Wavelength
+        grid   = diffraction_grid(self.gridSize,self.padding)
+        zXP    = exit_pupil(SurfaceData,wvln,optDsg.aprInd)
+        nImage = refraction_index(SurfaceData[-2][2],wvln)
+        image  = RayTrace[:,:,self.surfIndex]
+        opd    = grid.opd_map(reference_opd(image[:,8:11],image[:,19:22],image[:,24],
+                                            zXP,wvln,nImage)[1:])
+        return fft_psf(grid,opd).max()
+
+class MeritFunction:
+    '''
+    Weighted sum of squared operand residuals.
+
+    Attributes:
+        Operands: list of Operand
+    '''
+    def __init__(self,operands=[]):
+        self.Operands = list(operands)
+
+    def add_operand(self,operand):
+        assert isinstance(operand,Operand), 'operand must be an Operand object'
+        self.Operands.append(operand)
+
+    def collect_rays(self,designs):
+        '''
+        Union of the rays of all the operands. Returns the unique RayList and,
+        per operand, the indices of its rays in that list.
+        '''
+        RayList  = []
+        rayIndex = {}
+        opIndex  = []
+        for operand in self.Operands:
+            indices = []
+            for ray in operand.rays(designs):
+                key = (*ray[0],*ray[1],ray[2])
+                if key not in rayIndex:
+                    rayIndex[key] = len(RayList)
+                    RayList.append(ray)
+                indices.append(rayIndex[key])
+            opIndex.append(indices)
+        return RayList,opIndex
+
+    def evaluate(self,designs):
+        '''
+        designs: list of OpDesign of the same optical system, one per field
+
+        Returns the merit (sum of squared residuals) and the numpy arrays of
+        the operand values and residuals.
+        '''
+        SurfaceData = designs[0].optSys.SurfaceData
+        k = len(SurfaceData)
+        RayList,opIndex = self.collect_rays(designs)
+
+        # Trace the unique rays once, only up to the last surface needed. The
+        # surfaces after it are numpy.nan, the operands index the k surfaces
+        lastSurf = max([operand.surfIndex % k for operand,indices
+                        in zip(self.Operands,opIndex) if len(indices) > 0],default=0)
+        RayTrace = np.full([len(RayList),25,k],np.nan)
+        if len(RayList) > 0:
+            RayTrace[:,:,:lastSurf+1] = trace(RayList,SurfaceData[:lastSurf+1])
+
+        values    = np.zeros(len(self.Operands))
+        residuals = np.zeros(len(self.Operands))
+        for q,(operand,indices) in enumerate(zip(self.Operands,opIndex)):
+            values[q]    = operand.value(designs,RayTrace[indices])
+            residuals[q] = operand.residual(values[q])
+
+        return np.sum(residuals**2),values,residuals
+
+    def print_report(self,designs):
+        merit,values,residuals = self.evaluate(designs)
+        headers = ['#','Operand','Target','Weight','Value','Residual']
+        print("\nMERIT FUNCTION")
+        print("{: >5} {: >22} {: >12} {: >12} {: >12} {: >12} ".format(*headers))
+        for q,operand in enumerate(self.Operands):
+            print("{: 5d} {: >22} {:12f} {:12f} {:12f} {:12f} ".format(
+                  q,operand.__class__.__name__,operand.target,operand.weight,
+                  values[q],residuals[q]))
+        print("Merit: {:f}".format(merit))
+
+
+if __name__ == '__main__':
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.opt_dsg import OpDesign
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (30     ,1/-31.47  ,1      )
+
+    # One design per field
+    designs = [OpDesign(PointSource([0,Y,0],635),syst1,aprRad=2) for Y in (0.0,2.5)]
+
+    merit1 = MeritFunction()
+    merit1.add_operand(RMSSpot(fieldIndex=0,noRings=4))
+    merit1.add_operand(RMSSpot(fieldIndex=1,noRings=4))
+    merit1.add_operand(EffectiveFocalLength(target=25.0,weight=0.1))
+    merit1.add_operand(Distortion(fieldIndex=1))
+    merit1.add_operand(ChiefRayAngle(fieldIndex=1,target=0.0,mode='max'))
+    merit1.add_operand(EdgeThickness(1,5.0,target=1.0))
+    merit1.add_operand(GeometricMTF(fieldIndex=1,frequency=20.0,target=0.5))
+    merit1.add_operand(WavefrontRMS(fieldIndex=0))
+    merit1.add_operand(StrehlRatio(fieldIndex=0,target=0.8))
+    merit1.print_report(designs)
+
+    # The operand values do not depend on the traced length of the other operands
+    angle1 = MeritFunction([ChiefRayAngle(fieldIndex=1,surfIndex=-2)]).evaluate(designs)[1]
+    angle2 = MeritFunction([ChiefRayAngle(fieldIndex=1,surfIndex=-2),
+                            ChiefRayAngle(fieldIndex=1,surfIndex=-1)]).evaluate(designs)[1]
+    print('Chief ray angle after surface -2: {:f} {:f}'.format(angle1[0],angle2[0]))
+    assert angle1[0] == angle2[0], 'Operand value depends on the other operands'
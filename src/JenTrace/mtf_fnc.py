@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Geometric modulation transfer function (MTF)
+functions:  -mtf_sum
+            -geometric_mtf
+            -field_mtf
+            -matrix_mtf
+            -plot_mtf
+
+The geometric MTF is the modulus of the Fourier transform of the ray
+intercept distribution, evaluated as a vectorized sum over the rays for all
+the spatial frequencies at once:
+    MTF(f) = |sum(w*exp(-2*pi*i*f*u))| / sum(w)
+u is the x (sagittal) or y (tangential) intercept, the field is in the y-z plane.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+import matplotlib.pyplot as plt
+from JenTrace.spt_dgm import spot_diagram
+
+def mtf_sum(u,frequencies,weight=None,chunkSize=10000):
+    '''
+    Geometric MTF of the 1-D intercepts u (mm) at the spatial frequencies
+    (cycles/mm). Lost rays (numpy.nan) are ignored.
+    Returns numpy array [len(frequencies)]
+    '''
+    u = np.asarray(u,dtype=float)
+    if weight is None:
+        weight = np.ones(len(u))
+    valid  = np.isfinite(u)
+    u      = u[valid] - np.average(u[valid],weights=weight[valid])
+    weight = weight[valid]
+    freq   = 2*np.pi*np.atleast_1d(np.asarray(frequencies,dtype=float))
+    real   = np.zeros(len(freq))
+    imag   = np.zeros(len(freq))
+    # Chunks of rays keep the [frequencies, rays] phase matrix small
+    for start in range(0,len(u),chunkSize):
+        phase = freq[:,None]*u[start:start+chunkSize]
+        real += np.cos(phase) @ weight[start:start+chunkSize]
+        imag += np.sin(phase) @ weight[start:start+chunkSize]
+    return np.hypot(real,imag)/weight.sum()
+
+def geometric_mtf(spot,frequencies):
+    '''
+    Sagittal and tangential geometric MTF of a SpotData (weighted rays).
+    Returns sagittal, tangential numpy arrays [len(frequencies)]
+    '''
+    x,y = spot.Position[:,0],spot.Position[:,1]
+    return (mtf_sum(x,frequencies,spot.Weight),
+            mtf_sum(y,frequencies,spot.Weight))
+
+def field_mtf(designs,frequencies,noRays=10000,surfIndex=-1):
+    '''
+    Geometric MTF of several fields, one solved OpDesign per field.
+    Returns numpy array [F,2,len(frequencies)], index 0: sagittal, 1: tangential
+    '''
+    mtf = np.empty([len(designs),2,len(np.atleast_1d(frequencies))])
+    for q,optDsg in enumerate(designs):
+        spot   = spot_diagram(optDsg,noRays=noRays,surfIndex=surfIndex)
+        mtf[q] = geometric_mtf(spot,frequencies)
+    return mtf
+
+def matrix_mtf(spotMtx,frequencies,wvlnWeights=None):
+    '''
+    Polychromatic geometric MTF of every field of a SpotMatrix: the rays of all
+    the wavelengths are pooled with the weights wvlnWeights [W].
+    Returns numpy array [F,2,len(frequencies)], index 0: sagittal, 1: tangential
+    '''
+    F,W,N = spotMtx.X.shape
+    if wvlnWeights is None:
+        wvlnWeights = np.ones(W)
+    weight = np.repeat(np.asarray(wvlnWeights,dtype=float),N)
+    mtf    = np.empty([F,2,len(np.atleast_1d(frequencies))])
+    for f in range(F):
+        mtf[f,0] = mtf_sum(spotMtx.X[f].ravel(),frequencies,weight)
+        mtf[f,1] = mtf_sum(spotMtx.Y[f].ravel(),frequencies,weight)
+    return mtf
+
+def plot_mtf(frequencies,mtf,labels=None):
+    '''
+    Plots a field MTF array [F,2,len(frequencies)], sagittal dashed and
+    tangential solid lines.
+    '''
+    fig, ax = plt.subplots()
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    for q in range(mtf.shape[0]):
+        label = labels[q] if labels is not None else 'field {:d}'.format(q)
+        color = colors[q % len(colors)]
+        ax.plot(frequencies,mtf[q,1],'-' ,color=color,label=label+' T')
+        ax.plot(frequencies,mtf[q,0],'--',color=color,label=label+' S')
+    ax.set_ylim(0,1.05)
+    ax.grid('on')
+    ax.legend(fontsize=8)
+    ax.set_xlabel('frequency[cycles/mm]')
+    ax.set_ylabel('MTF')
+    return fig, ax
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import PointSource
+    from JenTrace.opt_dsg import OpDesign
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (39.68  ,1/-31.47  ,1      )
+
+    designs     = [OpDesign(PointSource([0,Y,0],635),syst1,aprRad=2) for Y in (0.0,2.5,5.0)]
+    frequencies = np.linspace(0,100,100)
+
+    start = time.time()
+    mtf1  = field_mtf(designs,frequencies,noRays=10**5)
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    plot_mtf(frequencies,mtf1,labels=['0mm','2.5mm','5mm'])
+    plt.show()
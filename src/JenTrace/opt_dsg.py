@@ -12,9 +12,10 @@ except ModuleNotFoundError:
 from JenTrace.plt_fnc import plot_system, plot_rayTrace
 from JenTrace.opt_sys import OpSysData
 from JenTrace.ray_src import RaySource,PointSource,InfinitySource
-from JenTrace.ray_trc import trace
-from JenTrace.mrt_fnc import LMN_apertureStop,XYZ_apertureStop,XYZ_image
+from JenTrace.ray_trc import trace, trace_surfaces
+from JenTrace.mrt_fnc import LMN_aperture_error,XYZ_aperture_error,image_error
 from JenTrace.spt_dgm import spot_diagram
+from JenTrace.ray_fan import ray_fan
 from scipy.optimize import minimize, brute, fmin
 import matplotlib.pyplot as plt
 import numpy as np
@@ -26,7 +27,8 @@ class OpDesign:
     
     Falta: Documentacion
     '''
-    def __init__(self,usrSrc,optSys,aprRad=1.0,aprInd=1,systemType='default'):
+    def __init__(self,usrSrc,optSys,aprRad=1.0,aprInd=1,systemType='default',warmDsg=None,
+                 solution=None):
         #Attributes
         self.usrSrc  = usrSrc
         self.optSys  = optSys
@@ -39,13 +41,24 @@ class OpDesign:
         #design attributes
         self.dsgPtoSrc = PointSource([0,0,0],self.usrSrc.Wavelength) 
         self.dsgInfSrc = InfinitySource([0,0,1],self.usrSrc.Wavelength)
+        #Warm start of the ray aiming from a similar (solved) design
+        self.warmStart = False
+        if warmDsg is not None:
+            self.warm_start(warmDsg)
         #Solve attriutes
         self.dsgSolved = False
         self.dsgError  = []
         self.tolError  = 0.005
+        #Cached pupil map and its (degree, gridSize), see pupil_map
+        self.pupilMap      = None
+        self.pupilMapKey   = None
+        self.pupilMapError = np.nan
         
-        # solve design
-        self.solve_dsg()
+        # solve design, or restore a cached aiming solution (see dsg_io)
+        if solution is None:
+            self.solve_dsg()
+        else:
+            self.restore_solution(*solution)
         
     def change_aperture_radius(self,aprRad):
         assert isinstance(aprRad,(int,float)), 'Invalid aperture radius (aperRad) data type'
@@ -58,8 +71,48 @@ class OpDesign:
         assert aprInd > 0 and aprInd < surf_len, 'Invalid aperture index (aprInd) value'
         self.aprInd=aprInd
         
+    def warm_start(self,warmDsg):
+        '''
+        The aimed essential rays of warmDsg are used as initial points of the 
+        ray aiming, e.g. between adjacent configurations of a zoom lens.
+        '''
+        assert warmDsg.dsgSolved, 'The warm start design (warmDsg) is not solved'
+        for rayIndex in range(5):
+            self.dsgPtoSrc.change_LMN(warmDsg.dsgPtoSrc.RayList[rayIndex][1],rayIndex)
+            if isinstance(warmDsg.dsgInfSrc,InfinitySource):
+                self.dsgInfSrc.change_XYZ(warmDsg.dsgInfSrc.RayList[rayIndex][0],rayIndex)
+            #User source, only if the field is the same
+            if (isinstance(self.usrSrc,PointSource) and isinstance(warmDsg.usrSrc,PointSource)
+                and list(self.usrSrc.Position) == list(warmDsg.usrSrc.Position)):
+                self.usrSrc.change_LMN(warmDsg.usrSrc.RayList[rayIndex][1],rayIndex)
+            if (isinstance(self.usrSrc,InfinitySource) and isinstance(warmDsg.usrSrc,InfinitySource)
+                and list(self.usrSrc.DirecCos) == list(warmDsg.usrSrc.DirecCos)):
+                self.usrSrc.change_XYZ(warmDsg.usrSrc.RayList[rayIndex][0],rayIndex)
+        self.warmStart = True
+        
+    def restore_solution(self,usrRays,ptoRays,infRays,dsgError,dsgSolved=True):
+        '''
+        Restores the aimed rays of the user source and of the design sources
+        (RayLists) without solving the ray aiming again, e.g. a saved design. 
+        infRays is None for a telecentric design.
+        '''
+        self.pupilMap          = None
+        self.usrSrc.RayList    = [[list(ray[0]),list(ray[1]),ray[2]] for ray in usrRays]
+        self.dsgPtoSrc.RayList = [[list(ray[0]),list(ray[1]),ray[2]] for ray in ptoRays]
+        self.dsgError          = list(dsgError)
+        self.dsgSolved         = dsgSolved
+        self.raySrcTrace = trace(self.usrSrc.RayList   ,self.optSys.SurfaceData)
+        self.dsgPtoTrace = trace(self.dsgPtoSrc.RayList,self.optSys.SurfaceData)
+        if infRays is None:
+            self.dsgInfSrc   = np.nan
+            self.dsgInfTrace = np.nan
+        else:
+            self.dsgInfSrc.RayList = [[list(ray[0]),list(ray[1]),ray[2]] for ray in infRays]
+            self.dsgInfTrace = trace(self.dsgInfSrc.RayList,self.optSys.SurfaceData)
+        
     def solve_dsg(self):
         self.dsgSolved = False
+        self.pupilMap  = None
         self.propagate_essential_rays()
         self.trace_optical_design()
         if max(self.dsgError)< self.tolError:
@@ -115,18 +168,25 @@ class OpDesign:
             
     
     def propagate_ray (self,ptoSrc,rayIndex):
+        # The merit functions receive plain data, the design is not modified
+        SurfaceData = self.optSys.SurfaceData
+        ray         = ptoSrc.RayList[rayIndex]
         
         if isinstance(ptoSrc,PointSource):
             #Perform optimization
             x0  = [0,0]
-            res = minimize(LMN_apertureStop, x0, args=(self,ptoSrc,rayIndex), method='Nelder-Mead')
+            if self.warmStart:
+                LMN = ptoSrc.RayList[rayIndex][1]
+                x0  = [LMN[0]/LMN[2],LMN[1]/LMN[2]]
+            args= (SurfaceData,ray[0],ray[2],self.aprRad,self.aprInd,rayIndex)
+            res = minimize(LMN_aperture_error, x0, args=args, method='Nelder-Mead')
             # Get result
             rayError = res.fun
             x1  = res.x
             # If error is out of boundary, try brute algorithm near x1
             if (rayError > self.tolError):
                 rranges = (slice(x1[0]-0.05, x1[0]+0.05, 0.01), slice(x1[1]-0.05, x1[1]+0.05, 0.01))
-                resbrute = brute(LMN_apertureStop, rranges,args=(self,ptoSrc,rayIndex), full_output=True,finish=fmin)
+                resbrute = brute(LMN_aperture_error, rranges,args=args, full_output=True,finish=fmin)
                 rayError = resbrute[1]
                 x1  = resbrute[0]
             LMN = RaySource.calc_direcCos([x1[0],x1[1],1])
@@ -138,14 +198,17 @@ class OpDesign:
             m   = ptoSrc.DirecCos
             #Perform optimization
             x0  = [-d*m[0],-d*m[1]]
-            res = minimize(XYZ_apertureStop, x0, args=(self,ptoSrc,rayIndex), method='Nelder-Mead')
+            if self.warmStart:
+                x0  = ptoSrc.RayList[rayIndex][0][:2]
+            args= (SurfaceData,ray[1],ray[2],self.aprRad,self.aprInd,rayIndex)
+            res = minimize(XYZ_aperture_error, x0, args=args, method='Nelder-Mead')
             # Get result
             rayError = res.fun
             x1  = res.x
             # If error is out of boundary, try brute algorithm near x1
             if (rayError > self.tolError):
                 rranges = (slice(x1[0]-0.05, x1[0]+0.05, 0.01), slice(x1[1]-0.05, x1[1]+0.05, 0.01))
-                resbrute = brute(XYZ_apertureStop, rranges,args=(self,ptoSrc,rayIndex), full_output=True,finish=fmin)
+                resbrute = brute(XYZ_aperture_error, rranges,args=args, full_output=True,finish=fmin)
                 rayError = resbrute[1]
                 x1  = resbrute[0]
             XYZ = [x1[0],x1[1],0]
@@ -155,15 +218,149 @@ class OpDesign:
         #Perform optimization
         #rayIndex = 1
         x0 = self.optSys.SurfaceData[-2][0]
-        sptSrc,sptTrace = spot_diagram(self,noRays=1000)
+        spot = spot_diagram(self,noRays=1000)
         #res= minimize(XYZ_image, x0,args=(self,rayIndex),method='Nelder-Mead')
-        res= minimize(XYZ_image, x0,args=(self,sptSrc),method='Nelder-Mead')
+        res= minimize(image_error, x0,args=(self.optSys.SurfaceData,spot.RayList),method='Nelder-Mead')
         #Replace value
         x1 = res.x
         self.optSys.SurfaceData[-2][0]=x1[0]
         #Actualize trace
         self.solve_dsg()
+
+    def pupil_map(self,degree=5,gridSize=17):
+        '''
+        Cached map from the normalized aperture stop coordinates [px,py] 
+        (unit circle = aperture radius) to the source variables: direction 
+        tangents [L/N,M/N] for a point source or position [X,Y] for an 
+        infinity source.
+        
+        A grid of gridSize x gridSize source rays around the aimed essential 
+        rays is traced to the aperture stop and the inverse map is fitted by 
+        least squares with a polynomial of degree degree. The aimed essential 
+        rays are weighted to be (almost) interpolated. The map is rebuilt 
+        after solve_dsg or when degree or gridSize change.
+        
+        pupilMapError: maximum error (normalized pupil units) of the fitted 
+        grid rays inside the stop
+        
+        Returns the exponents [terms,2] and the coefficients [terms,2]
+        '''
+        if self.pupilMap is not None and self.pupilMapKey == (degree,gridSize):
+            return self.pupilMap
+        
+        assert self.dsgSolved, 'The optical design is not solved'
+        SurfaceData = self.optSys.SurfaceData
+        wvln        = self.usrSrc.Wavelength
+        ess         = self.source_variables(self.usrSrc.RayList[:5])
         
+        # Source grid around the essential rays (10% margin)
+        lower = ess.min(axis=0) - 0.1*np.ptp(ess,axis=0)
+        upper = ess.max(axis=0) + 0.1*np.ptp(ess,axis=0)
+        gx,gy = np.meshgrid(np.linspace(lower[0],upper[0],gridSize),
+                            np.linspace(lower[1],upper[1],gridSize))
+        grid  = np.column_stack([gx.ravel(),gy.ravel()])
+        XYZ,LMN = self.source_rays(grid)
+        stop  = trace_surfaces(XYZ,LMN,wvln,SurfaceData,[self.aprInd])[:,0:2,0]/self.aprRad
+        valid = np.all(np.isfinite(stop),axis=1) & (np.sum(stop**2,axis=1) <= 1.5**2)
+        
+        # Essential rays: exact stop targets, high weight
+        target = np.array([[0,0],[0,1],[0,-1],[1,0],[-1,0]],dtype=float)
+        pupil  = np.vstack([target,stop[valid]])
+        values = np.vstack([ess,grid[valid]])
+        weight = np.concatenate([np.full(5,10.0),np.ones(valid.sum())])
+        
+        exponents = np.array([[a,b] for order in range(degree+1)
+                                    for a in range(order,-1,-1) for b in [order-a]])
+        basis = pupil[:,None,0]**exponents[:,0] * pupil[:,None,1]**exponents[:,1]
+        coef  = np.linalg.lstsq(basis*weight[:,None],values*weight[:,None],rcond=None)[0]
+        
+        inside = np.sum(pupil**2,axis=1) <= 1
+        scale  = np.ptp(ess,axis=0)/2
+        self.pupilMapError = np.max(np.abs(basis[inside] @ coef - values[inside])/scale)
+        self.pupilMap    = (exponents,coef)
+        self.pupilMapKey = (degree,gridSize)
+        return self.pupilMap
+    
+    def source_variables(self,RayList):
+        '''
+        Source variables of the rays: direction tangents [L/N,M/N] (point 
+        source) or position [X,Y] (infinity source). Returns numpy.ndarray [i,2]
+        '''
+        if isinstance(self.usrSrc,PointSource):
+            return np.array([[ray[1][0]/ray[1][2],ray[1][1]/ray[1][2]] for ray in RayList])
+        return np.array([ray[0][:2] for ray in RayList],dtype=float)
+    
+    def source_rays(self,variables):
+        '''
+        Inverse of source_variables. Returns XYZ,LMN numpy.ndarray [i,3]
+        '''
+        variables = np.asarray(variables,dtype=float).reshape(-1,2)
+        i = len(variables)
+        if isinstance(self.usrSrc,PointSource):
+            tan = np.column_stack([variables,np.ones(i)])
+            LMN = tan/np.linalg.norm(tan,axis=1,keepdims=True)
+            XYZ = np.tile(np.asarray(self.usrSrc.Position,dtype=float),(i,1))
+        else:
+            XYZ = np.column_stack([variables,np.zeros(i)])
+            LMN = np.tile(np.asarray(self.usrSrc.DirecCos,dtype=float),(i,1))
+        return XYZ,LMN
+    
+    def pupil_source(self,px,py):
+        '''
+        Source rays directed to the normalized aperture stop coordinates 
+        [px,py] through the cached pupil map. Returns XYZ,LMN numpy.ndarray [i,3]
+        '''
+        px = np.atleast_1d(np.asarray(px,dtype=float))
+        py = np.atleast_1d(np.asarray(py,dtype=float))
+        exponents,coef = self.pupil_map()
+        # Polynomial evaluated term by term, no [i,terms] basis is built
+        pxPow = [np.ones_like(px)]
+        pyPow = [np.ones_like(py)]
+        for order in range(exponents.max()):
+            pxPow.append(pxPow[-1]*px)
+            pyPow.append(pyPow[-1]*py)
+        variables = np.zeros([len(px),2])
+        for (a,b),c in zip(exponents,coef):
+            term = pxPow[a]*pyPow[b]
+            variables[:,0] += c[0]*term
+            variables[:,1] += c[1]*term
+        return self.source_rays(variables)
+    
+    def pupil_rays(self,px,py):
+        '''
+        Rays of the user source directed to the normalized aperture stop
+        coordinates [px,py] (unit circle = aperture radius), see pupil_map.
+
+        px,py: array-like with the same length
+        Returns a RayList
+        '''
+        px = np.atleast_1d(np.asarray(px,dtype=float))
+        py = np.atleast_1d(np.asarray(py,dtype=float))
+        XYZ,LMN = self.pupil_source(px,py)
+        wvln = self.usrSrc.Wavelength
+        rays = [[list(xyz),list(lmn),wvln] for xyz,lmn in zip(XYZ.tolist(),LMN.tolist())]
+        # The pupil center is the aimed chief ray itself
+        for q in np.flatnonzero((px==0) & (py==0)):
+            rays[q] = self.usrSrc.RayList[0]
+        return rays
+
+    def ray_fan(self,fields=None,wavelengths=None,noRays=21,surfIndex=-1,primary=0,show=False):
+        '''
+        Tangential and sagittal ray fans (ey/ex and OPD versus the normalized
+        pupil coordinate) of this optical system, aperture radius and index. 
+        All the fields and wavelengths are aimed and traced in one batch.
+
+        fields:      list of PointSource/InfinitySource, by default the user source
+        wavelengths: list of wavelengths in nm, by default the user source wavelength
+        Returns a RayFan
+        '''
+        if fields is None:
+            fields = [self.usrSrc]
+        if wavelengths is None:
+            wavelengths = [self.usrSrc.Wavelength]
+        return ray_fan(fields,wavelengths,self.optSys,self.aprRad,self.aprInd,
+                       noRays,surfIndex,primary,show)
+
     def plot_design(self,clearSemDia=[]):
         fig, ax = plt.subplots()
         fig, ax = plot_system(self,fig,ax,clearSemDia=clearSemDia)
@@ -11,11 +11,12 @@ except ModuleNotFoundError:
     
 import matplotlib.pyplot as plt
 from JenTrace.plt_fnc import plot_system
+from JenTrace.srf_tbl import SurfaceTable
 
 class OpSysData:
     '''
     Attributes:
-        SurfaceData: list of lists, (d,C,n,surfType)
+        SurfaceData: SurfaceTable, columnar list of (d,C,n,surfType) rows
         d: distance (mm)
         C: curvature (1/mm)
         n: refraction index (-)
@@ -25,7 +26,7 @@ class OpSysData:
     surfaceTypes = {'standard', 'paraxial', 'grin'}
     
     def __init__(self):                      
-        self.SurfaceData=[]
+        self.SurfaceData=SurfaceTable()
         self.add_surface(10,0,1,'standard',surfIndex=0) #object
         self.add_surface( 0,0,1,'standard',surfIndex=1) #image
     
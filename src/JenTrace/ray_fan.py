@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Ray fans: transverse ray aberration and OPD versus pupil coordinate
+Class:      -RayFan
+functions:  -ray_fan
+
+The tangential and sagittal fans of all the field/wavelength combinations are
+aimed (aim_fields) and traced in one batch, with their optical path length.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+import matplotlib.pyplot as plt
+from JenTrace.catalog import refraction_index
+from JenTrace.ray_src import PointSource, InfinitySource
+from JenTrace.mrt_fnc import aim_fields, trace_indices, field_label
+from JenTrace.wvf_fnc import exit_pupil, reference_opd
+
+class RayFan:
+    '''
+    Tangential and sagittal ray fans of F fields and W wavelengths.
+
+    Attributes:
+        Fields     : list of PointSource/InfinitySource, field definitions
+        Wavelengths: list of wavelengths in nm
+        Pupil      : numpy array [N], normalized pupil coordinate of the fans
+        EY         : numpy array [F,W,N], tangential fan, y error against the
+                     chief ray of the primary wavelength (numpy.nan: ray lost)
+        EX         : numpy array [F,W,N], sagittal fan, x error
+        OPDT,OPDS  : numpy arrays [F,W,N], tangential and sagittal OPD in waves
+                     (reference sphere of the chief ray of every wavelength)
+        AimError   : numpy array [F,W,2N+1], aperture stop error of the aimed
+                     rays (index 0: chief ray)
+    '''
+    def __init__(self,fields,wavelengths,pupil,EY,EX,OPDT,OPDS,aimError):
+        self.Fields      = fields
+        self.Wavelengths = wavelengths
+        self.Pupil       = pupil
+        self.EY          = EY
+        self.EX          = EX
+        self.OPDT        = OPDT
+        self.OPDS        = OPDS
+        self.AimError    = aimError
+
+    def field_label(self,fieldIndex):
+        return field_label(self.Fields[fieldIndex])
+
+    def plot(self,kind='ray',colors=None):
+        '''
+        Plots all the fans in one figure: one row per field, tangential and
+        sagittal columns, one line per wavelength.
+        kind: 'ray' (transverse aberration) or 'opd'
+        '''
+        assert kind in ('ray','opd'), 'kind must be "ray" or "opd"'
+        F,W,N = self.EY.shape
+        if colors is None:
+            colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        if kind == 'ray':
+            tangential,sagittal = 1000*self.EY,1000*self.EX
+            labels = ('ey[um]','ex[um]')
+        else:
+            tangential,sagittal = self.OPDT,self.OPDS
+            labels = ('OPD[waves]','OPD[waves]')
+        fig, axes = plt.subplots(F,2,squeeze=False,sharex=True,sharey=True,
+                                 figsize=(7,2*F))
+        for f in range(F):
+            for w in range(W):
+                color = colors[w % len(colors)]
+                axes[f,0].plot(self.Pupil,tangential[f,w],color=color,
+                               label='{:g}nm'.format(self.Wavelengths[w]))
+                axes[f,1].plot(self.Pupil,sagittal[f,w],color=color)
+            for c in range(2):
+                axes[f,c].axhline(0,color='black',lw=0.8)
+                axes[f,c].grid('on')
+            axes[f,0].set_ylabel('{}\n{}'.format(self.field_label(f),labels[0]),fontsize=8)
+        axes[0,0].set_title('Tangential')
+        axes[0,1].set_title('Sagittal')
+        axes[-1,0].set_xlabel('py')
+        axes[-1,1].set_xlabel('px')
+        axes[0,0].legend(fontsize=7)
+        fig.tight_layout()
+        return fig, axes
+
+    def print_report(self):
+        headers = ['Field','Wvln','MaxEY','MaxEX','PV OPDT','PV OPDS']
+        print("\nRAY FAN")
+        print("{: >14} {: >8} {: >12} {: >12} {: >12} {: >12} ".format(*headers))
+        with np.errstate(invalid='ignore'):
+            maxEY = np.nanmax(np.abs(self.EY),axis=2)
+            maxEX = np.nanmax(np.abs(self.EX),axis=2)
+            pvT   = np.nanmax(self.OPDT,axis=2) - np.nanmin(self.OPDT,axis=2)
+            pvS   = np.nanmax(self.OPDS,axis=2) - np.nanmin(self.OPDS,axis=2)
+        for f in range(len(self.Fields)):
+            for w in range(len(self.Wavelengths)):
+                print("{: >14} {: 8.1f} {:12f} {:12f} {:12f} {:12f} ".format(
+                      self.field_label(f),self.Wavelengths[w],maxEY[f,w],
+                      maxEX[f,w],pvT[f,w],pvS[f,w]))
+
+def ray_fan(fields,wavelengths,optSys,aprRad=1.0,aprInd=1,noRays=21,surfIndex=-1,
+            primary=0,show=False):
+    '''
+    Tangential and sagittal ray fans of all the field/wavelength combinations.
+
+    fields:      list of PointSource (field position) or InfinitySource (field
+                 direction). The wavelength of the sources is not used
+    wavelengths: list of wavelengths in nm
+    optSys:      optical system (OpSysData)
+    aprRad:      aperture stop radius
+    aprInd:      aperture stop index
+    noRays:      rays per fan, uniform pupil coordinates in [-1,1]
+    surfIndex:   evaluated surface, by default the image plane
+    primary:     wavelength index of the reference chief ray of ey/ex
+    show:        plot the fans
+
+    Returns a RayFan
+    '''
+    SurfaceData = optSys.SurfaceData
+    F,W = len(fields),len(wavelengths)
+
+    # Pupil targets: chief ray, tangential fan (0,p), sagittal fan (p,0)
+    pupil  = np.linspace(-1,1,noRays)
+    zero   = np.zeros(noRays)
+    target = np.vstack([[0,0],np.column_stack([zero,pupil]),np.column_stack([pupil,zero])])
+    R      = len(target)
+
+    # Rays ordered as [field, wavelength, ray]
+    XYZ,LMN,n,aimError = aim_fields(fields,wavelengths,SurfaceData,aprRad,aprInd,target)
+    surf = np.column_stack(trace_indices(XYZ,LMN,n,SurfaceData,surfIndex)[2:])
+    surf = surf.reshape(F,W,R,7)
+
+    # Transverse aberration against the primary chief ray
+    chief = surf[:,primary,0,0:2]
+    EY    = surf[:,:,1:noRays+1,1] - chief[:,None,None,1]
+    EX    = surf[:,:,noRays+1:,0]  - chief[:,None,None,0]
+
+    # OPD on the reference sphere of every field/wavelength
+    OPD = np.empty([F,W,R])
+    for w,wvln in enumerate(wavelengths):
+        zXP    = exit_pupil(SurfaceData,wvln,aprInd)
+        nImage = refraction_index(SurfaceData[-2][2],wvln)
+        for f in range(F):
+            OPD[f,w] = reference_opd(surf[f,w,:,0:3],surf[f,w,:,3:6],surf[f,w,:,6],
+                                     zXP,wvln,nImage)
+
+    rayFan = RayFan(fields,list(wavelengths),pupil,EY,EX,OPD[:,:,1:noRays+1],
+                    OPD[:,:,noRays+1:],aimError.reshape(F,W,R))
+    if show:
+        rayFan.plot()
+        plt.show()
+
+    return rayFan
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (39.68  ,1/-31.47  ,1      )
+
+    fields      = [PointSource([0,Y,0],587.6) for Y in (0.0,2.5,5.0)]
+    wavelengths = [486.1,587.6,656.3]
+
+    start = time.time()
+    fans1 = ray_fan(fields,wavelengths,syst1,aprRad=2,noRays=41,primary=1)
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    print('Max aim error: {:e} mm'.format(fans1.AimError.max()))
+    fans1.print_report()
+    fans1.plot()
+    fans1.plot(kind='opd')
+    plt.show()
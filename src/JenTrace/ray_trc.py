@@ -3,8 +3,16 @@
 Created on Sat Mar 21 05:44:55 2020
 @author: David Vasquez
 functions:  -trace
+            -trace_systems
+            -stack_systems
+            -ray_arrays
+            -surface_lists
             -fill_first
+            -transfer_refract
             -makeTrace           
+            -trace_ray
+            -trace_rays
+            -trace_surfaces
             -print_report
             -makeTrace_paraxial *
             -makeTrace_grin *
@@ -15,7 +23,8 @@ except ModuleNotFoundError:
     import os, sys
     sys.path.insert(0,os.path.dirname(os.getcwd()))
 
-from JenTrace.catalog import OPT_GLASS, sellmeierDispForm
+from JenTrace.catalog import refraction_index, refraction_index_array
+from JenTrace.srf_tbl import SurfaceTable, SURF_TYPE_CODE, surface_columns
 import math
 import numpy
 
@@ -35,13 +44,14 @@ def trace(RayList,SurfaceData):
                              [L,M,N]            new direction cosines
                              [Check2]           -> Boolean
                              [surfType]         -> 1:Standard, 2:Paraxial
+                             [OPL]              optical path length from the object surface
                          
               The position is represented by the index.
               In the array, i represent the ray, j the data and k the surface
             
     '''
     i = len(RayList)                          # Ray i
-    j = 24                                    # [d,c,n][X0,Y0][F,G,Delta][X,Y,Z][check1][alfa,beta,gamma][lambda][cosI,CosIp][K][L,M,N][Check2][surfType]
+    j = 25                                    # [d,c,n][X0,Y0][F,G,Delta][X,Y,Z][check1][alfa,beta,gamma][lambda][cosI,CosIp][K][L,M,N][Check2][surfType][OPL]
     k = len(SurfaceData)                      # Surface k
     RayTrace = numpy.zeros([i,j,k])
     RayTrace = fill_first(RayList,SurfaceData,RayTrace,i,k)
@@ -49,146 +59,384 @@ def trace(RayList,SurfaceData):
     
     return RayTrace
 
+def trace_systems(RayList,d,C,n,surfType=None):
+    '''
+    Traces the rays through a stack of S optical systems with the same number 
+    of surfaces in one vectorized pass. The leading surfaces shared by all the
+    systems (and rays) are traced only once.
+    
+    RayList : list of lists, ([x,y,z],[cosX,cosY,cosZ], lambda), the same rays
+              for every system, or a list of S RayLists with i rays each (the
+              shared surfaces are only traced once if the S RayLists are equal)
+    d       : numpy.ndarray [S,k], distances in mm
+    C       : numpy.ndarray [S,k], curvatures in 1/mm
+    n       : numpy.ndarray [S,k] or [S,i,k], refraction indices (per ray when 
+              the rays have different wavelengths), see stack_systems
+    surfType: numpy.ndarray [S,k], surface type code (1:Standard, 2:Paraxial)
+    
+    RayTrace: numpy.ndarray [S,i,25,k], the last three axes as in trace
+    '''
+    d = numpy.asarray(d,dtype=float)
+    C = numpy.asarray(C,dtype=float)
+    n = numpy.asarray(n,dtype=float)
+    (S,k) = d.shape
+    if n.ndim == 2:
+        n = n[:,None,:]
+    
+    XYZ,LMN,wvln = ray_arrays(RayList)
+    i = XYZ.shape[-2]
+    
+    RayTrace = numpy.zeros([S,i,25,k])
+    RayTrace[:,:,0 ,:] = d[:,None,:]
+    RayTrace[:,:,1 ,:] = C[:,None,:]
+    RayTrace[:,:,2 ,:] = n
+    RayTrace[:,:,8:11 ,0] = XYZ
+    RayTrace[:,:,11,0] = 1
+    RayTrace[:,:,15,:] = wvln[...,None]
+    RayTrace[:,:,19:22,0] = LMN
+    RayTrace[:,:,22,0] = 1
+    RayTrace[:,:,23,:] = 1 if surfType is None else numpy.asarray(surfType)[:,None,:]
+    
+    # Shared surfaces: the trace on surface w depends on d[w-1], C[w], n[w-1], n[w]
+    # and on the rays, which must be the same in every system
+    start = 1
+    if XYZ.ndim == 2 or (numpy.all(XYZ==XYZ[0]) and numpy.all(LMN==LMN[0])
+                         and numpy.all(wvln==wvln[0])):
+        while (start < k and numpy.all(RayTrace[:,:,0:3,start-1]==RayTrace[0,:,0:3,start-1])
+                         and numpy.all(RayTrace[:,:,1:3,start  ]==RayTrace[0,:,1:3,start  ])):
+            start += 1
+    if start > 1:
+        prefix = makeTrace(RayTrace[0,:,:,:start].copy(),i,start)
+        RayTrace[:,:,3:15 ,:start] = prefix[:,3:15 ,:]
+        RayTrace[:,:,16:23,:start] = prefix[:,16:23,:]
+        RayTrace[:,:,24   ,:start] = prefix[:,24   ,:]
+    
+    return makeTrace(RayTrace,i,k,start=start)
+
+def stack_systems(SurfaceDataList,RayList):
+    '''
+    Stacks a list of S SurfaceData with the same number of surfaces into the 
+    arrays used by trace_systems. Glass materials are evaluated at the 
+    wavelength of every ray.
+    
+    Returns d [S,k], C [S,k], n [S,i,k] and surfType [S,k]
+    '''
+    S = len(SurfaceDataList)
+    k = len(SurfaceDataList[0])
+    assert all([len(SurfaceData)==k for SurfaceData in SurfaceDataList]), 'All systems must have the same number of surfaces'
+    XYZ,LMN,wvln = ray_arrays(RayList)
+    wvlnSet = numpy.unique(wvln)
+    
+    columns  = [surface_columns(SurfaceData) for SurfaceData in SurfaceDataList]
+    d        = numpy.array([column[0] for column in columns])
+    C        = numpy.array([column[1] for column in columns])
+    surfType = numpy.array([column[3] for column in columns])
+    # refraction index per unique material and wavelength (one array), then per ray
+    rows     = {}
+    order    = numpy.array([[rows.setdefault(material,len(rows)) for material in column[2]] for column in columns])
+    nWvln    = numpy.moveaxis(refraction_index_array(list(rows),wvlnSet)[order],-1,1)
+    wvlnInd  = numpy.broadcast_to(numpy.searchsorted(wvlnSet,wvln),(S,XYZ.shape[-2]))
+    n        = nWvln[numpy.arange(S)[:,None],wvlnInd]
+    
+    return d,C,n,surfType
+
+def ray_arrays(RayList):
+    '''
+    Converts a RayList into numpy arrays XYZ [i,3], LMN [i,3] and wvln [i]. 
+    A list of S RayLists returns XYZ [S,i,3], LMN [S,i,3] and wvln [S,i].
+    '''
+    if len(RayList) > 0 and numpy.ndim(RayList[0][0][0]) > 0:
+        return tuple(numpy.stack(array) for array in zip(*[ray_arrays(rays) for rays in RayList]))
+    XYZ  = numpy.array([ray[0] for ray in RayList],dtype=float).reshape(-1,3)
+    LMN  = numpy.array([ray[1] for ray in RayList],dtype=float).reshape(-1,3)
+    wvln = numpy.array([ray[2] for ray in RayList],dtype=float)
+    
+    return XYZ,LMN,wvln
+
+def surface_lists(SurfaceData,wvln):
+    '''
+    d [k], C [k] and n [k] (lists of float) at the wavelength wvln. A 
+    SurfaceTable returns its cached columns without conversion.
+    '''
+    if isinstance(SurfaceData,SurfaceTable):
+        return SurfaceData.columns(wvln)
+    return ([surf[0] for surf in SurfaceData],[surf[1] for surf in SurfaceData],
+            [refraction_index(surf[2],wvln) for surf in SurfaceData])
+
 def fill_first(RayList,SurfaceData,RayTrace,i,k):
-    for q in range (0,i):                                       # i -> ray indice
-        RayTrace[q,8 ,0] = RayList[q][0][0]                     # X coordinate from object
-        RayTrace[q,9 ,0] = RayList[q][0][1]                     # Y coordinate from object
-        RayTrace[q,10,0] = RayList[q][0][2]                     # Z coordinate from object
+    XYZ,LMN,wvln = ray_arrays(RayList)
+    
+    RayTrace[:,8:11 ,0] = XYZ                                   # X,Y,Z coordinate from object
+    RayTrace[:,11,0]    = 1                                     # Chech 1 -> true
+    RayTrace[:,15,:]    = wvln[:,None]                          # Wavelength in nm
+    RayTrace[:,19:22,0] = LMN                                   # X,Y,Z cosine director
+    RayTrace[:,22,0]    = 1                                     # Chech 2 -> true
+    RayTrace[:,23,0]    = 1                                     # Surftype -> 1: Standard
+    
+    if isinstance(SurfaceData,SurfaceTable):
+        # Columnar surface data: whole arrays, indices per unique wavelength
+        wvlnSet,wvlnInd  = numpy.unique(wvln,return_inverse=True)
+        RayTrace[:,0,:]  = SurfaceData.d
+        RayTrace[:,1,:]  = SurfaceData.C
+        RayTrace[:,2,:]  = SurfaceData.index_array(wvlnSet)[:,wvlnInd].T
+        known            = SurfaceData.surfType > 0
+        RayTrace[:,23,known] = SurfaceData.surfType[known]
+        return RayTrace
+    
+    for w in range (0,k):                                       # k -> surface indice
+        RayTrace[:,0,w] = SurfaceData[w][0]                     # distance in mm
+        RayTrace[:,1,w] = SurfaceData[w][1]                     # curvature in 1/mm
+        # refraction indice, evaluated once per wavelength
+        if isinstance(SurfaceData[w][2],str):
+            for wv in set(wvln):
+                RayTrace[wvln==wv,2,w] = refraction_index(SurfaceData[w][2],wv)
+        else:
+            RayTrace[:,2,w] = SurfaceData[w][2] 
+        # Surface type 
+        if SurfaceData[w][3] in SURF_TYPE_CODE:
+            RayTrace[:,23,w] = SURF_TYPE_CODE[SurfaceData[w][3]]
+            
+    return RayTrace
+
+def transfer_refract(Xmin1,Ymin1,Zmin1,Lmin1,Mmin1,Nmin1,dmin1,c,n,np):
+    '''
+    Welford transfer to the next surface and refraction, vectorized over any 
+    broadcastable array shape. Rays that miss the surface or are reflected 
+    instead of refracted return numpy.nan.
+    
+    Returns X0,Y0,F,G,Delta,X,Y,Z,alfa,beta,gamma,CosI,CosIp,K,L,M,N
+    '''
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        #Transfer part1
+        X0 = Xmin1 + (Lmin1/Nmin1)*(dmin1-Zmin1)
+        Y0 = Ymin1 + (Mmin1/Nmin1)*(dmin1-Zmin1)
         
-        RayTrace[q,11,0] = 1                                    # Chech 1 -> true
-        RayTrace[q,15,:] = RayList[q][2]                        # Wavelength in nm
+        #Transfer part2
+        F = c*(X0**2+Y0**2)
+        G = Nmin1 - c*(Lmin1*X0+Mmin1*Y0)
         
-        RayTrace[q,19,0] = RayList[q][1][0]                     # X cosine director
-        RayTrace[q,20,0] = RayList[q][1][1]                     # Y cosine director
-        RayTrace[q,21,0] = RayList[q][1][2]                     # Z cosine director 
+        CosI  = numpy.sqrt(G**2-c*F)               # nan: surface not found
+        Delta = F / (G + CosI)
         
-        RayTrace[q,22,0] = 1                                    # Chech 2 -> true
-        RayTrace[q,23,0] = 1                                    # Surftype -> 1: Standard
+        X = X0 + Lmin1*Delta
+        Y = Y0 + Mmin1*Delta
+        Z = Nmin1*Delta
         
-        for w in range (0,k):                                  # k -> surface indice
-            RayTrace[q,0,w] = SurfaceData[w][0]                # distance in mm
-            RayTrace[q,1,w] = SurfaceData[w][1]                # curvature in 1/mm
-            # refraction indice 
-            if isinstance(SurfaceData[w][2],str):
-                try:
-                    RayTrace[q,2,w] = sellmeierDispForm (OPT_GLASS[SurfaceData[w][2]]
-                                                        ,RayList[q][2])
-                except KeyError:
-                    raise ValueError('%s, non existent glass material' % SurfaceData[w][2])
-            else:
-                RayTrace[q,2,w] = SurfaceData[w][2] 
-            # Surface type 
-            if SurfaceData[w][3]=="standard":               
-                RayTrace[q,23,w]=1
-            if SurfaceData[w][3]=="paraxial":
-                RayTrace[q,23,w]=2
-            
-    return RayTrace
+        #Refraction
+        alfa = -c*X
+        beta = -c*Y
+        gamma= 1 - c*Z
+        
+        CosIp = (1/np)*numpy.sqrt(np**2 - (n**2)*(1-CosI**2))   # nan: ray reflected
+        
+        K = c*(np*CosIp - n*CosI) 
+        
+        L = (1/np)*(n*Lmin1 - K*X )
+        M = (1/np)*(n*Mmin1 - K*Y )
+        N = (1/np)*(n*Nmin1 - K*Z + np*CosIp - n*CosI)
+    
+    return X0,Y0,F,G,Delta,X,Y,Z,alfa,beta,gamma,CosI,CosIp,K,L,M,N
 
-def makeTrace(RayTrace,i,k):
-    for q in range (0,i):                                             #i -> ray indice
-        for w in range (1,k):                                         #k -> surface indice, start in 1
-                
-            #Transfer part1
-            dmin1 = RayTrace[q,0 ,w-1]
-            
-            Xmin1 = RayTrace[q,8 ,w-1]
-            Ymin1 = RayTrace[q,9 ,w-1]
-            Zmin1 = RayTrace[q,10,w-1]
-            
-            Lmin1 = RayTrace[q,19,w-1]
-            Mmin1 = RayTrace[q,20,w-1]
-            Nmin1 = RayTrace[q,21,w-1]
-            
-            X0 = Xmin1 + (Lmin1/Nmin1)*(dmin1-Zmin1)
-            Y0 = Ymin1 + (Mmin1/Nmin1)*(dmin1-Zmin1)
-            
-            #Transfer part2
-            c = RayTrace[q,1,w]
-            
-            F = c*(X0**2+Y0**2)
-            G = Nmin1 - c*(Lmin1*X0+Mmin1*Y0)
-            
-            try:
-                Delta = F / (G + math.sqrt(G**2-c*F) )
-            except ValueError:
-                #Surface not found
-                RayTrace[q,3:11,w:]  = numpy.NaN
-                RayTrace[q,12:15,w:] = numpy.NaN
-                RayTrace[q,16:22,w:] = numpy.NaN
-                break 
-            
-            X = X0 + Lmin1*Delta
-            Y = Y0 + Mmin1*Delta
-            Z = Nmin1*Delta
-            
-            # The ray i meet the surface k
-            check1 = 1
-            
-            #Refraction
-            n   = RayTrace[q,2,w-1]
-            np  = RayTrace[q,2,w]
-            
-            alfa = -c*X
-            beta = -c*Y
-            gamma= 1 - c*Z
-            
-            
-            CosI  = math.sqrt(G**2 - c*F)
-            
-            try:
-                CosIp = (1/np)*math.sqrt(np**2 - (n**2)*(1-CosI**2))
-            except ValueError:
-                #ray reflected instead of refracted
-                RayTrace[q,3:11,w:]  = numpy.NaN
-                RayTrace[q,12:15,w:] = numpy.NaN
-                RayTrace[q,16:22,w:] = numpy.NaN
-                break
-            
-            K = c*(np*CosIp - n*CosI) 
-            
-            L = (1/np)*(n*Lmin1 - K*X )
-            M = (1/np)*(n*Mmin1 - K*Y )
-            N = (1/np)*(n*Nmin1 - K*Z + np*CosIp - n*CosI)
-            
-            #Check1 and Check for direction cosines
-            check2 = int(check1 and numpy.isclose((L**2+M**2+N**2),1))
-            
-            # Replace
-            
-            #RayTrace[q,0 ,w] = d                        # From SysData in function "fill_first"
-            #RayTrace[q,1 ,w] = c                        # From SysData in function "fill_first"
-            #RayTrace[q,2 ,w] = np                       # From SysData in function "fill_first"
-            RayTrace[q,3 ,w] = X0
-            RayTrace[q,4 ,w] = Y0
-            RayTrace[q,5 ,w] = F
-            RayTrace[q,6 ,w] = G
-            RayTrace[q,7 ,w] = Delta
-            RayTrace[q,8 ,w] = X
-            RayTrace[q,9 ,w] = Y
-            RayTrace[q,10,w] = Z
-            RayTrace[q,11,w] = check1
-            RayTrace[q,12,w] = alfa
-            RayTrace[q,13,w] = beta
-            RayTrace[q,14,w] = gamma
-            #RayTrace[q,15,w] = Lambda                   # From sysData in function "fill_first"
-            RayTrace[q,16,w] = CosI
-            RayTrace[q,17,w] = CosIp
-            RayTrace[q,18,w] = K
-            RayTrace[q,19,w] = L
-            RayTrace[q,20,w] = M
-            RayTrace[q,21,w] = N
-            RayTrace[q,22,w] = check2
-            #RayTrace[q,23 ,w] = SurfType                # From SysData in function "fill_first"    
+def makeTrace(RayTrace,i,k,start=1):
+    '''
+    Propagates the rays surface by surface. All the rays (and systems, for 
+    stacked traces [...,25,k]) are propagated at once. The surfaces before 
+    start must be already traced.
+    '''
+    alive = RayTrace[...,11,start-1] == 1
+    for w in range (start,k):                                         #k -> surface indice, start in 1
+        (X0,Y0,F,G,Delta,X,Y,Z,alfa,beta,gamma,
+         CosI,CosIp,K,L,M,N) = transfer_refract(RayTrace[...,8 ,w-1],
+                                                RayTrace[...,9 ,w-1],
+                                                RayTrace[...,10,w-1],
+                                                RayTrace[...,19,w-1],
+                                                RayTrace[...,20,w-1],
+                                                RayTrace[...,21,w-1],
+                                                RayTrace[...,0 ,w-1],
+                                                RayTrace[...,1 ,w  ],
+                                                RayTrace[...,2 ,w-1],
+                                                RayTrace[...,2 ,w  ])
+        
+        # The ray i meet the surface k and is refracted
+        alive = alive & numpy.isfinite(CosI) & numpy.isfinite(CosIp)
+        
+        #Check1 and Check for direction cosines
+        check1 = alive.astype(float)
+        with numpy.errstate(invalid='ignore'):
+            check2 = (alive & numpy.isclose((L**2+M**2+N**2),1)).astype(float)
+        
+        # Replace
+        
+        #RayTrace[...,0 ,w] = d                        # From SysData in function "fill_first"
+        #RayTrace[...,1 ,w] = c                        # From SysData in function "fill_first"
+        #RayTrace[...,2 ,w] = np                       # From SysData in function "fill_first"
+        RayTrace[...,3 ,w] = X0
+        RayTrace[...,4 ,w] = Y0
+        RayTrace[...,5 ,w] = F
+        RayTrace[...,6 ,w] = G
+        RayTrace[...,7 ,w] = Delta
+        RayTrace[...,8 ,w] = X
+        RayTrace[...,9 ,w] = Y
+        RayTrace[...,10,w] = Z
+        RayTrace[...,11,w] = check1
+        RayTrace[...,12,w] = alfa
+        RayTrace[...,13,w] = beta
+        RayTrace[...,14,w] = gamma
+        #RayTrace[...,15,w] = Lambda                   # From sysData in function "fill_first"
+        RayTrace[...,16,w] = CosI
+        RayTrace[...,17,w] = CosIp
+        RayTrace[...,18,w] = K
+        RayTrace[...,19,w] = L
+        RayTrace[...,20,w] = M
+        RayTrace[...,21,w] = N
+        RayTrace[...,22,w] = check2
+        #RayTrace[...,23 ,w] = SurfType                # From SysData in function "fill_first"    
+        # Optical path: transfer to the vertex plane plus Delta, in the medium before the surface
+        RayTrace[...,24,w] = RayTrace[...,24,w-1] + RayTrace[...,2,w-1]*(
+                             (RayTrace[...,0,w-1]-RayTrace[...,10,w-1])/RayTrace[...,21,w-1] + Delta)
+        
+        #Surface not found or ray reflected instead of refracted
+        lost = ~alive
+        RayTrace[lost,3:11,w]  = numpy.nan
+        RayTrace[lost,12:15,w] = numpy.nan
+        RayTrace[lost,16:22,w] = numpy.nan
+        RayTrace[lost,24,w]    = numpy.nan
     
     return RayTrace
 
+def trace_ray(XYZ,LMN,wvln,SurfaceData,surfIndex=-1):
+    '''
+    Fast path for a single ray: the ray is propagated with scalar arithmetic 
+    only up to the surface surfIndex and no RayTrace is allocated.
+    
+    XYZ        : list [3xdouble], ray position in mm
+    LMN        : list [3xdouble], direction cosines
+    wvln       : wavelength in nm
+    SurfaceData: list of lists, (d,C,n,surfType)
+    surfIndex  : last surface to trace, -1 is the image
+    
+    Returns X0,Y0,X,Y,Z,L,M,N on the surface surfIndex. If the ray misses a 
+    surface or is reflected, all the values are numpy.nan.
+    '''
+    if surfIndex < 0:
+        surfIndex += len(SurfaceData)
+    X,Y,Z = XYZ
+    L,M,N = LMN
+    X0,Y0 = numpy.nan,numpy.nan
+    dList,CList,nList = surface_lists(SurfaceData,wvln)
+    n     = nList[0]
+    
+    for w in range (1,surfIndex+1):
+        #Transfer
+        dmin1 = dList[w-1]
+        c     = CList[w]
+        np    = nList[w]
+        X0 = X + (L/N)*(dmin1-Z)
+        Y0 = Y + (M/N)*(dmin1-Z)
+        F  = c*(X0**2+Y0**2)
+        G  = N - c*(L*X0+M*Y0)
+        CosI2 = G**2-c*F
+        if CosI2 < 0:
+            #Surface not found
+            return (numpy.nan,)*8
+        CosI  = math.sqrt(CosI2)
+        Delta = F / (G + CosI)
+        X = X0 + L*Delta
+        Y = Y0 + M*Delta
+        Z = N*Delta
+        #Refraction
+        CosIp2 = np**2 - (n**2)*(1-CosI**2)
+        if CosIp2 < 0:
+            #Ray reflected instead of refracted
+            return (numpy.nan,)*8
+        CosIp = (1/np)*math.sqrt(CosIp2)
+        K = c*(np*CosIp - n*CosI) 
+        L,M,N = ((1/np)*(n*L - K*X ),
+                 (1/np)*(n*M - K*Y ),
+                 (1/np)*(n*N - K*Z + np*CosIp - n*CosI))
+        n = np
+    
+    return X0,Y0,X,Y,Z,L,M,N
+
+def trace_rays(XYZ,LMN,wvln,SurfaceData,surfIndex=-1):
+    '''
+    Fast path for a small batch of rays with the same wavelength, propagated 
+    only up to the surface surfIndex without RayTrace allocation.
+    
+    XYZ,LMN: numpy.ndarray [i,3], ray position and direction cosines
+    
+    Returns X0,Y0,X,Y,Z,L,M,N as numpy.ndarray [i] on the surface surfIndex
+    '''
+    if surfIndex < 0:
+        surfIndex += len(SurfaceData)
+    XYZ = numpy.asarray(XYZ,dtype=float)
+    LMN = numpy.asarray(LMN,dtype=float)
+    X,Y,Z = XYZ[:,0],XYZ[:,1],XYZ[:,2]
+    L,M,N = LMN[:,0],LMN[:,1],LMN[:,2]
+    X0,Y0 = numpy.full(len(X),numpy.nan),numpy.full(len(X),numpy.nan)
+    dList,CList,nList = surface_lists(SurfaceData,wvln)
+    n     = nList[0]
+    
+    alive = numpy.ones(len(X),dtype=bool)
+    for w in range (1,surfIndex+1):
+        np   = nList[w]
+        step = transfer_refract(X,Y,Z,L,M,N,dList[w-1],CList[w],n,np)
+        X0,Y0 = step[0:2]
+        X,Y,Z = step[5:8]
+        L,M,N = step[14:17]
+        alive = alive & numpy.isfinite(step[11]) & numpy.isfinite(step[12])
+        n = np
+    
+    #Surface not found or ray reflected instead of refracted
+    return tuple(numpy.where(alive,value,numpy.nan) for value in (X0,Y0,X,Y,Z,L,M,N))
+
+def trace_surfaces(XYZ,LMN,wvln,SurfaceData,surfIndices,chunkSize=100000):
+    '''
+    Lean batched trace for large numbers of rays with the same wavelength. 
+    Only the vertex plane position, position, direction cosines and optical 
+    path length on the surfaces surfIndices are stored, the rays are 
+    propagated in chunks of chunkSize rays.
+    
+    XYZ,LMN    : numpy.ndarray [i,3], ray position and direction cosines
+    surfIndices: list of surface indices (negative values count from the image)
+    
+    Returns numpy.ndarray [i,9,len(surfIndices)] with [X0,Y0,X,Y,Z,L,M,N,OPL]
+    '''
+    k = len(SurfaceData)
+    surfIndices = [q % k for q in surfIndices]
+    XYZ = numpy.asarray(XYZ,dtype=float).reshape(-1,3)
+    LMN = numpy.asarray(LMN,dtype=float).reshape(-1,3)
+    dList,CList,n = surface_lists(SurfaceData,wvln)
+    Result = numpy.empty([len(XYZ),9,len(surfIndices)])
+    
+    for start in range (0,len(XYZ),chunkSize):
+        chunk = slice(start,start+chunkSize)
+        X,Y,Z = XYZ[chunk].T
+        L,M,N = LMN[chunk].T
+        X0,Y0 = X,Y
+        OPL   = numpy.zeros(len(X))
+        alive = numpy.ones(len(X),dtype=bool)
+        for w in range (0,max(surfIndices)+1):
+            if w > 0:
+                step  = transfer_refract(X,Y,Z,L,M,N,dList[w-1],CList[w],n[w-1],n[w])
+                OPL   = OPL + n[w-1]*((dList[w-1]-Z)/N + step[4])
+                X0,Y0 = step[0:2]
+                X,Y,Z = step[5:8]
+                L,M,N = step[14:17]
+                alive = alive & numpy.isfinite(step[11]) & numpy.isfinite(step[12])
+            for q in [q for q,surfIndex in enumerate(surfIndices) if surfIndex == w]:
+                #Surface not found or ray reflected instead of refracted
+                Result[chunk,:,q] = numpy.where(alive,numpy.array([X0,Y0,X,Y,Z,L,M,N,OPL]),numpy.nan).T
+    
+    return Result
+
 def print_report(RayTrace,info='ray',index=0):
     (i,j,k) = RayTrace.shape
-    if j==24:
+    # j==24: RayTrace without the OPL column (older traces)
+    if j==25 or j==24:
         headers = ["d","c","n","X0","Y0","F","G","Delta","X","Y","Z"
                       ,"check1","alfa","beta","gamma","lambda","cosI","CosIp"
-                      ,"K","L","M","N","Check2","surfType"]
+                      ,"K","L","M","N","Check2","surfType","OPL"][:j]
         if info == 'surf':
             surfInfo= RayTrace[:,:,index].T
             print("\nRAYTRACE REPORT - SURFACE #{:}\n".format(index))
@@ -220,7 +468,7 @@ def print_report(RayTrace,info='ray',index=0):
                 print(str_val)
                 
         if info == 'prop':
-            if index < 24:
+            if index < j:
                 surfInfo= RayTrace[:,index,:]
                 print("\nRAYTRACE REPORT - PROPERTY #{:}\n".format(headers[index]))
                 str_row  = "{: >12} ".format("Ray#\Surf#")
@@ -236,7 +484,7 @@ def print_report(RayTrace,info='ray',index=0):
                         str_val +=  "{:12f} ".format(data)   
                     print(str_val)
             else:
-                raise Warning('Incorrect property index (0-23).')
+                raise Warning('Incorrect property index (0-{:d}).'.format(j-1))
     else:
         raise Warning('The RayTrace has an incorrect shape.')
         
@@ -258,4 +506,13 @@ if __name__ == '__main__':
     
     print_report(trace1)
     print_report(trace1, 'ray',index=4)
+    
+    #Stack of systems with different distance to the image
+    syst2 = OpSysData()
+    syst2.add_surface(10,0.005,'N-BK7')
+    syst2.add_surface(10,5,1.42)
+    syst2.add_surface(12,0.005,'N-K5')
+    d,C,n,surfType = stack_systems([syst1.SurfaceData,syst2.SurfaceData],pto1.RayList)
+    trace2 = trace_systems(pto1.RayList,d,C,n,surfType)
+    print_report(trace2[1], 'prop',index=9)
     
\ No newline at end of file
@@ -2,7 +2,15 @@
 """
 Created on Sat May  2 17:23:54 2020
 @author: David Vasquez
-Function: spot_diagram
+Class:      -SpotData
+            -SpotStatistics
+Functions:  -random_pupil
+            -polar_cells
+            -cell_pupil
+            -stratified_stats
+            -spot_statistics
+            -spot_diagram
+            -plot_spot
 """
 try: import JenTrace
 except ModuleNotFoundError: 
@@ -10,136 +18,360 @@ except ModuleNotFoundError:
     sys.path.insert(0,os.path.dirname(os.getcwd()))
     
 import numpy as np
-import random
 import matplotlib.pyplot as plt
-from JenTrace.ray_trc import trace,print_report
+from scipy.stats import norm
+from JenTrace.ray_trc import trace,trace_surfaces,print_report
 from JenTrace.ray_src import RaySource,PointSource,InfinitySource
 
-def spot_diagram(optDsg, noRays=1000, show=False, plotType ='posXYZ', surfIndex=-1, color='b'):
+class SpotData:
+    '''
+    Rays of a spot diagram, stored as numpy arrays.
+    
+    Attributes:
+        XYZ       : numpy.ndarray [i,3] source position of the rays inside the aperture
+        LMN       : numpy.ndarray [i,3] source direction cosines of the rays
+        Wavelength: wavelength in nm
+        SurfIndex : index of the evaluated surface
+        Position  : numpy.ndarray [i,3] ray position [X,Y,Z] on the surface SurfIndex
+        DirecCos  : numpy.ndarray [i,3] ray direction cosines [L,M,N] after the surface SurfIndex
+        Reference : [x,y] position or direction cosines of the chief ray, see plotType
+        PlotType  : 'posXYZ' or 'cosDir'
+        Pupil     : numpy.ndarray [i,2] normalized aperture stop coordinates [px,py]
+        Weight    : numpy.ndarray [i] pupil area represented by every ray (sum 1),
+                    uniform unless the rays come from an adaptive sampling
+        Statistics: SpotStatistics of an adaptive sampling, otherwise None
+    '''
+    def __init__(self,XYZ,LMN,wvln,surfIndex,position,direcCos,reference,plotType,pupil,weight=None):
+        self.XYZ        = XYZ
+        self.LMN        = LMN
+        self.Wavelength = wvln
+        self.SurfIndex  = surfIndex
+        self.Position   = position
+        self.DirecCos   = direcCos
+        self.Reference  = reference
+        self.PlotType   = plotType
+        self.Pupil      = pupil
+        self.Weight     = weight
+        if weight is None:
+            self.Weight = np.full(len(XYZ),1/max(len(XYZ),1))
+        self.Statistics = None
+    
+    def __len__(self):
+        return len(self.XYZ)
+    
+    @property
+    def RayList(self):
+        '''
+        RayList with the format of RaySource, built on demand
+        '''
+        return [[list(XYZ),list(LMN),self.Wavelength] for XYZ,LMN in zip(self.XYZ.tolist(),self.LMN.tolist())]
+    
+    def points(self):
+        '''
+        Plotted coordinates: XY position (posXYZ) or LM direction cosines (cosDir)
+        '''
+        if self.PlotType == 'cosDir':
+            return self.DirecCos[:,0],self.DirecCos[:,1]
+        return self.Position[:,0],self.Position[:,1]
+    
+    def rms_radius(self):
+        '''
+        RMS radius around the spot centroid
+        '''
+        x,y = self.Position[:,0],self.Position[:,1]
+        xCent = np.average(x,weights=self.Weight)
+        yCent = np.average(y,weights=self.Weight)
+        return np.sqrt(np.average((x-xCent)**2+(y-yCent)**2,weights=self.Weight))
+    
+    def trace(self,SurfaceData):
+        '''
+        Full RayTrace [i,25,k] of the spot rays, intended for small spots
+        '''
+        return trace(self.RayList,SurfaceData)
+
+def random_pupil(noRays,seed=102629122021):
+    '''
+    Random points uniformly distributed in the unit circle (normalized 
+    aperture stop). seed may also be a numpy.random.Generator to draw 
+    successive chunks. Returns px,py numpy.ndarray [noRays]
+    '''
+    rng   = np.random.default_rng(seed)
+    rho   = np.sqrt(rng.random(noRays))
+    theta = 2*np.pi*rng.random(noRays)
+    return rho*np.cos(theta),rho*np.sin(theta)
+
+class SpotStatistics:
+    '''
+    Spot estimates of an adaptive (stratified) sampling, see spot_statistics.
+    
+    Attributes:
+        RMS            : RMS radius around the centroid
+        Centroid       : [x,y] centroid
+        EncircledEnergy: fraction of the pupil area inside the circle of 
+                         radius EERadius around the centroid
+        EERadius       : radius of the encircled energy
+        StdError       : dictionary, standard error of 'RMS', 'CentroidX', 
+                         'CentroidY' and 'EncircledEnergy'
+        Interval       : dictionary, confidence interval (lower, upper) of 'RMS',
+                         'CentroidX', 'CentroidY' and 'EncircledEnergy'
+        Confidence     : confidence level of the intervals
+        RelError       : relative standard error reached. The centroid error 
+                         (radial, both axes) is relative to the RMS radius
+        NoRays         : number of traced rays
+        Rounds         : number of sampling rounds
+        Converged      : True if all the relative errors are below the request
+    '''
+    def __init__(self,estimates,stdError,confidence,noRays,rounds,converged,eeRadius):
+        rms,xCent,yCent,ee = estimates
+        z = norm.ppf(0.5+confidence/2)
+        self.RMS             = rms
+        self.Centroid        = np.array([xCent,yCent])
+        self.EncircledEnergy = ee
+        self.EERadius        = eeRadius
+        keys = ['RMS','CentroidX','CentroidY','EncircledEnergy']
+        self.StdError        = dict(zip(keys,stdError))
+        self.Interval        = {key:(value-z*se,value+z*se) for key,value,se in
+                                zip(keys,estimates,stdError)}
+        self.Confidence      = confidence
+        self.RelError        = {'RMS'            : stdError[0]/rms,
+                                'Centroid'       : np.hypot(stdError[1],stdError[2])/rms,
+                                'EncircledEnergy': stdError[3]/ee if ee > 0 else np.inf}
+        self.NoRays          = noRays
+        self.Rounds          = rounds
+        self.Converged       = converged
+    
+    def print_report(self):
+        print("\nSPOT STATISTICS")
+        print("Rays:      {:d} in {:d} rounds, converged: {}".format(self.NoRays,self.Rounds,self.Converged))
+        headers = ['Estimate','Value','StdError','Lower','Upper']
+        print("{: >16} {: >12} {: >12} {: >12} {: >12} ".format(*headers))
+        rows = [('RMS'           ,self.RMS            ,self.StdError['RMS']),
+                ('CentroidX'     ,self.Centroid[0]    ,self.StdError['CentroidX']),
+                ('CentroidY'     ,self.Centroid[1]    ,self.StdError['CentroidY']),
+                ('EncircledEnergy',self.EncircledEnergy,self.StdError['EncircledEnergy'])]
+        for key,value,se in rows:
+            print("{: >16} {:12f} {:12f} {:12f} {:12f} ".format(key,value,se,*self.Interval[key]))
+        print("Confidence: {:f}, EE radius: {:f}".format(self.Confidence,self.EERadius))
+
+def polar_cells(noRings,noSectors):
+    '''
+    Equal area polar cells of the unit circle. 
+    Returns the cell limits rho0,rho1,theta0,theta1 numpy.ndarray [noRings*noSectors]
+    '''
+    ring,sector = np.divmod(np.arange(noRings*noSectors),noSectors)
+    rho0   = np.sqrt(ring/noRings)
+    rho1   = np.sqrt((ring+1)/noRings)
+    theta0 = 2*np.pi*sector/noSectors
+    theta1 = 2*np.pi*(sector+1)/noSectors
+    return rho0,rho1,theta0,theta1
+
+def cell_pupil(cells,cellIndex,rng):
+    '''
+    Random points uniformly distributed inside the polar cells cellIndex.
+    Returns px,py numpy.ndarray
+    '''
+    rho0,rho1,theta0,theta1 = [limit[cellIndex] for limit in cells]
+    rho   = np.sqrt(rho0**2 + rng.random(len(cellIndex))*(rho1**2-rho0**2))
+    theta = theta0 + rng.random(len(cellIndex))*(theta1-theta0)
+    return rho*np.cos(theta),rho*np.sin(theta)
+
+def stratified_stats(values,cellIndex,noCells,cellWeight=None):
+    '''
+    Stratified estimate of the mean of values [i,q] over the polar cells.
+    cellWeight: [noCells] weight (area) of every cell, equal by default. The 
+                cells without values (vignetted) are left out and the weights 
+                are renormalized by the remaining cells
+    Returns the mean [q], its standard error [q] and the within-cell 
+    standard deviation [noCells,q]
+    '''
+    count = np.bincount(cellIndex,minlength=noCells)
+    used  = count > 0
+    weight= np.where(used,1.0 if cellWeight is None else cellWeight,0.0)
+    weight= weight/weight.sum()
+    n     = np.maximum(count,1)[:,None]
+    mean  = np.stack([np.bincount(cellIndex,v,noCells) for v in values.T],axis=1)/n
+    sqr   = np.stack([np.bincount(cellIndex,v**2,noCells) for v in values.T],axis=1)/n
+    var   = np.maximum(sqr-mean**2,0)*n/np.maximum(n-1,1)
+    return (weight @ mean,
+            np.sqrt(np.sum(weight[:,None]**2*var/n,axis=0)),
+            np.sqrt(var))
+
+def spot_statistics(optDsg, relError=0.01, confidence=0.95, roundRays=1024, 
+                    maxRays=10**6, eeRadius=None, noRings=8, noSectors=16, 
+                    surfIndex=-1, seed=102629122021):
+    '''
+    Adaptive spot statistics: RMS radius, centroid and encircled energy with 
+    their confidence intervals. 
+    
+    The aperture stop is divided in noRings x noSectors equal area cells 
+    (stratified sampling). The rays are traced in rounds; every new round 
+    allocates more rays to the cells where the ray intercepts change faster 
+    (Neyman allocation, proportional to the within-cell standard deviation). 
+    The sampling stops when the relative standard error of all the estimates 
+    is below relError or when maxRays rays are traced.
+    
+    optDsg:     solved optical design
+    relError:   requested relative standard error. The centroid error is 
+                relative to the RMS radius
+    confidence: confidence level of the intervals
+    roundRays:  rays of the first round
+    eeRadius:   encircled energy radius, by default the RMS radius of the 
+                first round
+    
+    Returns SpotStatistics and SpotData with all the traced rays (weighted)
+    '''
+    assert optDsg.dsgSolved, 'The optical design is not solved'
+    SurfaceData = optDsg.optSys.SurfaceData
+    wvln        = optDsg.usrSrc.Wavelength
+    rng         = np.random.default_rng(seed)
+    cells       = polar_cells(noRings,noSectors)
+    noCells     = noRings*noSectors
+    
+    # First round, the same number of rays in every cell (at least two)
+    cellIndex = np.repeat(np.arange(noCells),max(roundRays//noCells,2))
+    pupil,source,surfTrace,cellList = [],[],[],[]
+    rounds = 0
+    while True:
+        px,py   = cell_pupil(cells,cellIndex,rng)
+        XYZ,LMN = optDsg.pupil_source(px,py)
+        pupil.append(np.column_stack([px,py]))
+        source.extend([XYZ,LMN])
+        surfTrace.append(trace_surfaces(XYZ,LMN,wvln,SurfaceData,[surfIndex])[:,:,0])
+        cellList.append(cellIndex)
+        rounds += 1
+        
+        # Rays lost in the system are discarded (vignetted pupil area)
+        allTrace = np.concatenate(surfTrace)
+        allCell  = np.concatenate(cellList)
+        valid    = np.all(np.isfinite(allTrace),axis=1)
+        x,y      = allTrace[valid,2],allTrace[valid,3]
+        cell     = allCell[valid]
+        # Cell weight: unvignetted fraction of the (equal) cell area
+        traced   = np.bincount(allCell,minlength=noCells)
+        area     = np.bincount(cell,minlength=noCells)/np.maximum(traced,1)
+        
+        cent,centSE,centStd = stratified_stats(np.column_stack([x,y]),cell,noCells,area)
+        r2 = (x-cent[0])**2 + (y-cent[1])**2
+        if eeRadius is None:
+            eeRadius = np.sqrt(np.mean(r2))
+        moment,momentSE,_ = stratified_stats(np.column_stack([r2,r2 <= eeRadius**2]),cell,noCells,area)
+        rms  = np.sqrt(moment[0])
+        # Encircled energy: binomial variance of every cell with the fraction
+        # (inside+0.5)/(rays+1), not zero when all the rays of a cell are 
+        # inside (or outside) the circle
+        count  = np.bincount(cell,minlength=noCells)
+        pCell  = (np.bincount(cell,r2 <= eeRadius**2,noCells)+0.5)/(count+1)
+        eeSE   = np.sqrt(np.sum((area/area.sum())**2*pCell*(1-pCell)/np.maximum(count,1)))
+        # Delta method: se(sqrt(m)) = se(m)/(2*sqrt(m))
+        estimates = [rms,cent[0],cent[1],moment[1]]
+        stdError  = [momentSE[0]/(2*rms),centSE[0],centSE[1],max(momentSE[1],eeSE)]
+        stats     = SpotStatistics(estimates,stdError,confidence,len(allCell),rounds,False,eeRadius)
+        worst     = max(stats.RelError.values())
+        # A zero standard error is not a converged estimate
+        if not np.isfinite(worst) or min(stats.RelError.values()) <= 0:
+            worst = np.inf
+        
+        if worst <= relError or len(allCell) >= maxRays:
+            stats.Converged = worst <= relError
+            break
+        
+        # Next round: rays needed for the requested error (se ~ 1/sqrt(n)),
+        # allocated to the cells with the largest intercept spread
+        newRays = int(min(len(allCell)*((worst/relError)**2-1),maxRays-len(allCell)))
+        newRays = max(newRays,min(roundRays,maxRays-len(allCell)))
+        spread  = np.hypot(centStd[:,0],centStd[:,1]) + 1e-12
+        cellIndex = np.repeat(np.arange(noCells),np.floor(newRays*spread/spread.sum()).astype(int))
+    
+    # Ray weight: unvignetted area of its cell divided by its number of rays
+    weight = (area/area.sum())[cell]/count[cell]
+    reference = optDsg.raySrcTrace[0,8:10,surfIndex]
+    spot = SpotData(np.concatenate(source[0::2])[valid],np.concatenate(source[1::2])[valid],
+                    wvln,surfIndex,allTrace[valid,2:5],allTrace[valid,5:8],
+                    reference,'posXYZ',np.concatenate(pupil)[valid],weight)
+    spot.Statistics = stats
+    
+    return stats,spot
+
+def spot_diagram(optDsg, noRays=1000, show=False, plotType ='posXYZ', surfIndex=-1, color='b', relError=None):
     '''
     spot_diagram creates a bunch of rays from the source and porpagate it throw the system. 
-    The rays are filtereed (and discarted) using the ray position in the aperture plane.
+    The rays are uniformly distributed in the aperture stop and mapped to the source with 
+    the pupil map of the optical design (OpDesign.pupil_map), no ray is discarded.
     
-    This function return a RayTrace (sptTrace) where the rays information can be extracted.
+    This function return a SpotData object where the rays information can be extracted.
+    Only the selected surface is stored, so 10^6 rays are possible.
     
     optDsg: optical Design object
-    noRays: Initial number of rays to porpagate. Note that due to the filtering, the final rays are less
+    noRays: Number of rays to porpagate. Only rays lost in the system are discarded
     show: Boolean to show the plot
     plotType: Two types are posible, either the ray position (posXYZ) or ray cosine direction (cosDir) 
     surfIndex: Surface index of the selected plane. By dafault is the image plane selcted
     color: plot color, see Matplotlib.
+    relError: adaptive mode, the number of rays is chosen by spot_statistics to reach this 
+              relative standard error (noRays is ignored), see SpotData.Statistics
     '''
     
     if optDsg.dsgSolved == True:
-        optSys = optDsg.optSys
-        random.seed(102629122021)
-        if isinstance(optDsg.usrSrc,PointSource):
-            usrSrc = optDsg.usrSrc
-            xRad = np.array([usrSrc.RayList[rayIndex][1][0]for rayIndex in range(1,5)])
-            yRad = np.array([usrSrc.RayList[rayIndex][1][1]for rayIndex in range(1,5)])
-            xlim = [xRad.min(),xRad.max()]
-            ylim = [yRad.min(),yRad.max()]
-            
-            # Instantiate sampling (sam) source
-            samSrcXYZ = usrSrc.Position
-            samSrcWvln= usrSrc.Wavelength
-            samSrcLM  =[[random.uniform(xlim[0],xlim[1]),random.uniform(ylim[0],ylim[1])] for q in range(noRays)]
-            
-            LMN     = RaySource.calc_direcCos([samSrcLM[0][0],samSrcLM[0][1],1])
-            samSrc  = RaySource (samSrcXYZ,LMN,samSrcWvln)
-            
-            for LM in samSrcLM [1:]:
-                LMN     = RaySource.calc_direcCos([LM[0],LM[1],1])
-                samSrc.new_ray(samSrcXYZ,LMN,samSrcWvln)
-                
-        if isinstance(optDsg.usrSrc,InfinitySource): 
-            usrSrc = optDsg.usrSrc
-            xRad = np.array([usrSrc.RayList[rayIndex][0][0]for rayIndex in range(1,5)])
-            yRad = np.array([usrSrc.RayList[rayIndex][0][1]for rayIndex in range(1,5)])
-            xlim = [xRad.min(),xRad.max()]
-            ylim = [yRad.min(),yRad.max()]
-            
-            # Instantiate sampling (sam) source
-            samSrcLMN = usrSrc.DirecCos
-            samSrcWvln= usrSrc.Wavelength
-            samSrcXYZ =[[random.uniform(xlim[0],xlim[1]),random.uniform(ylim[0],ylim[1]),0] for q in range(noRays)]
-            
-            samSrc  = RaySource (samSrcXYZ[0],samSrcLMN,samSrcWvln)
-            
-            for XYZ in samSrcXYZ [1:]:
-                samSrc.new_ray(XYZ,samSrcLMN,samSrcWvln)
-            
-        # Make  Trace
-        samTrace = trace(samSrc.RayList,optSys.SurfaceData)
+        SurfaceData = optDsg.optSys.SurfaceData
+        wvln        = optDsg.usrSrc.Wavelength
         
-        # Filter the rays that hit outside the aperture
-        aprRad = optDsg.aprRad
-        aprInd = optDsg.aprInd
-        delInd = []
-        for rayInd in range(len(samSrc.RayList)):
-            # Ray position at aperture plane
-            x = samTrace[rayInd][8][aprInd]
-            y = samTrace[rayInd][9][aprInd]
-            if x**2 + y**2 > aprRad**2:
-                delInd.append(rayInd)
+        # Chiefray is used as the reference point
+        if plotType == 'cosDir':
+            reference = optDsg.raySrcTrace[0,19:21,surfIndex]
+        else:
+            reference = optDsg.raySrcTrace[0,8:10,surfIndex]
         
-        sptTrace = np.delete(samTrace,delInd,0)
-        for index in sorted(delInd, reverse=True):
-            del samSrc.RayList[index]
-
-        if show == True:
-            if plotType =='posXYZ':
-                # Chiefray is used as the reference point
-                xCent = optDsg.raySrcTrace[0][8][surfIndex]
-                yCent = optDsg.raySrcTrace[0][9][surfIndex]
-                # XY positions are stored in x/yPtos
-                xPtos = np.array([sptTrace[q][8][surfIndex] for q in range(len(sptTrace))])
-                yPtos = np.array([sptTrace[q][9][surfIndex] for q in range(len(sptTrace))])
-                # Plot limits
-                xDelt = abs(xPtos.max()-xPtos.min())
-                yDelt = abs(yPtos.max()-yPtos.min())
-                pltlim= np.max([xDelt,yDelt])
-                
-                plt.figure()
-                plt.plot(xPtos,yPtos,'o',markersize=1,color=color)
-                plt.plot(xCent,yCent,'kx')
-                plt.xlim(xCent-pltlim,xCent+pltlim)
-                plt.ylim(yCent-pltlim,yCent+pltlim)
-                plt.axis('equal')
-                plt.grid('on')
-                plt.xlabel('x[mm]')
-                plt.ylabel('y[mm]')
-                plt.show()
+        if relError is not None:
+            stats,spot = spot_statistics(optDsg,relError=relError,surfIndex=surfIndex)
+            spot.Reference = reference
+            spot.PlotType  = plotType
+        else:
+            # Exactly noRays in the aperture stop, mapped to the source by the pupil map
+            px,py   = random_pupil(noRays)
+            XYZ,LMN = optDsg.pupil_source(px,py)
+            surfTrace = trace_surfaces(XYZ,LMN,wvln,SurfaceData,[surfIndex])[:,:,0]
+            
+            # Rays lost in the system (surface not found or reflected) are discarded
+            valid = np.all(np.isfinite(surfTrace),axis=1)
             
-            if plotType =='cosDir':
-                # Chiefray is used as the reference point
-                xCent = optDsg.raySrcTrace[0][19][surfIndex]
-                yCent = optDsg.raySrcTrace[0][20][surfIndex]
-                # XY positions are stored in x/yPtos
-                xPtos = np.array([sptTrace[q][19][surfIndex] for q in range(len(sptTrace))])
-                yPtos = np.array([sptTrace[q][20][surfIndex] for q in range(len(sptTrace))])
-                # Plot limits
-                xDelt = abs(xPtos.max()-xPtos.min())
-                yDelt = abs(yPtos.max()-yPtos.min())
-                pltlim= np.max([xDelt,yDelt])
-                
-                plt.figure()
-                plt.plot(xPtos,yPtos,'o',markersize=1,color=color)
-                plt.plot(xCent,yCent,'kx')
-                plt.xlim(xCent-pltlim,xCent+pltlim)
-                plt.ylim(yCent-pltlim,yCent+pltlim)
-                plt.axis('equal')
-                plt.grid('on')
-                plt.xlabel('cosDir_x[rad]')
-                plt.ylabel('cosDir_y[rad]')
-                plt.show()
+            spot = SpotData(XYZ[valid],LMN[valid],wvln,surfIndex,
+                            surfTrace[valid,2:5],surfTrace[valid,5:8],
+                            reference,plotType,np.column_stack([px,py])[valid])
         
+        if show == True:
+            plot_spot(spot,color)
         
-        return samSrc,sptTrace
+        return spot
+
+def plot_spot(spot,color='b'):
+    '''
+    Plots a SpotData object around its reference (chief) ray
+    '''
+    xCent,yCent = spot.Reference
+    xPtos,yPtos = spot.points()
+    # Plot limits
+    xDelt = abs(np.nanmax(xPtos)-np.nanmin(xPtos))
+    yDelt = abs(np.nanmax(yPtos)-np.nanmin(yPtos))
+    pltlim= np.max([xDelt,yDelt])
+    
+    plt.figure()
+    plt.plot(xPtos,yPtos,'o',markersize=1,color=color)
+    plt.plot(xCent,yCent,'kx')
+    plt.xlim(xCent-pltlim,xCent+pltlim)
+    plt.ylim(yCent-pltlim,yCent+pltlim)
+    plt.axis('equal')
+    plt.grid('on')
+    if spot.PlotType == 'cosDir':
+        plt.xlabel('cosDir_x[rad]')
+        plt.ylabel('cosDir_y[rad]')
+    else:
+        plt.xlabel('x[mm]')
+        plt.ylabel('y[mm]')
+    plt.show()
         
 if __name__ == '__main__':
-    from opt_sys import OpSysData
-    from opt_dsg import OpDesign
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.opt_dsg import OpDesign
     
     # Instantiate optical system
     syst1 = OpSysData()
@@ -162,16 +394,46 @@ if __name__ == '__main__':
     
     # plot design
     design1.plot_design(clearSemDia)
-    samSrc1,samTrace1 = spot_diagram(design1,show=True)
+    spot1 = spot_diagram(design1,show=True)
     
     # Instantiate infinity source
     pto2    = InfinitySource(RaySource.calc_direcCos([+0.0,-0.4,1.0]), 635)
     design2 = OpDesign(pto2, syst1)
     design2.autofocus()
     design2.plot_design(clearSemDia)
-    samSrc2,samTrace2 = spot_diagram(design2,show=True)
+    spot2 = spot_diagram(design2,show=True)
+    
+    print_report(spot2.trace(syst1.SurfaceData))
+    
+    # Large spot diagram
+    spot3 = spot_diagram(design1,noRays=1000000)
+    print(len(spot3), spot3.rms_radius())
     
-    print_report(samTrace2)
+    # Adaptive spot statistics, 0.5% relative standard error
+    stats1,spot4 = spot_statistics(design1,relError=0.005)
+    stats1.print_report()    
+    # Vignetting: stratified estimate on a pupil cut at px = 0.5 (empty and 
+    # partly vignetted cells), against a dense uniform sample
+    rng   = np.random.default_rng(1)
+    cells = polar_cells(8,16)
+    cellIndex = np.repeat(np.arange(128),200)
+    px,py = cell_pupil(cells,cellIndex,rng)
+    valid = px < 0.5
+    area  = np.bincount(cellIndex[valid],minlength=128)/np.bincount(cellIndex,minlength=128)
+    mean,se,_ = stratified_stats(np.column_stack([px**2+py])[valid],cellIndex[valid],128,area)
+    dense = rng.uniform(-1,1,(10**6,2))
+    dense = dense[(np.hypot(*dense.T) <= 1) & (dense[:,0] < 0.5)]
+    exact = np.mean(dense[:,0]**2+dense[:,1])
+    print('Vignetted pupil: {:f} +- {:f}, dense: {:f}'.format(mean[0],se[0],exact))
+    assert abs(mean[0]-exact) < 4*se[0] + 1e-3, 'Biased stratified estimate'
     
-    #print_report(samTrace2, 'prop',index=8)
-    #print_report(samTrace2, 'prop',index=9)
\ No newline at end of file
+    # Vignetted design: surface R=2 after the aperture stop
+    syst2 = OpSysData()
+    syst2.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst2.add_surface   (1.0    ,0         ,1      )
+    syst2.add_surface   (3.5    ,1/2.0     ,'N-BK7')
+    syst2.add_surface   (40     ,-1/15     ,1      )
+    design3 = OpDesign(PointSource([0,3,0],587.6),syst2,aprRad=1.9)
+    stats3,spot5 = spot_statistics(design3,relError=0.01)
+    stats3.print_report()
+    assert np.isclose(spot5.Weight.sum(),1) and np.isfinite(stats3.RMS), 'Vignetted spot statistics'
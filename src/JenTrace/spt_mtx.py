@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Field x wavelength spot diagram matrix
+Class:      -SpotMatrix
+functions:  -spot_matrix
+
+All the field/wavelength combinations are aimed (aim_fields) and traced in one
+batch, no OpDesign is built per cell.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+import matplotlib.pyplot as plt
+from JenTrace.ray_src import PointSource, InfinitySource
+from JenTrace.mrt_fnc import aim_fields, trace_indices, field_label
+from JenTrace.spt_dgm import random_pupil
+
+class SpotMatrix:
+    '''
+    Spot diagrams of F fields and W wavelengths.
+
+    Attributes:
+        Fields       : list of PointSource/InfinitySource, field definitions
+        Wavelengths  : list of wavelengths in nm
+        Pupil        : numpy array [N,2], normalized aperture stop coordinates
+        X,Y          : numpy arrays [F,W,N], ray positions on the surface
+                       (numpy.nan: ray lost)
+        Chief        : numpy array [F,W,2], chief ray position on the surface
+        AimError     : numpy array [F,W,N+1], aperture stop error of the
+                       aimed rays (index 0: chief ray)
+        RMS          : numpy array [F,W], RMS radius around the centroid
+        GEO          : numpy array [F,W], maximum radius around the centroid
+        Centroid     : numpy array [F,W,2], [x,y] centroid
+        CentroidShift: numpy array [F,W,2], centroid minus chief ray position
+    '''
+    def __init__(self,fields,wavelengths,pupil,X,Y,chief,aimError):
+        self.Fields      = fields
+        self.Wavelengths = wavelengths
+        self.Pupil       = pupil
+        self.X           = X
+        self.Y           = Y
+        self.Chief       = chief
+        self.AimError    = aimError
+        with np.errstate(invalid='ignore'):
+            self.Centroid = np.stack([np.nanmean(X,axis=2),np.nanmean(Y,axis=2)],axis=2)
+            r2 = ((X-self.Centroid[:,:,0,None])**2 + (Y-self.Centroid[:,:,1,None])**2)
+            self.RMS = np.sqrt(np.nanmean(r2,axis=2))
+            self.GEO = np.sqrt(np.nanmax(r2,axis=2))
+        self.CentroidShift = self.Centroid - chief
+
+    def field_label(self,fieldIndex):
+        return field_label(self.Fields[fieldIndex])
+
+    def plot(self,colors=None):
+        '''
+        Plots the whole matrix in one figure: one row per field, one column per
+        wavelength. Every spot is centered on its chief ray and all the cells
+        share the same scale.
+        '''
+        F,W = self.RMS.shape
+        if colors is None:
+            colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        pltlim = np.nanmax(self.GEO + np.hypot(*np.moveaxis(self.CentroidShift,2,0)))
+        fig, axes = plt.subplots(F,W,squeeze=False,sharex=True,sharey=True,
+                                 figsize=(2.2*W,2.2*F))
+        for f in range(F):
+            for w in range(W):
+                ax = axes[f,w]
+                ax.plot(self.X[f,w]-self.Chief[f,w,0],self.Y[f,w]-self.Chief[f,w,1],'o',
+                        markersize=1,color=colors[w % len(colors)])
+                ax.plot(0,0,'kx')
+                ax.set_xlim(-pltlim,pltlim)
+                ax.set_ylim(-pltlim,pltlim)
+                ax.set_aspect('equal')
+                ax.grid('on')
+                ax.set_title('{} {:g}nm\nRMS={:.3g}mm'.format(self.field_label(f),
+                             self.Wavelengths[w],self.RMS[f,w]),fontsize=8)
+        for ax in axes[-1,:]:
+            ax.set_xlabel('x[mm]')
+        for ax in axes[:,0]:
+            ax.set_ylabel('y[mm]')
+        fig.tight_layout()
+        return fig, axes
+
+    def print_report(self):
+        headers = ['Field','Wvln','RMS','GEO','ShiftX','ShiftY']
+        print("\nSPOT MATRIX")
+        print("{: >14} {: >8} {: >12} {: >12} {: >12} {: >12} ".format(*headers))
+        for f in range(len(self.Fields)):
+            for w in range(len(self.Wavelengths)):
+                print("{: >14} {: 8.1f} {:12f} {:12f} {:12f} {:12f} ".format(
+                      self.field_label(f),self.Wavelengths[w],self.RMS[f,w],
+                      self.GEO[f,w],*self.CentroidShift[f,w]))
+
+def spot_matrix(fields,wavelengths,optSys,aprRad=1.0,aprInd=1,noRays=500,
+                surfIndex=-1,show=False):
+    '''
+    Spot diagram matrix of all the field/wavelength combinations.
+
+    fields:      list of PointSource (field position) or InfinitySource (field
+                 direction). The wavelength of the sources is not used
+    wavelengths: list of wavelengths in nm
+    optSys:      optical system (OpSysData)
+    aprRad:      aperture stop radius
+    aprInd:      aperture stop index
+    noRays:      rays per cell, the same pupil points are used in every cell
+    surfIndex:   evaluated surface, by default the image plane
+    show:        plot the matrix
+
+    Returns a SpotMatrix
+    '''
+    SurfaceData = optSys.SurfaceData
+    k = len(SurfaceData)
+    F,W = len(fields),len(wavelengths)
+
+    # Pupil targets, the chief ray (0,0) first
+    px,py  = random_pupil(noRays)
+    pupil  = np.column_stack([px,py])
+    target = np.vstack([[0,0],pupil])
+    R      = noRays+1
+
+    # Rays ordered as [field, wavelength, pupil]
+    XYZ,LMN,n,aimError = aim_fields(fields,wavelengths,SurfaceData,aprRad,aprInd,target)
+    X,Y = trace_indices(XYZ,LMN,n,SurfaceData,surfIndex)[2:4]
+
+    X        = X.reshape(F,W,R)
+    Y        = Y.reshape(F,W,R)
+    chief    = np.stack([X[:,:,0],Y[:,:,0]],axis=2)
+    spotMtx  = SpotMatrix(fields,list(wavelengths),pupil,X[:,:,1:],Y[:,:,1:],
+                          chief,aimError.reshape(F,W,R))
+    if show:
+        spotMtx.plot()
+        plt.show()
+
+    return spotMtx
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (39.68  ,1/-31.47  ,1      )
+
+    fields      = [PointSource([0,Y,0],587.6) for Y in np.linspace(0,5,7)]
+    wavelengths = [486.1,587.6,656.3]
+
+    start  = time.time()
+    spots1 = spot_matrix(fields,wavelengths,syst1,aprRad=2,noRays=500)
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    print('Max aim error: {:e} mm'.format(spots1.AimError.max()))
+    spots1.print_report()
+    spots1.plot()
+    plt.show()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar surface data
+Class:      -SurfaceTable
+            -SurfaceRow
+functions:  -surface_columns
+
+SurfaceTable stores the surfaces [d,C,n,surfType] of an optical system as
+contiguous d/C arrays, an interned material index array and a surface type
+code array. It keeps the list interface of SurfaceData (SurfaceData[w][0],
+insert, del, slices, iteration), so the code written for lists of
+[d,C,n,surfType] works unchanged, while the trace engine reads the arrays
+and the cached refraction index columns without any per-call conversion.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+from JenTrace.catalog import refraction_index, refraction_index_array
+
+'''
+Surface type code stored in the SurfaceTable and the RayTrace (0: unknown)
+'''
+SURF_TYPE_CODE = {'standard':1, 'paraxial':2, 'grin':3}
+SURF_TYPE_NAME = {code:name for name,code in SURF_TYPE_CODE.items()}
+
+class SurfaceRow:
+    '''
+    View of the row w of a SurfaceTable as [d,C,n,surfType]. Item
+    assignments are written in the table.
+    '''
+    __slots__ = ('table','w')
+
+    def __init__(self,table,w):
+        self.table = table
+        self.w     = w
+
+    def __getitem__(self,j):
+        return self.table.row(self.w)[j]
+
+    def __setitem__(self,j,value):
+        row    = self.table.row(self.w)
+        row[j] = value
+        self.table[self.w] = row
+
+    def __iter__(self):
+        return iter(self.table.row(self.w))
+
+    def __len__(self):
+        return 4
+
+    def __eq__(self,other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(self.table.row(self.w))
+
+class SurfaceTable:
+    '''
+    Columnar SurfaceData, list-like container of [d,C,n,surfType] rows.
+
+    Attributes:
+        d        : numpy array [k], distances in mm (contiguous)
+        C        : numpy array [k], curvatures in 1/mm (contiguous)
+        material : numpy array [k] int, index of the material in Materials
+        surfType : numpy array [k] int, SURF_TYPE_CODE
+        Materials: list of the interned materials (refraction index or glass
+                   name) in use, shared by all the surfaces with the same 
+                   material. A material is released when its last surface 
+                   changes, so the list does not grow with the edits
+        Cache    : refraction index columns per wavelength, cleared by every
+                   change of the table. Assignments made directly on the
+                   arrays must call changed()
+    '''
+    def __init__(self,rows=()):
+        self.set_rows(rows)
+
+    def set_rows(self,rows):
+        '''
+        Replaces all the surfaces, rows: list of [d,C,n,surfType]
+        '''
+        rows = [list(row) for row in rows]
+        self.Materials   = []
+        self.MaterialKey = {}
+        self.d        = np.array([row[0] for row in rows],dtype=float)
+        self.C        = np.array([row[1] for row in rows],dtype=float) + 0.0 # no -0.0
+        self.material = np.array([self.intern(row[2]) for row in rows],dtype=int)
+        self.surfType = np.array([SURF_TYPE_CODE.get(row[3],0) for row in rows],dtype=int)
+        self.changed()
+
+    @classmethod
+    def from_columns(cls,d,C,Materials,material,surfType):
+        '''
+        SurfaceTable built directly from its columns (e.g. a saved system),
+        Materials is the list of the interned materials
+        '''
+        table = cls()
+        table.d        = np.array(d,dtype=float)
+        table.C        = np.array(C,dtype=float)
+        table.material = np.array(material,dtype=int)
+        table.surfType = np.array(surfType,dtype=int)
+        assert len(table.d) == len(table.C) == len(table.material) == len(table.surfType), \
+            'All the surface columns must have the same length'
+        for m in Materials:
+            table.intern(m)
+        assert len(table.Materials) == len(Materials), 'Repeated material in Materials'
+        assert np.all((table.material >= 0) & (table.material < len(Materials))), \
+            'Invalid material index'
+        for m in range(len(Materials)-1,-1,-1):
+            table.release(m)
+        return table
+
+    def intern(self,material):
+        '''
+        Index of the material in Materials, appended if it is new. The type
+        is part of the key, 1 and 1.0 are kept as different references
+        '''
+        key = (type(material),material)
+        if key not in self.MaterialKey:
+            self.MaterialKey[key] = len(self.Materials)
+            self.Materials.append(material)
+        return self.MaterialKey[key]
+
+    def release(self,m):
+        '''
+        Removes the material m from Materials if no surface references it,
+        the last material takes its index
+        '''
+        if np.any(self.material == m):
+            return
+        last = len(self.Materials)-1
+        del self.MaterialKey[(type(self.Materials[m]),self.Materials[m])]
+        if m != last:
+            moved = self.Materials[last]
+            self.Materials[m] = moved
+            self.MaterialKey[(type(moved),moved)] = m
+            self.material[self.material == last] = m
+        self.Materials.pop()
+
+    def changed(self):
+        self.Cache = {}
+
+    def row(self,w):
+        '''
+        Surface w as a new list [d,C,n,surfType]
+        '''
+        return [float(self.d[w]),float(self.C[w]),self.Materials[self.material[w]],
+                SURF_TYPE_NAME.get(int(self.surfType[w]),'standard')]
+
+    def tolist(self):
+        return [self.row(w) for w in range(len(self.d))]
+
+    def __len__(self):
+        return len(self.d)
+
+    def __iter__(self):
+        return (SurfaceRow(self,w) for w in range(len(self.d)))
+
+    def __getitem__(self,w):
+        if isinstance(w,slice):
+            return self.tolist()[w]
+        if w < -len(self.d) or w >= len(self.d):
+            raise IndexError('surface index out of range')
+        return SurfaceRow(self,w % len(self.d))
+
+    def __setitem__(self,w,row):
+        if isinstance(w,slice):
+            rows    = self.tolist()
+            rows[w] = [list(surf) for surf in row]
+            self.set_rows(rows)
+            return
+        d,C,n,surfType  = row
+        old              = self.material[w]
+        self.d[w]        = d
+        self.C[w]        = C + 0.0
+        self.material[w] = self.intern(n)
+        self.surfType[w] = SURF_TYPE_CODE.get(surfType,0)
+        if self.material[w] != old:
+            self.release(old)
+        self.changed()
+
+    def __delitem__(self,w):
+        rows = self.tolist()
+        del rows[w]
+        self.set_rows(rows)
+
+    def insert(self,w,row):
+        rows = self.tolist()
+        rows.insert(w,list(row))
+        self.set_rows(rows)
+
+    def append(self,row):
+        self.insert(len(self.d),row)
+
+    def __eq__(self,other):
+        return self.tolist() == [list(row) for row in other]
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def columns(self,wvln):
+        '''
+        Python float lists d [k], C [k] and n [k] at the wavelength wvln in
+        nm, cached for the scalar ray traces
+        '''
+        key = ('columns',float(wvln))
+        if key not in self.Cache:
+            n = [refraction_index(material,wvln) for material in self.Materials]
+            self.Cache[key] = (self.d.tolist(),self.C.tolist(),
+                               [n[m] for m in self.material.tolist()])
+        return self.Cache[key]
+
+    def index_array(self,wavelengths):
+        '''
+        Refraction indices of the surfaces, numpy array [k,W] (cached). The
+        indices of the interned materials are computed in one array call
+        '''
+        wavelengths = np.atleast_1d(np.asarray(wavelengths,dtype=float))
+        key = ('index',wavelengths.tobytes())
+        if key not in self.Cache:
+            self.Cache[key] = refraction_index_array(self.Materials,wavelengths)[self.material]
+        return self.Cache[key]
+
+def surface_columns(SurfaceData):
+    '''
+    d [k], C [k] (numpy arrays), materials [k] (list) and surface type codes
+    [k] of a SurfaceTable (no conversion) or of a list of [d,C,n,surfType]
+    '''
+    if isinstance(SurfaceData,SurfaceTable):
+        return (SurfaceData.d,SurfaceData.C,
+                [SurfaceData.Materials[m] for m in SurfaceData.material.tolist()],
+                SurfaceData.surfType)
+    return (np.array([surf[0] for surf in SurfaceData],dtype=float),
+            np.array([surf[1] for surf in SurfaceData],dtype=float),
+            [surf[2] for surf in SurfaceData],
+            np.array([SURF_TYPE_CODE.get(surf[3],0) for surf in SurfaceData],dtype=int))
+
+
+if __name__ == '__main__':
+    table1 = SurfaceTable([[60,0,1,'standard'],[3.5,1/15.37,'N-BK7','standard'],
+                           [0,0,1,'standard']])
+    table1.insert(2,[1.5,1/-11.10,'N-SF5','standard'])
+    table1[-2][0] = 1.6
+    print(table1)
+    print(table1.d,table1.C,table1.material,table1.Materials,table1.surfType)
+    print(table1.columns(587.6))
+    print(table1.index_array([486.1,587.6,656.3]))
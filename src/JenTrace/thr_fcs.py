@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Through-focus analysis from a single trace
+Class:      -ThroughFocus
+functions:  -focus_rays
+            -defocus_intercepts
+            -best_focus
+            -through_focus
+            -field_curvature
+
+The rays are traced once. The position and direction cosines on the last
+surface define the intercepts on any plane z = dz (measured from the vertex
+of that surface), so no change_surface + trace cycle is needed.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+import matplotlib.pyplot as plt
+from JenTrace.spt_dgm import SpotData, spot_diagram
+
+class ThroughFocus:
+    '''
+    Spot statistics against the defocus.
+
+    Attributes:
+        Defocus        : numpy array [D], defocus distances (mm)
+        RMS            : numpy array [D], RMS radius around the centroid
+        Centroid       : numpy array [D,2], [x,y] centroid
+        EERadius       : numpy array [R], encircled energy radii
+        EncircledEnergy: numpy array [D,R], fraction of rays inside EERadius
+        BestFocus      : defocus of the minimum RMS radius (closed form)
+        MinRMS         : RMS radius at BestFocus
+    '''
+    def __init__(self,defocus,rms,centroid,eeRadius,encircledEnergy,bestFocus,minRMS):
+        self.Defocus         = defocus
+        self.RMS             = rms
+        self.Centroid        = centroid
+        self.EERadius        = eeRadius
+        self.EncircledEnergy = encircledEnergy
+        self.BestFocus       = bestFocus
+        self.MinRMS          = minRMS
+
+    def depth_of_focus(self,maxRMS=None):
+        '''
+        Defocus range (lower, upper) around the best focus where the RMS radius
+        is below maxRMS (by default sqrt(2) times the minimum RMS radius).
+        Returns numpy.nan limits if the range is not inside Defocus.
+        '''
+        if maxRMS is None:
+            maxRMS = np.sqrt(2)*self.MinRMS
+        inside = self.RMS <= maxRMS
+        best   = np.argmin(self.RMS)
+        if not inside[best]:
+            return np.nan,np.nan
+        # Contiguous interval around the minimum, linear interpolation of the limits
+        lower = best
+        while lower > 0 and inside[lower-1]:
+            lower -= 1
+        upper = best
+        while upper < len(inside)-1 and inside[upper+1]:
+            upper += 1
+        limits = []
+        for edge,step in ((lower,-1),(upper,+1)):
+            out = edge + step
+            if out < 0 or out >= len(inside):
+                limits.append(np.nan)
+                continue
+            t = (maxRMS-self.RMS[edge])/(self.RMS[out]-self.RMS[edge])
+            limits.append(float(self.Defocus[edge] + t*(self.Defocus[out]-self.Defocus[edge])))
+        return tuple(limits)
+
+    def plot(self,color='b'):
+        fig, ax = plt.subplots()
+        ax.plot(self.Defocus,self.RMS,color=color)
+        ax.axvline(self.BestFocus,color='k',linestyle='--')
+        ax.grid('on')
+        ax.set_xlabel('defocus[mm]')
+        ax.set_ylabel('RMS radius[mm]')
+        return fig, ax
+
+    def print_report(self):
+        print("\nTHROUGH FOCUS")
+        print("Best focus: {:f} mm, RMS radius: {:f} mm".format(self.BestFocus,self.MinRMS))
+        print("Depth of focus: ({:f}, {:f}) mm".format(*self.depth_of_focus()))
+        headers = ['Defocus','RMS','CentroidX','CentroidY']
+        print("{: >12} {: >12} {: >12} {: >12} ".format(*headers))
+        for q in range(len(self.Defocus)):
+            print("{:12f} {:12f} {:12f} {:12f} ".format(
+                  self.Defocus[q],self.RMS[q],*self.Centroid[q]))
+
+def focus_rays(source,surfIndex=-1):
+    '''
+    Position [i,3], direction cosines [i,3] and weight [i] of the rays on the
+    surface surfIndex. source is a SpotData (its own surface is used) or a
+    RayTrace numpy array [i,25,k]. Lost rays are removed.
+    '''
+    if isinstance(source,SpotData):
+        XYZ,LMN,weight = source.Position,source.DirecCos,source.Weight
+    else:
+        XYZ = source[:,8:11,surfIndex]
+        LMN = source[:,19:22,surfIndex]
+        weight = np.ones(len(XYZ))
+    valid = np.all(np.isfinite(XYZ),axis=1) & np.all(np.isfinite(LMN),axis=1)
+    return XYZ[valid],LMN[valid],weight[valid]/weight[valid].sum()
+
+def defocus_intercepts(XYZ,LMN,dz):
+    '''
+    Ray intercepts on the planes z = dz.
+    XYZ,LMN: numpy arrays [i,3], dz: numpy array [D]
+    Returns x,y numpy arrays [D,i]
+    '''
+    dz = np.atleast_1d(np.asarray(dz,dtype=float))
+    t  = (dz[:,None] - XYZ[:,2])/LMN[:,2]
+    return XYZ[:,0] + LMN[:,0]*t, XYZ[:,1] + LMN[:,1]*t
+
+def best_focus(XYZ,LMN,weight=None,axis='xy'):
+    '''
+    Defocus of the minimum RMS spot in closed form, RMS(dz)^2 is quadratic in
+    dz. axis='xy' (RMS radius), 'x' (sagittal) or 'y' (tangential) spread.
+    Returns the defocus and the minimum RMS value.
+    '''
+    if weight is None:
+        weight = np.full(len(XYZ),1/len(XYZ))
+    # Intercepts on the plane z = 0: u = u0 + a*dz
+    u0 = XYZ[:,0:2] - LMN[:,0:2]*(XYZ[:,2]/LMN[:,2])[:,None]
+    a  = LMN[:,0:2]/LMN[:,2,None]
+    cols = {'xy':[0,1],'x':[0],'y':[1]}[axis]
+    u0 = u0[:,cols] - np.average(u0[:,cols],axis=0,weights=weight)
+    a  = a[:,cols]  - np.average(a[:,cols],axis=0,weights=weight)
+    dz  = -np.sum(weight[:,None]*u0*a)/np.sum(weight[:,None]*a**2)
+    rms = np.sqrt(np.sum(weight[:,None]*(u0+a*dz)**2))
+    return dz,rms
+
+def through_focus(source,defocus,eeRadius=None,surfIndex=-1,chunkSize=64):
+    '''
+    Through-focus RMS radius, centroid and encircled energy from one trace.
+
+    source:    SpotData or RayTrace [i,25,k], see focus_rays
+    defocus:   numpy array [D], image plane positions relative to the surface
+               (mm). Hundreds of planes are evaluated as one broadcast, in
+               chunks of chunkSize planes
+    eeRadius:  encircled energy radius or list of radii [R], by default the
+               minimum RMS radius
+    Returns a ThroughFocus
+    '''
+    XYZ,LMN,weight = focus_rays(source,surfIndex)
+    defocus = np.atleast_1d(np.asarray(defocus,dtype=float))
+    dzBest,minRMS = best_focus(XYZ,LMN,weight)
+    if eeRadius is None:
+        eeRadius = minRMS
+    eeRadius = np.atleast_1d(np.asarray(eeRadius,dtype=float))
+
+    D = len(defocus)
+    rms      = np.empty(D)
+    centroid = np.empty([D,2])
+    ee       = np.empty([D,len(eeRadius)])
+    for start in range(0,D,chunkSize):
+        chunk = slice(start,start+chunkSize)
+        x,y   = defocus_intercepts(XYZ,LMN,defocus[chunk])
+        xCent = x @ weight
+        yCent = y @ weight
+        r2    = (x-xCent[:,None])**2 + (y-yCent[:,None])**2
+        rms[chunk]      = np.sqrt(r2 @ weight)
+        centroid[chunk] = np.column_stack([xCent,yCent])
+        ee[chunk]       = (r2[:,:,None] <= eeRadius**2).transpose(0,2,1) @ weight
+
+    return ThroughFocus(defocus,rms,centroid,eeRadius,ee,dzBest,minRMS)
+
+def field_curvature(designs,noRays=1000,surfIndex=-1):
+    '''
+    Best focus of every design (one per field) from a single spot trace per
+    field: RMS radius, sagittal (x) and tangential (y) best focus.
+
+    designs: list of solved OpDesign
+    Returns numpy arrays [F]: field (y position of the chief ray on the
+    surface), best focus, sagittal focus and tangential focus
+    '''
+    field   = np.empty(len(designs))
+    focus   = np.empty([len(designs),3])
+    for q,optDsg in enumerate(designs):
+        spot = spot_diagram(optDsg,noRays=noRays,surfIndex=surfIndex)
+        XYZ,LMN,weight = focus_rays(spot)
+        field[q] = optDsg.raySrcTrace[0,9,surfIndex]
+        focus[q] = [best_focus(XYZ,LMN,weight,axis)[0] for axis in ('xy','x','y')]
+    return field,focus[:,0],focus[:,1],focus[:,2]
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import PointSource
+    from JenTrace.opt_dsg import OpDesign
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (40     ,1/-31.47  ,1      )
+
+    design1 = OpDesign(PointSource([0,2.5,0],635),syst1,aprRad=2)
+    spot1   = spot_diagram(design1,noRays=20000)
+
+    start = time.time()
+    focus1 = through_focus(spot1,np.linspace(-1,1,401),eeRadius=[0.005,0.01,0.02])
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    print("Best focus: {:f} mm, depth of focus: {}".format(focus1.BestFocus,focus1.depth_of_focus()))
+    focus1.plot()
+
+    designs = [OpDesign(PointSource([0,Y,0],635),syst1,aprRad=2) for Y in (0.0,2.5,5.0)]
+    field,best,sag,tan = field_curvature(designs)
+    print(np.column_stack([field,best,sag,tan]))
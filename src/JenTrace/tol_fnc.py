@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo tolerancing
+Class:      -ToleranceReport
+functions:  -perturbed_systems
+            -trace_stack
+            -spot_criterion
+            -monte_carlo_tolerance
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import numpy as np
+from JenTrace.catalog import refraction_index
+from JenTrace.ray_trc import transfer_refract
+from JenTrace.spt_dgm import spot_diagram
+
+'''
+Tolerance parameters
+    'R': radius (mm)
+    'C': curvature (1/mm)
+    'd': distance to the next surface (mm)
+    'n': refraction index of the medium after the surface (-)
+'''
+TOL_PARAMS = {'R','C','d','n'}
+
+class ToleranceReport:
+    '''
+    Results of a Monte Carlo tolerance analysis.
+
+    Attributes:
+        Tolerances  : list of tuples, (param, surfIndex, tolerance)
+        Nominal     : criterion value of the nominal design
+        Criterion   : numpy array [noTrials], criterion value of every trial
+        Perturbation: numpy array [noTrials, P], perturbation of every parameter
+        FocusShift  : numpy array [noTrials], compensator (image distance) shift
+        Spec        : criterion upper limit used for the yield
+        Yield       : fraction of trials with Criterion <= Spec
+        Sensitivity : numpy array [P, 2], criterion change with only one
+                      parameter at -tolerance and +tolerance
+        Slope       : numpy array [P], linear regression of the criterion
+                      against every parameter perturbation
+    '''
+    def __init__(self,tolerances,nominal,criterion,perturbation,focusShift,
+                 sensitivity,spec=None):
+        self.Tolerances   = tolerances
+        self.Nominal      = nominal
+        self.Criterion    = criterion
+        self.Perturbation = perturbation
+        self.FocusShift   = focusShift
+        self.Sensitivity  = sensitivity
+        self.Spec         = spec
+        self.Yield        = np.nan
+        if spec is not None:
+            self.Yield = np.mean(criterion <= spec)
+        # Linear sensitivity from the Monte Carlo sample
+        valid = np.isfinite(criterion)
+        A     = np.column_stack([np.ones(valid.sum()),perturbation[valid]])
+        coef  = np.linalg.lstsq(A,criterion[valid],rcond=None)[0]
+        self.Slope = coef[1:]
+
+    def percentile(self,q):
+        return np.nanpercentile(self.Criterion,q)
+
+    def print_report(self):
+        print("\nTOLERANCE REPORT")
+        print("Trials:    {:d}".format(len(self.Criterion)))
+        print("Nominal:   {:12f}".format(self.Nominal))
+        print("Mean:      {:12f}".format(np.nanmean(self.Criterion)))
+        print("Std:       {:12f}".format(np.nanstd(self.Criterion)))
+        for q in (50,90,97.7):
+            print("P{: <8} {:12f}".format(q,self.percentile(q)))
+        if self.Spec is not None:
+            print("Yield:     {:12f} (criterion <= {:f})".format(self.Yield,self.Spec))
+        headers = ['Param','Surf','Tolerance','-Tol','+Tol','Slope']
+        print("\n{: >5} {: >5} {: >12} {: >12} {: >12} {: >12} ".format(*headers))
+        for q,(param,surfIndex,tol) in enumerate(self.Tolerances):
+            print("{: >5} {: 5d} {:12f} {:12f} {:12f} {:12f} ".format(
+                  param,surfIndex,tol,*self.Sensitivity[q],self.Slope[q]))
+
+def perturbed_systems(SurfaceData,wvln,tolerances,perturbation):
+    '''
+    Builds the stacked arrays d, C, n [S, k] of the perturbed systems.
+
+    SurfaceData : list of lists, (d,C,n,surfType) of the nominal system
+    wvln        : wavelength in nm, used for the glass materials
+    tolerances  : list of tuples, (param, surfIndex, tolerance)
+    perturbation: numpy array [S, P], perturbation of every parameter
+    '''
+    S = perturbation.shape[0]
+    d = np.tile([surf[0] for surf in SurfaceData],(S,1)).astype(float)
+    C = np.tile([surf[1] for surf in SurfaceData],(S,1)).astype(float)
+    n = np.tile([refraction_index(surf[2],wvln) for surf in SurfaceData],(S,1))
+
+    for q,(param,surfIndex,tol) in enumerate(tolerances):
+        if param == 'R':
+            # Radius tolerance, flat surfaces have no radius
+            C[:,surfIndex] = 1/(1/C[:,surfIndex] + perturbation[:,q])
+        if param == 'C':
+            C[:,surfIndex] += perturbation[:,q]
+        if param == 'd':
+            d[:,surfIndex] += perturbation[:,q]
+        if param == 'n':
+            n[:,surfIndex] += perturbation[:,q]
+
+    return d,C,n
+
+def trace_stack(XYZ,LMN,d,C,n):
+    '''
+    Vectorized Welford trace of R rays through S systems, returns the ray
+    position and direction cosines on the last surface.
+
+    XYZ,LMN: numpy arrays [R, 3], ray position and direction cosines
+    d,C,n  : numpy arrays [S, k], stacked systems
+    Returns X,Y,Z,L,M,N as numpy arrays [S, R]. Rays that miss a surface or
+    are reflected are numpy.nan.
+    '''
+    S = d.shape[0]
+    X,Y,Z = [np.broadcast_to(XYZ[:,q],(S,len(XYZ))) for q in range(3)]
+    L,M,N = [np.broadcast_to(LMN[:,q],(S,len(LMN))) for q in range(3)]
+    k = d.shape[1]
+
+    for w in range (1,k):
+        step  = transfer_refract(X,Y,Z,L,M,N,
+                                 d[:,w-1,None],C[:,w,None],
+                                 n[:,w-1,None],n[:,w,None])
+        X,Y,Z = step[5:8]
+        L,M,N = step[14:17]
+
+    return X,Y,Z,L,M,N
+
+def spot_criterion(X,Y,L,M,N,criterion='rms',compensator=True):
+    '''
+    Spot criterion per system on the image plane.
+
+    X,Y,L,M,N  : numpy arrays [S, R] on the image surface
+    criterion  : 'rms' (RMS radius), 'geo' (maximum radius) or a function
+                 criterion(x,y) -> [S], with x,y centered [S, R] arrays
+    compensator: if True, the image plane is refocused to the distance
+                 that minimizes the RMS radius (autofocus)
+    Returns the criterion [S] and the focus shift [S]
+    '''
+    with np.errstate(invalid='ignore',divide='ignore'):
+        a  = L/N
+        b  = M/N
+        xc = X - np.nanmean(X,axis=1,keepdims=True)
+        yc = Y - np.nanmean(Y,axis=1,keepdims=True)
+        ac = a - np.nanmean(a,axis=1,keepdims=True)
+        bc = b - np.nanmean(b,axis=1,keepdims=True)
+        focusShift = np.zeros(X.shape[0])
+        if compensator:
+            # RMS(dz)^2 is quadratic in dz, the minimum is found in closed form
+            focusShift = -(np.nanmean(xc*ac+yc*bc,axis=1)
+                           /np.nanmean(ac**2+bc**2,axis=1))
+            focusShift = np.nan_to_num(focusShift)
+            xc = xc + ac*focusShift[:,None]
+            yc = yc + bc*focusShift[:,None]
+
+        if criterion == 'rms':
+            value = np.sqrt(np.nanmean(xc**2+yc**2,axis=1))
+        elif criterion == 'geo':
+            value = np.sqrt(np.nanmax(xc**2+yc**2,axis=1))
+        else:
+            value = criterion(xc,yc)
+
+    return value,focusShift
+
+def monte_carlo_tolerance(optDsg,tolerances,noTrials=10000,noRays=100,
+                          criterion='rms',spec=None,compensator=True,
+                          distribution='uniform',chunkSize=2000,seed=None):
+    '''
+    Monte Carlo tolerance analysis of an optical design. The rays of a spot
+    diagram of the nominal design are traced through noTrials perturbed
+    systems in batches of chunkSize systems.
+
+    optDsg:       solved OpDesign
+    tolerances:   list of tuples, (param, surfIndex, tolerance), param in
+                  TOL_PARAMS. Decenter and tilt are not supported by the trace
+    noTrials:     number of perturbed systems
+    noRays:       number of rays of the nominal spot diagram
+    criterion:    see spot_criterion
+    spec:         criterion upper limit for the yield
+    compensator:  if True, the image distance is refocused in every trial
+    distribution: 'uniform' in [-tolerance, +tolerance] or 'normal' with
+                  tolerance as standard deviation
+    seed:         seed of the random generator
+
+    Returns a ToleranceReport
+    '''
+    assert optDsg.dsgSolved, 'The optical design is not solved'
+    SurfaceData = optDsg.optSys.SurfaceData
+    for (param,surfIndex,tol) in tolerances:
+        if param not in TOL_PARAMS:
+            raise ValueError('%s, tolerance parameter not supported' % param)
+        assert 0 <= surfIndex < len(SurfaceData), 'Invalid surface index in tolerances'
+        if param == 'R' and SurfaceData[surfIndex][1] == 0:
+            raise ValueError('Radius tolerance on flat surface %d, use "C" instead' % surfIndex)
+
+    # Nominal rays, sampled once from the aperture stop
+    spot = spot_diagram(optDsg,noRays=noRays)
+    XYZ  = spot.XYZ
+    LMN  = spot.LMN
+    wvln = optDsg.usrSrc.Wavelength
+
+    def evaluate(perturbation):
+        d,C,n = perturbed_systems(SurfaceData,wvln,tolerances,perturbation)
+        X,Y,Z,L,M,N = trace_stack(XYZ,LMN,d,C,n)
+        return spot_criterion(X,Y,L,M,N,criterion,compensator)
+
+    P   = len(tolerances)
+    tol = np.array([q[2] for q in tolerances],dtype=float)
+    rng = np.random.default_rng(seed)
+    if distribution == 'uniform':
+        perturbation = rng.uniform(-1,1,(noTrials,P))*tol
+    elif distribution == 'normal':
+        perturbation = rng.normal(0,1,(noTrials,P))*tol
+    else:
+        raise ValueError('%s, distribution not supported' % distribution)
+
+    # Nominal and one parameter at a time (-tol, +tol) systems
+    single = np.zeros((1+2*P,P))
+    for q in range(P):
+        single[1+2*q  ,q] = -tol[q]
+        single[1+2*q+1,q] = +tol[q]
+    singleCrit,_ = evaluate(single)
+    nominal      = singleCrit[0]
+    sensitivity  = singleCrit[1:].reshape(P,2) - nominal
+
+    # Monte Carlo trials
+    crit  = np.empty(noTrials)
+    focus = np.empty(noTrials)
+    for start in range(0,noTrials,chunkSize):
+        stop = min(start+chunkSize,noTrials)
+        crit[start:stop],focus[start:stop] = evaluate(perturbation[start:stop])
+
+    return ToleranceReport(tolerances,nominal,crit,perturbation,focus,sensitivity,spec)
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import PointSource
+    from JenTrace.opt_dsg import OpDesign
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (10     ,1/-31.47  ,1      )
+
+    # Instantiate optical design
+    pto1     = PointSource([0,2.5,0],635)
+    design1  = OpDesign(pto1,syst1,aprRad=2)
+    design1.autofocus()
+
+    tolerances = [('R',1,0.05),('R',2,0.05),('R',3,0.10),
+                  ('d',1,0.05),('d',2,0.05),
+                  ('n',1,0.001),('n',2,0.001)]
+
+    start  = time.time()
+    report = monte_carlo_tolerance(design1,tolerances,noTrials=10000,spec=0.05,seed=1)
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    report.print_report()
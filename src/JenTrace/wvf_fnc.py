@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Wavefront analysis: exit pupil reference sphere OPD and Zernike fit
+Class:      -Wavefront
+functions:  -exit_pupil
+            -reference_opd
+            -noll_index
+            -zernike_basis
+            -zernike_fit
+            -grid_pupil
+            -wavefront
+
+The optical path length (OPL) is accumulated by the trace (column 24). The
+OPD is measured on the reference sphere centered on the chief ray image
+point that passes through the center of the exit pupil. The Zernike
+polynomials use the Noll order and are normalized to unit RMS over the pupil,
+the pupil coordinates are the normalized aperture stop coordinates.
+"""
+try: import JenTrace
+except ModuleNotFoundError:
+    import os, sys
+    sys.path.insert(0,os.path.dirname(os.getcwd()))
+
+import math
+import numpy as np
+import matplotlib.pyplot as plt
+from JenTrace.catalog import refraction_index
+from JenTrace.ray_trc import trace_surfaces
+
+'''
+Cached Zernike basis and pseudo-inverse, key: (pupil grid, number of terms)
+'''
+ZERNIKE_CACHE = {}
+ZERNIKE_CACHE_SIZE = 32
+
+class Wavefront:
+    '''
+    Wavefront error of an optical design.
+
+    Attributes:
+        Pupil       : numpy array [i,2], normalized pupil coordinates [px,py]
+        OPD         : numpy array [i], optical path difference in waves
+                      (OPL of the ray minus OPL of the chief ray, on the
+                      reference sphere)
+        Coefficients: numpy array [noTerms], Zernike coefficients in waves (Noll)
+        RMS         : RMS wavefront error in waves (piston removed)
+        PV          : peak to valley wavefront error in waves
+        Strehl      : Strehl ratio (Marechal approximation)
+        Wavelength  : wavelength in nm
+    '''
+    def __init__(self,pupil,opd,coefficients,wvln):
+        self.Pupil        = pupil
+        self.OPD          = opd
+        self.Coefficients = coefficients
+        self.Wavelength   = wvln
+        self.RMS          = np.sqrt(np.sum(coefficients[1:]**2))
+        self.PV           = np.nanmax(opd) - np.nanmin(opd)
+        self.Strehl       = np.exp(-(2*np.pi*self.RMS)**2)
+
+    def plot(self):
+        fig, ax = plt.subplots()
+        sc = ax.scatter(self.Pupil[:,0],self.Pupil[:,1],c=self.OPD,s=8,cmap='jet')
+        fig.colorbar(sc,ax=ax,label='OPD[waves]')
+        ax.set_aspect('equal')
+        ax.set_xlabel('px')
+        ax.set_ylabel('py')
+        return fig, ax
+
+    def print_report(self):
+        print("\nWAVEFRONT")
+        print("Wavelength: {:f} nm".format(self.Wavelength))
+        print("RMS: {:f} waves, PV: {:f} waves, Strehl: {:f}".format(self.RMS,self.PV,self.Strehl))
+        headers = ['Term','n','m','Coef']
+        print("{: >6} {: >4} {: >4} {: >12} ".format(*headers))
+        for j,coef in enumerate(self.Coefficients,start=1):
+            print("{: 6d} {: 4d} {: 4d} {:12f} ".format(j,*noll_index(j),coef))
+
+def exit_pupil(SurfaceData,wvln,aprInd):
+    '''
+    Paraxial exit pupil position, measured from the image surface (negative:
+    before the image). A paraxial ray from the center of the aperture stop is
+    traced to the last surface. Returns numpy.inf if the system is
+    telecentric in the image space.
+    '''
+    k = len(SurfaceData)
+    n = [refraction_index(surf[2],wvln) for surf in SurfaceData]
+    y,u = 0.0,1e-3
+    for w in range(aprInd+1,k-1):
+        y = y + SurfaceData[w-1][0]*u
+        u = (n[w-1]*u - y*SurfaceData[w][1]*(n[w]-n[w-1]))/n[w]
+    if u == 0:
+        return np.inf
+    return -y/u - SurfaceData[k-2][0]
+
+def reference_opd(XYZ,LMN,OPL,zXP,wvln,nImage=1.0,chiefIndex=0):
+    '''
+    OPD (waves) of the rays on the reference sphere. The sphere is centered on
+    the image point of the chief ray and passes through the exit pupil center
+    [0,0,zXP]; a plane normal to the chief ray is used when zXP is infinite.
+
+    XYZ,LMN: numpy arrays [i,3] on the image surface
+    OPL    : numpy array [i], optical path length up to the image surface
+    Returns numpy array [i]
+    '''
+    center = XYZ[chiefIndex]
+    rel    = XYZ - center
+    if np.isfinite(zXP):
+        pupil  = np.array([0.0,0.0,zXP]) - center
+        radius = np.linalg.norm(pupil)
+        b = np.sum(LMN*rel,axis=1)
+        c = np.sum(rel**2,axis=1) - radius**2
+        with np.errstate(invalid='ignore'):
+            root = np.sqrt(b**2 - c)
+        # Intersection on the side of the exit pupil
+        t = np.where(np.dot(LMN,pupil) > 0, -b + root, -b - root)
+    else:
+        chief = LMN[chiefIndex]
+        t = -(rel @ chief)/(LMN @ chief)
+    sphereOPL = OPL + nImage*t
+    return (sphereOPL - sphereOPL[chiefIndex])/(wvln*1e-6)
+
+def noll_index(j):
+    '''
+    Radial order n and azimuthal frequency m of the Noll Zernike term j (j>=1)
+    '''
+    n = 0
+    while (n+1)*(n+2)//2 < j:
+        n += 1
+    # Position in the order n, the |m| values grow with j (each m != 0 twice)
+    p = j - n*(n+1)//2 - 1
+    mAbs = 2*((p+1)//2) if n % 2 == 0 else 2*(p//2)+1
+    if mAbs == 0:
+        return n,0
+    # Even j: cosine terms (m > 0), odd j: sine terms (m < 0)
+    return n,(mAbs if j % 2 == 0 else -mAbs)
+
+def zernike_basis(px,py,noTerms=37):
+    '''
+    Noll Zernike basis [i,noTerms] (unit RMS normalization) on the pupil
+    points px,py. The basis and its pseudo-inverse are cached per pupil grid,
+    so repeated fits on the same grid only cost a matrix product.
+    Returns the basis [i,noTerms] and the pseudo-inverse [noTerms,i]
+    '''
+    px  = np.ascontiguousarray(px,dtype=float)
+    py  = np.ascontiguousarray(py,dtype=float)
+    key = (len(px),hash(px.tobytes()),hash(py.tobytes()),noTerms)
+    if key in ZERNIKE_CACHE:
+        return ZERNIKE_CACHE[key]
+
+    rho   = np.hypot(px,py)
+    theta = np.arctan2(py,px)
+    basis = np.empty([len(px),noTerms])
+    for j in range(1,noTerms+1):
+        n,m = noll_index(j)
+        radial = np.zeros(len(px))
+        for s in range((n-abs(m))//2+1):
+            radial += ((-1)**s*math.factorial(n-s)
+                       /(math.factorial(s)*math.factorial((n+abs(m))//2-s)
+                         *math.factorial((n-abs(m))//2-s)))*rho**(n-2*s)
+        if m == 0:
+            basis[:,j-1] = np.sqrt(n+1)*radial
+        elif m > 0:
+            basis[:,j-1] = np.sqrt(2*(n+1))*radial*np.cos(m*theta)
+        else:
+            basis[:,j-1] = np.sqrt(2*(n+1))*radial*np.sin(-m*theta)
+
+    if len(ZERNIKE_CACHE) >= ZERNIKE_CACHE_SIZE:
+        ZERNIKE_CACHE.pop(next(iter(ZERNIKE_CACHE)))
+    ZERNIKE_CACHE[key] = (basis,np.linalg.pinv(basis))
+    return ZERNIKE_CACHE[key]
+
+def zernike_fit(px,py,opd,noTerms=37):
+    '''
+    Least squares Zernike coefficients [noTerms] of the OPD sampled on the
+    pupil points px,py, one system solved over all the rays. Lost rays
+    (numpy.nan) are removed: the rows of the valid points are taken from the
+    cached basis of the full grid and solved without caching, so the cache
+    does not grow with the vignetting patterns.
+    '''
+    basis,pinv = zernike_basis(px,py,noTerms)
+    valid = np.isfinite(opd)
+    if np.all(valid):
+        return pinv @ opd
+    return np.linalg.lstsq(basis[valid],opd[valid],rcond=None)[0]
+
+def grid_pupil(gridSize=32):
+    '''
+    Regular square grid of gridSize x gridSize points clipped to the unit
+    circle. Returns px,py numpy arrays
+    '''
+    g     = (np.arange(gridSize)+0.5)/gridSize*2 - 1
+    px,py = np.meshgrid(g,g)
+    inside = px**2 + py**2 <= 1
+    return px[inside],py[inside]
+
+def wavefront(optDsg,gridSize=32,noTerms=37):
+    '''
+    Wavefront error of a solved optical design on a regular pupil grid: the
+    rays are mapped to the source with OpDesign.pupil_source, traced with
+    their optical path length and referred to the exit pupil reference sphere.
+    Returns a Wavefront
+    '''
+    assert optDsg.dsgSolved, 'The optical design is not solved'
+    SurfaceData = optDsg.optSys.SurfaceData
+    wvln        = optDsg.usrSrc.Wavelength
+    px,py       = grid_pupil(gridSize)
+
+    XYZ,LMN = optDsg.pupil_source(px,py)
+    # Aimed chief ray first
+    chief   = optDsg.usrSrc.RayList[0]
+    XYZ     = np.vstack([chief[0],XYZ])
+    LMN     = np.vstack([chief[1],LMN])
+    image   = trace_surfaces(XYZ,LMN,wvln,SurfaceData,[-1])[:,:,0]
+
+    zXP    = exit_pupil(SurfaceData,wvln,optDsg.aprInd)
+    nImage = refraction_index(SurfaceData[-2][2],wvln)
+    opd    = reference_opd(image[:,2:5],image[:,5:8],image[:,8],zXP,wvln,nImage)[1:]
+    coef   = zernike_fit(px,py,opd,noTerms)
+
+    return Wavefront(np.column_stack([px,py]),opd,coef,wvln)
+
+
+if __name__ == '__main__':
+    import time
+    from JenTrace.opt_sys import OpSysData
+    from JenTrace.ray_src import PointSource
+    from JenTrace.opt_dsg import OpDesign
+
+    # Instantiate optical system
+    syst1 = OpSysData()
+    syst1.change_surface(60     ,0         ,1      ,surfIndex=0)
+    syst1.add_surface   (3.50   ,1/15.37   ,'N-BK7')
+    syst1.add_surface   (1.50   ,1/-11.10  ,'N-SF5')
+    syst1.add_surface   (39.68  ,1/-31.47  ,1      )
+
+    design1 = OpDesign(PointSource([0,2.5,0],635),syst1,aprRad=1)
+    design1.autofocus()
+
+    start = time.time()
+    wave1 = wavefront(design1)
+    print('Elapsed time: {:f} s'.format(time.time()-start))
+    start = time.time()
+    wave1 = wavefront(design1)
+    print('Elapsed time (cached basis): {:f} s'.format(time.time()-start))
+    wave1.print_report()
+    wave1.plot()
+    plt.show()